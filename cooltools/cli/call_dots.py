@@ -1,11 +1,17 @@
+import os
 import os.path as op
-from scipy.stats import poisson
+import json
+import shutil
+import tempfile
+import time
+import multiprocess as mp
 import pandas as pd
 import numpy as np
 import cooler
 
 import click
 from . import cli
+from .util import read_expected
 from .. import dotfinder
 
 
@@ -18,7 +24,7 @@ from .. import dotfinder
 @click.argument(
     "expected_path",
     metavar="EXPECTED_PATH",
-    type=click.Path(exists=True, dir_okay=False),
+    type=click.Path(dir_okay=False),
     nargs=1)
 @click.option(
     '--expected-name',
@@ -72,6 +78,31 @@ from .. import dotfinder
     default=39000,
     show_default=True,
     )
+@click.option(
+    '--clustering-method',
+    help='Method for clustering dots: Birch clustering, or connected'
+         ' components of dots closer than the clustering radius, which'
+         ' is much faster for large numbers of enriched pixels.',
+    type=click.Choice(['birch', 'connected']),
+    default='birch',
+    show_default=True,
+    )
+@click.option(
+    '--resolutions',
+    help="Comma-separated resolutions to call dots at, in a multi-resolution"
+         " COOL_PATH (.mcool), sharing a pool of workers. EXPECTED_PATH must"
+         " then have a {resolution} placeholder. Dots called at every"
+         " resolution are merged, keeping the finer ones.",
+    type=str,
+    required=False)
+@click.option(
+    "--profile",
+    help="Record timings of every step and every tile: time spent in"
+         " fetching, convolution, Poisson tests and annotation, bytes fetched,"
+         " size of dense tiles, pixels scored and worker pid. The profile is"
+         " written to <output-calls>.profile.json and summarized in the output.",
+    is_flag=True,
+    default=False)
 @click.option(
     "--verbose", "-v",
     help="Enable verbose output",
@@ -84,6 +115,37 @@ from .. import dotfinder
          " preprocessed in a BEDPE-like format.",
     type=str,
     required=False)
+@click.option(
+    "--spill-dir",
+    help="Keep the scored pixels of every tile in this directory during the"
+         " histogramming pass and extract dots from them afterwards, instead"
+         " of convolving every tile a second time, in a subdirectory"
+         " specific to the inputs and parameters of the run. Needs disk space"
+         " for the scored pixels with more than one raw count.",
+    type=click.Path(file_okay=False),
+    required=False)
+@click.option(
+    "--tmp-dir",
+    help="Directory for temporary files, such as the extracted pixels"
+         " streamed to disk before they are sorted. [default: system"
+         " temporary directory]",
+    type=click.Path(exists=True, file_okay=False),
+    required=False)
+@click.option(
+    "--checkpoint-dir",
+    help="Record per-tile histograms and extracted pixels in this directory"
+         " as tiles are done, in a subdirectory specific to the inputs and"
+         " parameters of the run. Use with --resume to restart a killed run"
+         " without redoing finished tiles.",
+    type=click.Path(file_okay=False),
+    required=False)
+@click.option(
+    "--resume",
+    help="Resume a run from the records in --checkpoint-dir, instead of"
+         " discarding them. When combined with --spill-dir, tiles missing"
+         " from the spill directory are scored again.",
+    is_flag=True,
+    default=False)
 @click.option(
     "--output-calls", "-o",
     help="Specify output file name where to store"
@@ -99,8 +161,15 @@ def call_dots(
         tile_size,
         fdr,
         dots_clustering_radius,
+        clustering_method,
+        resolutions,
+        profile,
         verbose,
         output_scores,
+        spill_dir,
+        tmp_dir,
+        checkpoint_dir,
+        resume,
         output_calls):
     """
     Call dots on a Hi-C heatmap that are not larger than max_loci_separation.
@@ -119,10 +188,151 @@ def call_dots(
 
     EXPECTED_PATH must contain at least the following columns for cis contacts:
     'chrom', 'diag', 'n_valid', value_name. value_name is controlled using
-    options. Header must be present in a file.
+    options. Header must be present in a file. EXPECTED_PATH may also be
+    a Parquet (.parquet) or HDF5 (.h5) table written by compute-expected.
+
+    With --resolutions, COOL_PATH is a .mcool file and EXPECTED_PATH is
+    a template, e.g. "expected.{resolution}.tsv". Outputs of every
+    resolution get the resolution inserted before their extension, and
+    "final_" output gets the dots merged across resolutions.
 
     """
+    if resume and checkpoint_dir is None:
+        raise click.UsageError("--resume requires --checkpoint-dir")
+
+    params = dict(
+        expected_name=expected_name,
+        nproc=nproc,
+        max_loci_separation=max_loci_separation,
+        max_nans_tolerated=max_nans_tolerated,
+        tile_size=tile_size,
+        fdr=fdr,
+        dots_clustering_radius=dots_clustering_radius,
+        clustering_method=clustering_method,
+        verbose=verbose,
+        tmp_dir=tmp_dir,
+        checkpoint_dir=checkpoint_dir,
+        resume=resume,
+        # records of timings of steps and tiles:
+        profile=({'steps': [], 'tiles': []} if profile else None))
+
+    if resolutions is None:
+        _call_dots_at(cool_path, expected_path, output_scores=output_scores,
+                      spill_dir=spill_dir, output_calls=output_calls,
+                      **params)
+        _report_profile(params['profile'], output_calls)
+        return
+
+    resolutions = [int(res) for res in resolutions.split(',')]
+    if "{resolution}" not in expected_path:
+        raise click.BadParameter(
+            "EXPECTED_PATH must have a {resolution} placeholder"
+            " with --resolutions")
+    # one pool for all of the steps at all of the resolutions:
+    pool = mp.Pool(nproc) if nproc > 1 else None
+    calls = {}
+    try:
+        for res in resolutions:
+            if verbose:
+                print("calling dots at {} bp resolution".format(res))
+            calls[res] = _call_dots_at(
+                "{}::resolutions/{}".format(cool_path, res),
+                expected_path.format(resolution=res),
+                output_scores=(None if output_scores is None else
+                               "{}.{}".format(output_scores, res)),
+                spill_dir=(None if spill_dir is None else
+                           op.join(spill_dir, str(res))),
+                output_calls=(None if output_calls is None else
+                              _resolution_path(output_calls, res)),
+                pool=pool,
+                **params)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    # (3):
+    # merge dots called at different resolutions:
+    start = time.time()
+    merged = dotfinder.merge_resolutions(calls)
+    _profile_step(params['profile'], cool_path, 'merging', start)
+    if verbose:
+        print("{} dots after merging {} resolutions".format(
+                len(merged), len(resolutions)))
+    if output_calls is not None:
+        merged.to_csv(
+            op.join(op.dirname(output_calls),
+                    "final_" + op.basename(output_calls)),
+            sep='\t',
+            header=True,
+            index=False,
+            compression=None)
+    _report_profile(params['profile'], output_calls)
+
+
+def _profile_step(profile, cool_path, step, start):
+    """
+    Record the time since 'start' spent in a step for a cooler, and return
+    the current time - the start of the next step.
+
+    """
+    now = time.time()
+    if profile is not None:
+        profile['steps'].append(
+            dict(cooler=cool_path, step=step, time=now - start))
+    return now
+
+
+def _report_profile(profile, output_calls):
+    """
+    Write the profile next to 'output_calls' and print its summary.
+
+    """
+    if profile is None:
+        return
+    if output_calls is not None:
+        with open(output_calls + ".profile.json", "w") as f:
+            json.dump(profile, f, indent=1)
+    print("time spent in steps:")
+    print(pd.DataFrame(profile['steps']).to_string(index=False))
+    if profile['tiles']:
+        stages, slowest = dotfinder.profile_summary(profile['tiles'])
+        print("time spent in tiles:")
+        print(stages.to_string())
+        print("slowest tiles:")
+        print(slowest.to_string(index=False))
+
+
+def _resolution_path(path, res):
+    """
+    Output path for a single resolution, e.g. calls.5000.tsv for calls.tsv.
+
+    """
+    root, ext = op.splitext(path)
+    return "{}.{}{}".format(root, res, ext)
+
+
+def _call_dots_at(cool_path, expected_path, expected_name, nproc,
+                  max_loci_separation, max_nans_tolerated, tile_size, fdr,
+                  dots_clustering_radius, clustering_method, verbose,
+                  output_scores, spill_dir, tmp_dir, checkpoint_dir, resume,
+                  output_calls, pool=None, profile=None):
+    """
+    Call dots in a single cooler, see 'call_dots'. Steps are done in an
+    existing 'pool' of 'nproc' workers when provided, and their timings
+    are recorded in 'profile' when provided.
+
+    Returns dots that passed the thresholding.
+
+    """
+    if not op.exists(expected_path):
+        raise click.BadParameter(
+            "Path {} does not exist.".format(expected_path),
+            param_hint="EXPECTED_PATH")
+
+    start = time.time()
     clr = cooler.Cooler(cool_path)
+    # timings of tiles are labeled with the cooler:
+    tiles_profile = [] if profile is not None else None
 
     # read expected and make preparations for validation,
     # that's what we expect as column names:
@@ -141,15 +351,13 @@ def call_dots(
     # compute # of bins by comparing matching indexes:
     get_exp_bins = lambda df, ref_chroms: (
         df.index.get_level_values("chrom").isin(ref_chroms).sum())
-    # use 'usecols' as a rudimentary form of validation,
-    # and dtype. Keep 'comment' and 'verbose' - explicit,
-    # as we may use them later:
-    expected = pd.read_table(
+    # use columns and dtype as a rudimentary form of validation,
+    # text, Parquet and HDF5 tables are told apart by extension:
+    expected = read_expected(
         expected_path,
-        usecols=expected_columns,
-        index_col=expected_index,
-        dtype=expected_dtype,
-        comment=None,
+        expected_columns,
+        expected_index,
+        expected_dtype,
         verbose=verbose)
 
     #############################################
@@ -252,14 +460,56 @@ def call_dots(
     #              max_nans_tolerated, loci_separation_bins, output_scores,
     #              nproc, verbose)
 
+    # per-tile records and spilled pixels of this particular run are kept
+    # in subdirectories keyed by the inputs and parameters affecting them:
+    run_key = None
+    if checkpoint_dir is not None or spill_dir is not None:
+        run_params = dict(
+            expected_name=expected_name,
+            max_nans_tolerated=max_nans_tolerated,
+            loci_separation_bins=loci_separation_bins,
+            tile_size_bins=tile_size_bins,
+            balance_factor=balance_factor,
+            fdr=fdr)
+        run_key = dotfinder.checkpoint_key(clr, expected_path, kernels,
+                                           ledges, **run_params)
+    checkpoint_path = None
+    if checkpoint_dir is not None:
+        checkpoint_path = op.join(checkpoint_dir, run_key)
+        if op.exists(checkpoint_path) and not resume:
+            # stale records of an earlier run with the same inputs:
+            shutil.rmtree(checkpoint_path)
+        os.makedirs(checkpoint_path, exist_ok=True)
+        with open(op.join(checkpoint_path, "params.json"), "w") as f:
+            json.dump(dict(run_params,
+                           cool_path=cool_path,
+                           expected_path=expected_path), f, indent=2)
+        if verbose:
+            print("recording progress in {}".format(checkpoint_path))
+    spill_path = None
+    if spill_dir is not None:
+        spill_path = op.join(spill_dir, run_key)
+        if op.exists(spill_path) and not resume:
+            shutil.rmtree(spill_path)
+        os.makedirs(spill_path, exist_ok=True)
+
     ################################
     # calculates genome-wide histogram (gw_hist):
     ################################
+    start = _profile_step(profile, cool_path, 'preparation', start)
     gw_hist = dotfinder.scoring_and_histogramming_step(
         clr, expected, expected_name, tiles,
         kernels, ledges, max_nans_tolerated,
         loci_separation_bins, None, nproc,
-        verbose)
+        verbose,
+        # scored pixels are kept for the extraction,
+        # which needs the dynamic-donut criteria:
+        balance_factor=(balance_factor if spill_path is not None else None),
+        spill_path=spill_path,
+        checkpoint_path=checkpoint_path,
+        pool=pool,
+        profile=tiles_profile)
+    start = _profile_step(profile, cool_path, 'histogramming', start)
     # gw_hist for each kernel contains a histogram of
     # raw pixel intensities for every lambda-chunk (one per column)
     # in a row-wise order, i.e. each column is a histogram
@@ -279,41 +529,11 @@ def call_dots(
     ##############
 
 
-    # Reverse Cumulative Sum of a histogram ...
-    rcs_hist = {}
-    rcs_Poisson = {}
-    qvalues = {}
-    threshold_df = {}
-    for k in kernels:
-        # generate a reverse cumulative histogram for each kernel,
-        #  such that 0th raw contains total # of pixels in each lambda-chunk:
-        rcs_hist[k] = gw_hist[k].iloc[::-1].cumsum(axis=0).iloc[::-1]
-        # now for every kernel-type k - create rcsPoisson,
-        # a unit Poisson distribution for every lambda-chunk
-        # using upper boundary of each lambda-chunk as the expected:
-        rcs_Poisson[k] = pd.DataFrame()
-        for mu, column in zip(ledges[1:-1], gw_hist[k].columns):
-            # poisson.sf = 1 - poisson.cdf, but more precise
-            # poisson.sf(-1,mu) == 1.0, i.e. is equivalent to the
-            # poisson.pmf(gw_hist[k].index,mu)[::-1].cumsum()[::-1]
-            # i.e., the way unitPoissonPMF is generated in HiCCUPS:
-            renorm_factors = rcs_hist[k].loc[0,column]
-            rcs_Poisson[k][column] = renorm_factors * poisson.sf(gw_hist[k].index-1, mu)
-        # once we have both RCS hist and the Poisson:
-        # now compare rcs_hist and re-normalized rcs_Poisson
-        # to infer FDR thresolds for every lambda-chunk:
-        fdr_diff = fdr * rcs_hist[k] - rcs_Poisson[k]
-        # determine the threshold by checking the value at which
-        # 'fdr_diff' first turns positive:
-        threshold_df[k] = fdr_diff.where(fdr_diff>0).apply(lambda col: col.first_valid_index())
-        # q-values ...
-        # roughly speaking, qvalues[k] =  rcs_Poisson[k]/rcs_hist[k]
-        # bear in mind some issues with lots of NaNs and Infs after
-        # such a brave operation ...
-        qvalues[k] = rcs_Poisson[k] / rcs_hist[k]
-        # fill NaNs with the "unreachably" high value:
-        very_high_value = len(rcs_hist[k])
-        threshold_df[k] = threshold_df[k].fillna(very_high_value).astype(np.integer)
+    # FDR thresholds and q-values for every lambda-chunk,
+    # from reverse cumulative histograms and unit Poisson tables:
+    threshold_df, qvalues = dotfinder.determine_thresholds(
+        gw_hist, kernels, ledges, fdr)
+    start = _profile_step(profile, cool_path, 'thresholds', start)
 
     #################
     # this way threshold_df's index is
@@ -349,46 +569,70 @@ def call_dots(
     # calculated in the histogramming step ...
     ###################
 
-    filtered_pix = dotfinder.scoring_and_extraction_step(
-        clr, expected, expected_name, tiles, kernels,
-        ledges, threshold_df, max_nans_tolerated,
-        balance_factor, loci_separation_bins, output_calls,
-        nproc, verbose)
-
-    if verbose:
-        print("preparing to extract needed q-values ...")
-
-    # attempting to extract q-values using l-chunks and IntervalIndex:
-    # we'll do it in an ugly but workign fashion, by simply
-    # iteration over pairs of obs, la_exp and extracting needed qvals
-    # one after another ...
-    for k in kernels:
-        filtered_pix["la_exp."+k+".qval"] = \
-            [ qvalues[k].loc[o,e] for o,e \
-                 in filtered_pix[["obs.raw","la_exp."+k+".value"]].itertuples(index=False) ]
-    # qvalues : dict
-    #   A dictionary with keys being kernel names and values pandas.DataFrame-s
-    #   storing q-values: each column corresponds to a lambda-chunk,
-    #   while rows correspond to observed pixels values.
-
-
-    ######################################
-    # post processing starts from here on:
-    # it includes:
-    # 0. remove low MAPQ reads (done externally ?!?)
-    # 1. clustering
-    # 2. filter pixels by FDR
-    # 3. merge different resolutions. (external script)
-    ######################################
-
-    if verbose:
-        print("Subsequent clustering and thresholding steps are not production-ready")
-
-    # (1):
-    centroids = dotfinder.clustering_step_local(filtered_pix, expected_chroms,
-                                      dots_clustering_radius, verbose)
-    # (2):
-    out = dotfinder.thresholding_step(centroids)
+    # extracted pixels are streamed to disk and come back sorted,
+    # one chromosome at a time, to be annotated and clustered:
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as sink_dir:
+        if spill_path is not None:
+            filtered_pix = dotfinder.extraction_from_spill_step(
+                spill_path, tiles, kernels, ledges, threshold_df,
+                output_calls, verbose)
+        else:
+            filtered_pix = dotfinder.scoring_and_extraction_step(
+                clr, expected, expected_name, tiles, kernels,
+                ledges, threshold_df, max_nans_tolerated,
+                balance_factor, loci_separation_bins, output_calls,
+                nproc, verbose, checkpoint_path=checkpoint_path,
+                sink_path=op.join(sink_dir, "extracted.h5"),
+                pool=pool,
+                profile=tiles_profile)
+        start = _profile_step(profile, cool_path, 'extraction', start)
+
+        if verbose:
+            print("preparing to extract needed q-values ...")
+
+        # attempting to extract q-values using l-chunks and IntervalIndex:
+        # we'll do it in an ugly but workign fashion, by simply
+        # iteration over pairs of obs, la_exp and extracting needed qvals
+        # one after another ...
+        def annotate_qvals(pixels):
+            for k in kernels:
+                pixels["la_exp."+k+".qval"] = \
+                    [ qvalues[k].loc[o,e] for o,e \
+                         in pixels[["obs.raw","la_exp."+k+".value"]].itertuples(index=False) ]
+            return pixels
+        # qvalues : dict
+        #   A dictionary with keys being kernel names and values pandas.DataFrame-s
+        #   storing q-values: each column corresponds to a lambda-chunk,
+        #   while rows correspond to observed pixels values.
+        if isinstance(filtered_pix, pd.DataFrame):
+            filtered_pix = annotate_qvals(filtered_pix)
+            start = _profile_step(profile, cool_path, 'qvalues', start)
+        else:
+            # chromosomes are annotated as they are clustered,
+            # that time is a part of the clustering step:
+            filtered_pix = map(annotate_qvals, filtered_pix)
+
+        ######################################
+        # post processing starts from here on:
+        # it includes:
+        # 0. remove low MAPQ reads (done externally ?!?)
+        # 1. clustering
+        # 2. filter pixels by FDR
+        # 3. merge different resolutions. (with --resolutions)
+        ######################################
+
+        if verbose:
+            print("Subsequent clustering and thresholding steps are not production-ready")
+
+        # (1) and (2), per chromosome in parallel:
+        centroids, out = dotfinder.clustering_and_thresholding_step(
+            filtered_pix, expected_chroms, dots_clustering_radius, verbose,
+            method=clustering_method, nproc=nproc, pool=pool,
+            profile=tiles_profile)
+    _profile_step(profile, cool_path, 'clustering', start)
+    if profile is not None:
+        profile['tiles'].extend(dict(record, cooler=cool_path)
+                                    for record in tiles_profile)
     if output_calls is not None:
         final_output = op.join(
             op.dirname(output_calls),
@@ -401,5 +645,5 @@ def call_dots(
             compression=None)
 
     # (3):
-    # Call dots for different resolutions individually and then use external methods
-    # to merge the calls
+    # dots called at different resolutions are merged by 'call_dots'
+    return out
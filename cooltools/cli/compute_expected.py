@@ -1,3 +1,4 @@
+import os.path as op
 import multiprocess as mp
 import numpy as np
 import pandas as pd
@@ -6,6 +7,7 @@ from .. import expected
 
 import click
 from . import cli
+from .util import EXPECTED_FORMATS, check_expected_format, write_expected
 
 # might be relevant to us ...
 # https://stackoverflow.com/questions/46577535/how-can-i-run-a-dask-distributed-local-cluster-from-the-command-line
@@ -13,10 +15,11 @@ from . import cli
 
 @cli.command()
 @click.argument(
-    "cool_path",
+    "cool_paths",
     metavar="COOL_PATH",
     type=str,
-    nargs=1)
+    nargs=-1,
+    required=True)
 @click.option(
     '--nproc', '-p',
     help="Number of processes to split the work between."
@@ -32,8 +35,9 @@ from . import cli
 @click.option(
     '--contact-type', "-t",
     help="compute expected for cis or trans region"
-    "of a Hi-C map.",
-    type=click.Choice(['cis', 'trans']),
+    "of a Hi-C map. 'both' computes cis and trans expected"
+    " in a single pass over the pixel table and requires --out-prefix.",
+    type=click.Choice(['cis', 'trans', 'both']),
     default='cis',
     show_default=True,
     )
@@ -49,6 +53,27 @@ from . import cli
     type=int,
     default=2,
     show_default=True)
+@click.option(
+    "--with-variance",
+    help="Also report the variance and standard deviation of the contact"
+         " frequencies of each diagonal. Only used for cis contact type.",
+    is_flag=True,
+    default=False)
+@click.option(
+    "--out-prefix", "-o",
+    help="Save expected tables as <out-prefix>.<contact-type>.<ext> instead"
+         " of printing them to stdout.",
+    type=str,
+    required=False)
+@click.option(
+    "--format", "out_format",
+    help="Format of the saved expected tables. Binary formats (Parquet, HDF5)"
+         " keep the column dtypes and are much faster to write and to read back"
+         " in compute-saddle and call-dots. Requires --out-prefix for anything"
+         " but tsv. Parquet requires pyarrow (the 'parquet' extra).",
+    type=click.Choice(list(EXPECTED_FORMATS)),
+    default='tsv',
+    show_default=True)
 # can we use feature switch
 # for --cis/--trans instead (?):
 # http://click.pocoo.org/options/#feature-switches
@@ -69,18 +94,56 @@ from . import cli
 #     flag_value='trans',
 #     required=True
 #     )
-def compute_expected(cool_path, nproc, chunksize, contact_type, weight_name, drop_diags):
+def compute_expected(cool_paths, nproc, chunksize, contact_type, weight_name,
+                     drop_diags, with_variance, out_prefix, out_format):
     """
     Calculate expected Hi-C signal either for cis or for trans regions
     of chromosomal interaction map.
 
     COOL_PATH : The paths to a .cool file with a balanced Hi-C map.
 
+    Several COOL_PATHs, or a multi-resolution .mcool file without a resolution
+    (which stands for all of its resolutions), compute cis expected for every
+    input on a single process pool. Tables are then saved as
+    <out-prefix>.<name>.cis.<ext>, where <name> is the file name of the input
+    without extension, followed by the resolution for .mcool inputs.
+
     """
+    # fail before computing anything:
+    check_expected_format(out_format)
+    uris = _expand_uris(cool_paths)
+    if len(uris) > 1:
+        if contact_type != 'cis':
+            raise click.BadParameter(
+                "several inputs are only supported for cis contact type",
+                param_hint="'--contact-type'")
+        if out_prefix is None:
+            raise click.BadParameter(
+                "several inputs produce several tables and require --out-prefix",
+                param_hint="'--out-prefix'")
+        _compute_expected_batch(uris, nproc, chunksize, weight_name,
+                                drop_diags, with_variance, out_prefix,
+                                out_format)
+        return
+    cool_path, = uris
+
+    if contact_type == 'both' and out_prefix is None:
+        raise click.BadParameter(
+            "--contact-type both produces two tables and requires --out-prefix",
+            param_hint="'--out-prefix'")
+    if out_format != 'tsv' and out_prefix is None:
+        raise click.BadParameter(
+            "--format {} can't be printed to stdout and requires --out-prefix"
+                .format(out_format),
+            param_hint="'--out-prefix'")
+
     clr = cooler.Cooler(cool_path)
     supports = [(chrom, 0, clr.chromsizes[chrom]) for chrom in clr.chromnames]
     weight1 = weight_name+"1"
     weight2 = weight_name+"2"
+    transforms = {
+        'balanced': lambda p: p['count'] * p[weight1] * p[weight2]
+    }
 
     if nproc > 1:
         pool = mp.Pool(nproc)
@@ -88,44 +151,124 @@ def compute_expected(cool_path, nproc, chunksize, contact_type, weight_name, dro
     else:
         map_ = map
 
+    results = {}
     try:
         if contact_type == 'cis':
             tables = expected.diagsum(
                 clr,
                 supports,
-                transforms={
-                    'balanced': lambda p: p['count'] * p[weight1] * p[weight2]
-                },
+                transforms=transforms,
                 chunksize=chunksize,
                 ignore_diags=drop_diags,
-                map=map_)
-            result = pd.concat(
-                [tables[support] for support in supports],
-                keys=[support[0] for support in supports],
-                names=['chrom'])
-            result['balanced.avg'] = result['balanced.sum'] / result['n_valid']
-            result = result.reset_index()
+                map=map_,
+                moments=('sumsq',) if with_variance else None)
+            results['cis'] = _cis_expected_table(tables, supports)
 
         elif contact_type == 'trans':
             records = expected.blocksum_pairwise(
                 clr,
                 supports,
-                transforms={
-                    'balanced': lambda p: p['count'] * p[weight1] * p[weight2]
-                },
+                transforms=transforms,
                 chunksize=chunksize,
                 map=map_)
-            result = pd.DataFrame(
-                [{'chrom1': s1[0], 'chrom2': s2[0], **rec}
-                    for (s1, s2), rec in records.items()],
-                columns=['chrom1', 'chrom2', 'n_valid',
-                         'count.sum', 'balanced.sum'])
-            result['balanced.avg'] = result['balanced.sum'] / result['n_valid']
+            results['trans'] = _trans_expected_table(records)
+
+        elif contact_type == 'both':
+            tables, records = expected.diagsum_and_blocksum(
+                clr,
+                supports,
+                transforms=transforms,
+                chunksize=chunksize,
+                ignore_diags=drop_diags,
+                map=map_)
+            results['cis'] = _cis_expected_table(tables, supports)
+            results['trans'] = _trans_expected_table(records)
     finally:
         if nproc > 1:
             pool.close()
 
-    # output to stdout,
-    # just like in diamond_insulation:
-    print(result.to_csv(sep='\t', index=False, na_rep='nan'))
+    for key, result in results.items():
+        if out_prefix is not None:
+            ext = EXPECTED_FORMATS[out_format][0]
+            write_expected(result, out_prefix + '.' + key + ext, out_format)
+        else:
+            # output to stdout,
+            # just like in diamond_insulation:
+            print(result.to_csv(sep='\t', index=False, na_rep='nan'))
+
+
+def _expand_uris(cool_paths):
+    uris = []
+    for path in cool_paths:
+        if '::' not in path and cooler.fileops.is_multires_file(path):
+            uris.extend(path + '::' + group
+                            for group in cooler.fileops.list_coolers(path))
+        else:
+            uris.append(path)
+    return uris
+
+
+def _uri_label(uri):
+    file_path, _, group = uri.partition('::')
+    label = op.splitext(op.basename(file_path))[0]
+    if group.strip('/'):
+        label += '.' + group.strip('/').split('/')[-1]
+    return label
+
+
+def _compute_expected_batch(uris, nproc, chunksize, weight_name, drop_diags,
+                            with_variance, out_prefix, out_format):
+    labels = [_uri_label(uri) for uri in uris]
+    if len(set(labels)) < len(labels):
+        labels = [str(i) + '.' + label for i, label in enumerate(labels)]
+
+    clrs = [cooler.Cooler(uri) for uri in uris]
+    weight1 = weight_name+"1"
+    weight2 = weight_name+"2"
+    transforms = {
+        'balanced': lambda p: p['count'] * p[weight1] * p[weight2]
+    }
+
+    if nproc > 1:
+        pool = mp.Pool(nproc)
+        map_ = pool.imap
+    else:
+        map_ = map
+
+    try:
+        batch = expected.diagsum_batch(
+            clrs,
+            transforms=transforms,
+            chunksize=chunksize,
+            ignore_diags=drop_diags,
+            map=map_,
+            moments=('sumsq',) if with_variance else None)
+        ext = EXPECTED_FORMATS[out_format][0]
+        for clr, label, tables in zip(clrs, labels, batch):
+            supports = [(chrom, 0, clr.chromsizes[chrom])
+                            for chrom in clr.chromnames]
+            write_expected(_cis_expected_table(tables, supports),
+                           out_prefix + '.' + label + '.cis' + ext,
+                           out_format)
+    finally:
+        if nproc > 1:
+            pool.close()
+
+
+def _cis_expected_table(tables, supports):
+    result = pd.concat(
+        [tables[support] for support in supports],
+        keys=[support[0] for support in supports],
+        names=['chrom'])
+    result['balanced.avg'] = result['balanced.sum'] / result['n_valid']
+    return result.reset_index()
+
 
+def _trans_expected_table(records):
+    result = pd.DataFrame(
+        [{'chrom1': s1[0], 'chrom2': s2[0], **rec}
+            for (s1, s2), rec in records.items()],
+        columns=['chrom1', 'chrom2', 'n_valid',
+                 'count.sum', 'balanced.sum'])
+    result['balanced.avg'] = result['balanced.sum'] / result['n_valid']
+    return result
@@ -11,7 +11,7 @@ import cooler
 from .. import saddle
 
 import click
-from .util import validate_csv
+from .util import validate_csv, read_expected
 from . import cli
 
 
@@ -142,7 +142,8 @@ def compute_saddle(cool_path, track_path, expected_path, contact_type, n_bins,
     EXPECTED_PATH must contain at least the following columns for cis contacts:
     'chrom', 'diag', 'n_valid', value_name and the following columns for trans
     contacts: 'chrom1', 'chrom2', 'n_valid', value_name value_name is controlled
-    using options. Header must be present in a file.
+    using options. Header must be present in a file. EXPECTED_PATH may also be
+    a Parquet (.parquet) or HDF5 (.h5) table written by compute-expected.
 
     """
     c = cooler.Cooler(cool_path)
@@ -191,15 +192,13 @@ def compute_saddle(cool_path, track_path, expected_path, contact_type, n_bins,
         raise ValueError(
             "Incorrect contact_type: {}, ".format(contact_type),
             "Should have been caught by click.")
-    # use 'usecols' as a rudimentary form of validation,
-    # and dtype. Keep 'comment' and 'verbose' - explicit,
-    # as we may use them later:
-    expected = pd.read_table(
+    # use columns and dtype as a rudimentary form of validation,
+    # text, Parquet and HDF5 tables are told apart by extension:
+    expected = read_expected(
         expected_path,
-        usecols=expected_columns,
-        index_col=expected_index,
-        dtype=expected_dtype,
-        comment=None,
+        expected_columns,
+        expected_index,
+        expected_dtype,
         verbose=False)
 
     # read bedGraph-file :
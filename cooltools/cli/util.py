@@ -2,6 +2,7 @@ import os.path as op
 import csv
 import io
 import click
+import pandas as pd
 
 
 class TabularFilePath(click.Path):
@@ -76,3 +77,132 @@ def validate_csv(ctx, param, value, default_column):
     elif field_name.isdigit():
         field_name = int(field_name)
     return file_path, field_name
+
+
+# extensions of the supported formats of expected tables,
+# the first one is used when writing:
+EXPECTED_FORMATS = {
+    'tsv': ['.tsv'],
+    'parquet': ['.parquet', '.pq'],
+    'hdf5': ['.h5', '.hdf5', '.hdf'],
+}
+# key of the expected table within an HDF5 file:
+EXPECTED_HDF5_KEY = 'expected'
+
+
+def expected_format(file_path):
+    """
+    Guess the format of an expected table from the file extension, anything
+    unknown is assumed to be tab-separated text.
+
+    """
+    ext = op.splitext(file_path)[1].lower()
+    for fmt, exts in EXPECTED_FORMATS.items():
+        if ext in exts:
+            return fmt
+    return 'tsv'
+
+
+def check_expected_format(fmt):
+    """
+    Make sure the optional dependencies of an expected table format are
+    installed: Parquet needs pyarrow or fastparquet, which are not installed
+    with cooltools by default (use the 'parquet' extra).
+
+    """
+    if fmt != 'parquet':
+        return
+    for engine in ['pyarrow', 'fastparquet']:
+        try:
+            __import__(engine)
+            return
+        except ImportError:
+            pass
+    raise click.ClickException(
+        "Parquet expected tables require pyarrow or fastparquet, install"
+        " one of them, e.g. with: pip install cooltools[parquet]")
+
+
+def _table_columns(file_path, fmt):
+    """
+    Column names of a Parquet or HDF5 expected table, from its schema,
+    without reading the table.
+
+    """
+    if fmt == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            import fastparquet
+            return list(fastparquet.ParquetFile(file_path).columns)
+        return pq.read_schema(file_path).names
+    with pd.HDFStore(file_path, 'r') as store:
+        return list(store.select(EXPECTED_HDF5_KEY, stop=0).columns)
+
+
+def write_expected(df, file_path, fmt='tsv'):
+    """
+    Write an expected table as tab-separated text, Parquet or HDF5.
+    The binary formats keep the column dtypes, so that reading the table
+    back doesn't require parsing text.
+
+    """
+    check_expected_format(fmt)
+    if fmt == 'tsv':
+        df.to_csv(file_path, sep='\t', index=False, na_rep='nan')
+    elif fmt == 'parquet':
+        df.to_parquet(file_path, index=False)
+    elif fmt == 'hdf5':
+        df.to_hdf(file_path, key=EXPECTED_HDF5_KEY, mode='w',
+                  format='table', index=False)
+    else:
+        raise ValueError("Unknown expected format: {}".format(fmt))
+
+
+def read_expected(file_path, columns, index, dtype, verbose=False):
+    """
+    Read the required columns of an expected table in any of the formats
+    written by :func:`write_expected`, validate their dtypes and index
+    the table.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the expected table, the format is guessed from the extension.
+    columns : list of str
+        Columns that must be present in the table.
+    index : list of str
+        Columns that become the (Multi)Index of the table.
+    dtype : dict of str -> dtype
+        Expected dtypes of the columns, a rudimentary form of validation.
+    verbose : bool, optional
+        Passed to the text reader.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    fmt = expected_format(file_path)
+    if fmt == 'tsv':
+        # use 'usecols' as a rudimentary form of validation,
+        # and dtype. Keep 'comment' and 'verbose' - explicit,
+        # as we may use them later:
+        return pd.read_table(
+            file_path,
+            usecols=columns,
+            index_col=index,
+            dtype=dtype,
+            comment=None,
+            verbose=verbose)
+
+    check_expected_format(fmt)
+    missing = set(columns) - set(_table_columns(file_path, fmt))
+    if missing:
+        raise ValueError(
+            "Columns {} are missing from {}".format(sorted(missing), file_path))
+    if fmt == 'parquet':
+        df = pd.read_parquet(file_path, columns=columns)
+    else:
+        df = pd.read_hdf(file_path, key=EXPECTED_HDF5_KEY, columns=columns)
+    return df[columns].astype(dtype).set_index(index)
@@ -2,19 +2,29 @@
 Collection of functions needed for dot-calling
 
 """
-from functools import partial, reduce
+from functools import partial
+from itertools import chain, islice
+import hashlib
+import json
+import os
+import os.path as op
+import queue
+import tempfile
+import time
 import multiprocess as mp
 
 from scipy.linalg import toeplitz
-from scipy.ndimage import convolve
-from scipy.stats import poisson
+from scipy.signal import fftconvolve
+from scipy.special import pdtr, pdtrc
 from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import numpy as np
 import pandas as pd
 from sklearn.cluster import Birch
-import cooler
 
 from .lib.numutils import LazyToeplitz, get_kernel
+from .lib import get_bin_arrays, annotate_pixels
 
 
 # these are the constants from HiCCUPS, that dictate how initial histogramms
@@ -181,6 +191,107 @@ def clust_2D_pixels(pixels_df,
     return centroids_n_labels_df
 
 
+def clust_2D_pixels_connected(pixels_df,
+                              threshold_cluster=2,
+                              bin1_id_name='bin1_id',
+                              bin2_id_name='bin2_id',
+                              clust_label_name='c_label',
+                              clust_size_name='c_size',
+                              verbose=True):
+    '''
+    Group significant pixels by proximity into connected components:
+    pixels closer than "threshold_cluster" to each other are linked, and
+    every group of linked pixels is reported as a single cluster along with
+    its centroid. Neighbours are found with a KD-tree, so this scales as
+    O(n log n) with the number of pixels and is a drop-in replacement for
+    'clust_2D_pixels' on large sets of enriched pixels.
+
+    Parameters
+    ----------
+    pixels_df : pandas.DataFrame
+        a DataFrame with pixel coordinates that must have at least 2 columns
+        named 'bin1_id' and 'bin2_id', where first is pixels's row and the
+        second is pixel's column index.
+    threshold_cluster : int
+        linking distance between pixels of the same cluster, in the units of
+        the coordinates.
+    bin1_id_name : str
+        Name of the 1st coordinate (row index) in 'pixel_df', by default
+        'bin1_id'. 'start1/end1' could be usefull as well.
+    bin2_id_name : str
+        Name of the 2nd coordinate (column index) in 'pixel_df', by default
+        'bin2_id'. 'start2/end2' could be usefull as well.
+    clust_label_name : str
+        Name of the cluster of pixels label. "c_label" by default.
+    clust_size_name : str
+        Name of the cluster of pixels size. "c_size" by default.
+    verbose : bool
+        Print verbose clustering summary report defaults is True.
+
+    Returns
+    -------
+    peak_tmp : pandas.DataFrame
+        DataFrame with the following columns:
+        [c+bin1_id_name, c+bin2_id_name, clust_label_name, clust_size_name]
+        row/col (bin1/bin2) are coordinates of centroids,
+        label and sizes are unique pixel-cluster
+        labels and their corresponding sizes.
+    '''
+
+    # integer coordinates are fine for the KD-tree, distances
+    # are computed in floating point internally:
+    pixels     = pixels_df[[bin1_id_name, bin2_id_name]].values
+    pixel_idxs = pixels_df.index
+    n_pixels   = len(pixels)
+
+    # pairs of pixels within the linking distance:
+    tree  = cKDTree(pixels)
+    pairs = tree.query_pairs(threshold_cluster, output_type='ndarray')
+    adjacency = coo_matrix(
+                    (np.ones(len(pairs), dtype=np.int8),
+                     (pairs[:, 0], pairs[:, 1])),
+                    shape=(n_pixels, n_pixels))
+    # labels are continuous here, i.e. 0, 1, ..., n_clusters-1:
+    n_clusters, clustered_labels = connected_components(adjacency,
+                                                        directed=False)
+    uniq_counts = np.bincount(clustered_labels, minlength=n_clusters)
+    cluster_sizes = uniq_counts[clustered_labels]
+    # centroids are the mean coordinates of the pixels in every cluster:
+    clustered_centroids = np.column_stack(
+        [np.bincount(clustered_labels,
+                     weights=pixels[:, i].astype(np.float64),
+                     minlength=n_clusters) / np.maximum(uniq_counts, 1)
+         for i in range(2)])
+    centroids_per_pixel = clustered_centroids[clustered_labels]
+
+    if verbose:
+        # prepare clustering summary report:
+        msg = "Clustering is completed:\n" + \
+              "{} clusters detected\n".format(n_clusters) + \
+              "{:.2f}+/-{:.2f} mean size\n".format(uniq_counts.mean(),
+                                                 uniq_counts.std())
+        print(msg)
+
+    # create output DataFrame
+    centroids_n_labels_df = pd.DataFrame(
+                                centroids_per_pixel.reshape(n_pixels, 2),
+                                index=pixel_idxs,
+                                columns=['c'+bin1_id_name,'c'+bin2_id_name])
+    # add labels per pixel:
+    centroids_n_labels_df[clust_label_name] = clustered_labels.astype(np.int64)
+    # add cluster sizes:
+    centroids_n_labels_df[clust_size_name] = cluster_sizes.astype(np.int64)
+
+    return centroids_n_labels_df
+
+
+# pixel clustering backends available to the clustering steps:
+CLUSTERING_METHODS = {
+    'birch': clust_2D_pixels,
+    'connected': clust_2D_pixels_connected,
+}
+
+
 def diagonal_matrix_tiling(start, stop, bandwidth, edge=0, verbose=False):
     """
     Generate a stream of tiling coordinates that guarantee to cover a diagonal
@@ -361,54 +472,124 @@ def square_matrix_tiling(start, stop, step, edge, square=False, verbose=False):
             yield (lwx+start,rwx+start), (lwy+start,rwy+start)
 
 
-def _convolve_and_count_nans(O_bal,E_bal,E_raw,N_bal,kernel):
-    """
-    Dense versions of a bunch of matrices needed for convolution and
-    calculation of number of NaNs in a vicinity of each pixel. And a kernel to
-    be provided of course.
-
-    """
-    # a matrix filled with the kernel-weighted sums
-    # based on a balanced observed matrix:
-    KO = convolve(O_bal,
-                  kernel,
-                  mode='constant',
-                  cval=0.0,
-                  origin=0)
-    # a matrix filled with the kernel-weighted sums
-    # based on a balanced expected matrix:
-    KE = convolve(E_bal,
-                  kernel,
-                  mode='constant',
-                  cval=0.0,
-                  origin=0)
-    # get number of NaNs in a vicinity of every
-    # pixel (kernel's nonzero footprint)
-    # based on the NaN-matrix N_bal.
-    # N_bal is shared NaNs between O_bal E_bal,
-    # is it redundant ?
-    NN = convolve(N_bal.astype(np.int),
-                  # we have to use kernel's
-                  # nonzero footprint:
-                  (kernel != 0).astype(np.int),
-                  mode='constant',
-                  # there are only NaNs
-                  # beyond the boundary:
-                  cval=1,
-                  origin=0)
-    ######################################
-    # using cval=0 for actual data and
-    # cval=1 for NaNs matrix reduces
-    # "boundary issue" to the "number of
-    # NaNs"-issue
-    # ####################################
-
-    # now finally, E_raw*(KO/KE), as the
-    # locally-adjusted expected with raw counts as values:
-    Ek_raw = np.multiply(E_raw, np.divide(KO, KE))
-    # return locally adjusted expected and number of NaNs
-    # in the form of dense matrices:
-    return Ek_raw, NN
+def decompose_kernel(kernel, max_rectangles=None):
+    """
+    Decompose a kernel into a set of non-overlapping weighted rectangles,
+    such as the HiCCUPS-like kernels from 'get_kernel', that are unions
+    of a few rectangles of ones.
+
+    Parameters
+    ----------
+    kernel : numpy.ndarray
+        2D kernel.
+    max_rectangles : int or None
+        Give up when the decomposition requires more rectangles than that.
+        Defaults to a quarter of the kernel's size, beyond which a direct
+        or FFT convolution is cheaper.
+
+    Returns
+    -------
+    rectangles : list of tuples or None
+        Tuples (u0, u1, v0, v1, weight) of inclusive row and column ranges
+        of every rectangle and its weight, or None when the kernel does not
+        decompose into few enough rectangles.
+
+    """
+    kernel = np.asarray(kernel)
+    if max_rectangles is None:
+        max_rectangles = max(1, kernel.size // 4)
+    rectangles = []
+    for weight in np.unique(kernel[kernel != 0]):
+        remaining = (kernel == weight)
+        while remaining.any():
+            # greedily grow a rectangle from the first remaining element,
+            # first to the right and then down:
+            u0, v0 = np.argwhere(remaining)[0]
+            v1 = v0
+            while v1 + 1 < kernel.shape[1] and remaining[u0, v1 + 1]:
+                v1 += 1
+            u1 = u0
+            while (u1 + 1 < kernel.shape[0] and
+                    remaining[u1 + 1, v0:v1 + 1].all()):
+                u1 += 1
+            remaining[u0:u1 + 1, v0:v1 + 1] = False
+            rectangles.append((u0, u1, v0, v1, weight))
+            if len(rectangles) > max_rectangles:
+                return None
+    return rectangles
+
+
+def convolve_kernels(matrix, kernels, cval=0.0, out=None):
+    """
+    Convolve a matrix with several kernels at once, equivalent to
+    calling scipy.ndimage.convolve(matrix, kernel, mode='constant',
+    cval=cval) for every kernel.
+
+    Kernels that decompose into a few rectangles (see 'decompose_kernel')
+    are evaluated from a single integral image (summed-area table) of the
+    matrix, in O(1) per pixel and rectangle. Other kernels fall back to FFT
+    convolution. Integer matrices (e.g. NaN masks) produce exact integer
+    results with either method.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray
+        2D matrix to convolve, without NaNs.
+    kernels : list of numpy.ndarray
+        2D kernels with odd dimensions.
+    cval : scalar
+        Value of the matrix beyond its boundaries.
+    out : numpy.ndarray, optional
+        Preallocated (n_kernels, n_rows, n_cols) buffer for the results.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Results of the convolutions, one (n_rows, n_cols) matrix per kernel.
+
+    """
+    is_int = np.issubdtype(matrix.dtype, np.integer)
+    n, m = matrix.shape
+    if out is None:
+        out = np.empty((len(kernels), n, m),
+                       dtype=np.int64 if is_int else np.float64)
+    if any(k.shape[0] % 2 == 0 or k.shape[1] % 2 == 0 for k in kernels):
+        raise ValueError("Kernels must have odd dimensions.")
+    # pad the matrix to the largest kernel, the same padding
+    # serves for the integral image and for FFT convolution:
+    cu = max(k.shape[0] for k in kernels) // 2
+    cv = max(k.shape[1] for k in kernels) // 2
+    padded = np.pad(matrix.astype(np.int64 if is_int else np.float64),
+                    ((cu, cu), (cv, cv)), mode='constant', constant_values=cval)
+    sat = None
+    for i, kernel in enumerate(kernels):
+        rectangles = decompose_kernel(kernel)
+        # offsets of the kernel's center within the padding:
+        du, dv = cu - kernel.shape[0] // 2, cv - kernel.shape[1] // 2
+        if rectangles is None:
+            sub = padded[du:du + n + kernel.shape[0] - 1,
+                         dv:dv + m + kernel.shape[1] - 1]
+            res = fftconvolve(sub, kernel, mode='valid')
+            out[i] = np.round(res) if is_int else res
+            continue
+        if sat is None:
+            sat = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1),
+                           dtype=padded.dtype)
+            np.cumsum(padded, axis=0, out=sat[1:, 1:])
+            np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+        out[i] = 0
+        for u0, u1, v0, v1, weight in rectangles:
+            # convolution flips the kernel, so that kernel's element (u, v)
+            # meets matrix element (r + c_u - u, c + c_v - v) for pixel (r, c):
+            r0 = du + 2 * (kernel.shape[0] // 2) - u1
+            r1 = du + 2 * (kernel.shape[0] // 2) - u0 + 1
+            c0 = dv + 2 * (kernel.shape[1] // 2) - v1
+            c1 = dv + 2 * (kernel.shape[1] // 2) - v0 + 1
+            out[i] += weight * (sat[r1:r1 + n, c1:c1 + m] -
+                                sat[r0:r0 + n, c1:c1 + m] -
+                                sat[r1:r1 + n, c0:c0 + m] +
+                                sat[r0:r0 + n, c0:c0 + m])
+    return out
 
 
 ########################################################################
@@ -581,113 +762,55 @@ def get_adjusted_expected_tile_some_nans(origin,
     N_bal = np.logical_or(np.isnan(O_bal),
                           np.isnan(E_bal))
     # fill in common nan-s with zeroes, preventing
-    # NaNs during convolution part of '_convolve_and_count_nans':
+    # NaNs in the kernel-weighted sums below:
     O_bal[N_bal] = 0.0
     E_bal[N_bal] = 0.0
-    # think about usinf copyto and where functions later:
-    # https://stackoverflow.com/questions/6431973/how-to-copy-data-from-a-numpy-array-to-another
-    #
-    #
-    # we are going to accumulate all the results
-    # into a DataFrame, keeping NaNs, and other
-    # unfiltered results (even the lower triangle for now):
-    i,j = np.indices(O_raw.shape)
-    # pack it into DataFrame to accumulate results:
-    peaks_df = pd.DataFrame({"bin1_id": i.flatten()+io,
-                             "bin2_id": j.flatten()+jo})
-
+    # kernel-weighted sums based on balanced observed and expected matrices,
+    # and numbers of NaNs in the kernels' nonzero footprints, are evaluated
+    # for all of the kernels at once (from a single integral image per
+    # matrix) into preallocated (n_kernels, n_rows, n_cols) buffers:
+    kernel_names = list(kernels)
+    kernel_list = [kernels[k] for k in kernel_names]
+    footprints = [(k != 0).astype(np.int64) for k in kernel_list]
+    KO_all = np.empty((len(kernel_list),) + O_bal.shape)
+    KE_all = np.empty_like(KO_all)
+    NN_all = np.empty(KO_all.shape, dtype=np.int64)
+    convolve_kernels(O_bal, kernel_list, out=KO_all)
+    convolve_kernels(E_bal, kernel_list, out=KE_all)
+    # there are only NaNs beyond the boundary, using cval=0 for actual data
+    # and cval=1 for NaNs matrix reduces "boundary issue" to the
+    # "number of NaNs"-issue:
+    convolve_kernels(N_bal.astype(np.int64), footprints, cval=1, out=NN_all)
+    # footprints with nothing but NaNs sum up to exactly 0, like with
+    # direct convolution, rather than to round-off residuals of integral
+    # images (they are masked as 0/0 below), and sums of non-negative
+    # kernels over non-negative matrices can't go below 0:
+    for KX_all in (KO_all, KE_all):
+        for ki, footprint in enumerate(footprints):
+            KX_all[ki][NN_all[ki] == footprint.sum()] = 0.0
+            if kernel_list[ki].min() >= 0:
+                np.maximum(KX_all[ki], 0.0, out=KX_all[ki])
+
+    # this is the place where we would need to extract
+    # some results of convolution and multuplt it by the
+    # appropriate factor "cooler._load_attrs(‘bins/weight’)[‘scale’]" ...
+    # KO*balance_factor for "lowleft": to be compared with 16 ...
+    keep_kerobs = bool(balance_factor) and ("lowleft" in kernel_names)
+    if keep_kerobs:
+        KerObs = balance_factor * KO_all[kernel_names.index("lowleft")]
+
+    # now finally, E_raw*(KO/KE), as the locally-adjusted
+    # expected with raw counts as values, in place of KO:
     with np.errstate(divide='ignore', invalid='ignore'):
-        for kernel_name, kernel in kernels.items():
-            ###############################
-            # kernel-specific calculations:
-            ###############################
-            # kernel paramters such as width etc
-            # are taken into account implicitly ...
-            ########################################
-            #####################
-            # unroll _convolve_and_count_nans function back
-            # for us to test the dynamic donut criteria ...
-            #####################
-            # Ek_raw, NN = _convolve_and_count_nans(O_bal,
-            #                                     E_bal,
-            #                                     E_raw,
-            #                                     N_bal,
-            #                                     kernel)
-            # Dense versions of a bunch of matrices needed for convolution and
-            # calculation of number of NaNs in a vicinity of each pixel. And a kernel to
-            # be provided of course.
-            # a matrix filled with the kernel-weighted sums
-            # based on a balanced observed matrix:
-            KO = convolve(O_bal,
-                          kernel,
-                          mode='constant',
-                          cval=0.0,
-                          origin=0)
-            # a matrix filled with the kernel-weighted sums
-            # based on a balanced expected matrix:
-            KE = convolve(E_bal,
-                          kernel,
-                          mode='constant',
-                          cval=0.0,
-                          origin=0)
-            # get number of NaNs in a vicinity of every
-            # pixel (kernel's nonzero footprint)
-            # based on the NaN-matrix N_bal.
-            # N_bal is shared NaNs between O_bal E_bal,
-            NN = convolve(N_bal.astype(np.int),
-                          # we have to use kernel's
-                          # nonzero footprint:
-                          (kernel != 0).astype(np.int),
-                          mode='constant',
-                          # there are only NaNs
-                          # beyond the boundary:
-                          cval=1,
-                          origin=0)
-            ######################################
-            # using cval=0 for actual data and
-            # cval=1 for NaNs matrix reduces
-            # "boundary issue" to the "number of
-            # NaNs"-issue
-            # ####################################
-            # now finally, E_raw*(KO/KE), as the
-            # locally-adjusted expected with raw counts as values:
-            Ek_raw = np.multiply(E_raw, np.divide(KO, KE))
-
-            # this is the place where we would need to extract
-            # some results of convolution and multuplt it by the
-            # appropriate factor "cooler._load_attrs(‘bins/weight’)[‘scale’]" ...
-            if balance_factor and (kernel_name == "lowleft"):
-                peaks_df["factor_balance."+kernel_name+".KerObs"] = balance_factor * KO.flatten()
-                # KO*balance_factor: to be compared with 16 ...
-            if verbose:
-                print("Convolution with kernel {} is complete.".format(kernel_name))
-            #
-            # accumulation into single DataFrame:
-            # store locally adjusted expected for each kernel
-            # and number of NaNs in the footprint of each kernel
-            peaks_df["la_exp."+kernel_name+".value"] = Ek_raw.flatten()
-            peaks_df["la_exp."+kernel_name+".nnans"] = NN.flatten()
-            # do all the filter/logic/masking etc on the complete DataFrame ...
-    #####################################
-    # downstream stuff is supposed to be
-    # aggregated over all kernels ...
-    #####################################
-    peaks_df["exp.raw"] = E_raw.flatten()
-    peaks_df["obs.raw"] = O_raw.flatten()
-
-    # TO BE REFACTORED/deprecated ...
-    # compatibility with legacy API is completely BROKEN
-    # post-processing allows us to restore it, see tests,
-    # but we pay with the processing speed for it.
-    mask_ndx = pd.Series(0, index=peaks_df.index, dtype=np.bool)
-    for kernel_name, kernel in kernels.items():
-        # accummulating with a vector full of 'False':
-        mask_ndx_kernel = ~np.isfinite(peaks_df["la_exp."+kernel_name+".value"])
-        mask_ndx = np.logical_or(mask_ndx_kernel,mask_ndx)
-
-    # returning only pixels from upper triangle of a matrix
-    # is likely here to stay:
-    upper_band = (peaks_df["bin1_id"] < peaks_df["bin2_id"])
+        np.divide(KO_all, KE_all, out=KO_all)
+        np.multiply(KO_all, E_raw, out=KO_all)
+    Ek_raw_all = KO_all
+    if verbose:
+        print("Convolution with kernels {} is complete.".format(
+                ", ".join(kernel_names)))
+
+    # returning only pixels from upper triangle of a matrix, with
+    # finite locally adjusted expected for every kernel:
     # Consider filling lower triangle of the OBSERVED matrix tile
     # with NaNs, instead of this - we'd need this for a fair
     # consideration of the pixels that are super close to the
@@ -696,10 +819,32 @@ def get_adjusted_expected_tile_some_nans(origin,
     # selecting pixels in relation to diagonal - too far, too
     # close etc, is now shifted to the outside of this function
     # a way to simplify code.
-
+    i, j = np.indices(O_raw.shape)
+    is_good = (i + io < j + jo) & np.isfinite(Ek_raw_all).all(axis=0)
+    i, j = i[is_good], j[is_good]
+
+    # pack results of all kernels into a single structured array,
+    # and turn it into a DataFrame only once:
+    fields = [("bin1_id", np.int64), ("bin2_id", np.int64)]
+    for kernel_name in kernel_names:
+        if keep_kerobs and (kernel_name == "lowleft"):
+            fields.append(("factor_balance."+kernel_name+".KerObs", np.float64))
+        fields.append(("la_exp."+kernel_name+".value", np.float64))
+        fields.append(("la_exp."+kernel_name+".nnans", np.int64))
+    fields += [("exp.raw", np.float64), ("obs.raw", O_raw.dtype)]
+    peaks = np.empty(len(i), dtype=fields)
+    peaks["bin1_id"] = i + io
+    peaks["bin2_id"] = j + jo
+    for ki, kernel_name in enumerate(kernel_names):
+        if keep_kerobs and (kernel_name == "lowleft"):
+            peaks["factor_balance."+kernel_name+".KerObs"] = KerObs[i, j]
+        peaks["la_exp."+kernel_name+".value"] = Ek_raw_all[ki][i, j]
+        peaks["la_exp."+kernel_name+".nnans"] = NN_all[ki][i, j]
+    peaks["exp.raw"] = E_raw[i, j]
+    peaks["obs.raw"] = O_raw[i, j]
 
     # return good semi-sparsified DF:
-    return peaks_df[~mask_ndx & upper_band].reset_index(drop=True)
+    return pd.DataFrame(peaks)
 
 
 def heatmap_tiles_generator_diag(clr, chroms, pad_size, tile_size, band_to_cover):
@@ -751,8 +896,192 @@ def heatmap_tiles_generator_diag(clr, chroms, pad_size, tile_size, band_to_cover
                 yield chrom, tilei, tilej
 
 
+def poisson_pvals(obs, la_exp):
+    """
+    Poisson p-values P(X > obs) for X ~ Poisson(la_exp), for arrays of
+    observed raw counts and locally adjusted expecteds.
+
+    Evaluates the regularized incomplete gamma function directly
+    (scipy.special.pdtr) for the whole batch, without the per-call overhead
+    of scipy.stats distributions. Same as 1.0 - poisson.cdf(obs, la_exp).
+
+    """
+    return 1.0 - pdtr(obs, la_exp)
+
+
+def poisson_survival_table(obs, mus):
+    """
+    Table of Poisson survival functions P(X >= obs) for X ~ Poisson(mu),
+    for every observed value and every mu - typically the upper
+    boundaries of lambda-chunks, i.e. the unit Poisson table of HiCCUPS.
+
+    Parameters
+    ----------
+    obs : array-like of int
+        Observed raw counts.
+    mus : array-like of float
+        Poisson expecteds.
+
+    Returns
+    -------
+    table : numpy.ndarray
+        (len(obs), len(mus)) array, same as poisson.sf(obs-1, mu) for
+        every mu.
+
+    """
+    obs = np.asarray(obs)
+    mus = np.asarray(mus, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        table = pdtrc(obs[:, None] - 1, mus[None, :])
+    # P(X >= 0) is 1 regardless of mu:
+    table[obs <= 0, :] = 1.0
+    return table
+
+
+def fetch_band_tile(clr, tilei, tilej, max_diag, field='count'):
+    """
+    Fetch a tile of a Hi-C heatmap as a dense matrix, with only the pixels
+    of the upper-triangular diagonal band 0 <= bin2 - bin1 < max_diag filled
+    in, the rest is zero.
+
+    Only the rows of the tile that intersect the band are read from the
+    pixel table, and the band is densified directly into the tile buffer.
+    For 'symmetric-upper' coolers, the band of the tile is identical to the
+    same pixels of the full dense tile returned by
+    clr.matrix(balance=False)[slice(*tilei), slice(*tilej)]. The number of
+    bytes read is added to the 'bytes_fetched' of the tile profile.
+
+    Parameters
+    ----------
+    clr : cooler
+        Cooler object to use to extract Hi-C heatmap data.
+    tilei, tilej : (int, int) tuple
+        Row-wise and column-wise spans of the tile, in bins.
+    max_diag : int
+        Width of the diagonal band to fetch, in bins.
+    field : str
+        Pixel table column to fetch.
+
+    Returns
+    -------
+    tile : numpy.ndarray
+        Dense matrix of the tile.
+
+    """
+    i0, i1 = tilei
+    j0, j1 = tilej
+    # rows that have at least one column within the band:
+    r0 = max(i0, j0 - max_diag + 1)
+    r1 = min(i1, j1)
+    with clr.open('r') as h5:
+        dtype = h5['pixels'][field].dtype
+        tile = np.zeros((i1 - i0, j1 - j0), dtype=dtype)
+        if r0 >= r1:
+            return tile
+        offsets = h5['indexes/bin1_offset'][r0:r1 + 1]
+        lo, hi = offsets[0], offsets[-1]
+        bin2 = h5['pixels/bin2_id'][lo:hi]
+        values = h5['pixels'][field][lo:hi]
+    # size of the arrays read from the file, for profiling:
+    _tile_profile["bytes_fetched"] = _tile_profile.get("bytes_fetched", 0) + \
+        offsets.nbytes + bin2.nbytes + values.nbytes
+    bin1 = np.repeat(np.arange(r0, r1), np.diff(offsets))
+    in_band = ((bin2 >= j0) & (bin2 < j1) &
+               (bin2 - bin1 >= 0) & (bin2 - bin1 < max_diag))
+    tile[bin1[in_band] - i0, bin2[in_band] - j0] = values[in_band]
+    return tile
+
+
+_scoring_context = {}
+
+
+def _expected_fingerprint(cis_exp, exp_v_name):
+    """
+    Hash of the index and of a value column of an expected DataFrame, equal
+    for equal DataFrames, e.g. for the copies unpickled by pool workers.
+
+    """
+    hashed = pd.util.hash_pandas_object(cis_exp[exp_v_name], index=True)
+    return hashlib.sha1(hashed.values.tobytes()).hexdigest()
+
+
+def get_scoring_context(clr, cis_exp, exp_v_name, bal_v_name):
+    """
+    Everything 'score_tile' needs besides the heatmap itself: bin table
+    column arrays, balancing weights and a LazyToeplitz expected for every
+    chromosome.
+
+    The context is cached per process for the latest cooler and expected
+    values, so that a worker prepares it once for all of its tiles and
+    tiles get annotated by integer indexing instead of re-reading the bin
+    table. Expected is compared by value when it is not the same object,
+    e.g. when a worker installs the job of the next step of dot-calling.
+
+    Parameters
+    ----------
+    clr : cooler
+        Cooler object.
+    cis_exp : pandas.DataFrame
+        DataFrame with 1 dimensional expected, indexed with 'chrom' and 'diag'.
+    exp_v_name : str
+        Name of a value column in expected DataFrame
+    bal_v_name : str
+        Name of a value column with balancing weights in a cooler.bins()
+        DataFrame. Typically 'weight'.
+
+    Returns
+    -------
+    context : dict
+        'bin_arrays' (see cooltools.lib.get_bin_arrays), 'weights' and
+        'expected' - a dict of chromosome -> LazyToeplitz.
+
+    """
+    key = (clr.filename, clr.root, exp_v_name, bal_v_name)
+    cached = _scoring_context.get("latest")
+    # cis_exp is kept in the cache to skip hashing
+    # it again when the same object is passed:
+    if cached is not None and cached[0] == key and cached[1] is cis_exp:
+        return cached[3]
+    fingerprint = _expected_fingerprint(cis_exp, exp_v_name)
+    if cached is None or cached[0] != key or cached[2] != fingerprint:
+        bin_arrays = get_bin_arrays(clr)
+        exp_values = cis_exp[exp_v_name]
+        chroms = exp_values.index.get_level_values("chrom").unique()
+        context = {
+            "bin_arrays": bin_arrays,
+            "weights": bin_arrays[bal_v_name],
+            "expected": {chrom: LazyToeplitz(exp_values.loc[chrom].values)
+                            for chrom in chroms},
+        }
+    else:
+        context = cached[3]
+    _scoring_context["latest"] = (key, cis_exp, fingerprint, context)
+    return context
+
+
+# stages of 'score_tile' timed for profiling, in the order they are done:
+PROFILE_STAGES = ['context', 'fetch', 'convolve', 'filter', 'pvals', 'annotate']
+
+# per-process profile of the tile being processed: time spent in every
+# stage of 'score_tile', bytes fetched from the cooler, bytes of dense tiles
+# and pixels scored - collected by 'map_tiles' after every tile:
+_tile_profile = {}
+
+
+def _profile_stage(stage, start):
+    """
+    Add the time since 'start' to a stage of the profile of the tile being
+    processed, and return the current time - the start of the next stage.
+
+    """
+    now = time.time()
+    _tile_profile[stage] = _tile_profile.get(stage, 0.0) + now - start
+    return now
+
+
 def score_tile(tile_cij, clr, cis_exp, exp_v_name, bal_v_name, kernels,
-               nans_tolerated, band_to_cover, balance_factor, verbose):
+               nans_tolerated, band_to_cover, balance_factor, verbose,
+               compute_pvals=True):
     """
     The main working function that given a tile of a heatmap, applies kernels to
     perform convolution to calculate locally-adjusted expected and then
@@ -788,6 +1117,9 @@ def score_tile(tile_cij, clr, cis_exp, exp_v_name, bal_v_name, kernels,
         use None value to disable dynamic-donut criteria calculation.
     verbose : bool
         Enable verbose output.
+    compute_pvals : bool
+        Calculate Poisson p-values of every pixel for every kernel. Not
+        needed for lambda-chunking, that relies on FDR thresholds only.
 
     Returns
     -------
@@ -801,18 +1133,30 @@ def score_tile(tile_cij, clr, cis_exp, exp_v_name, bal_v_name, kernels,
     # unpack tile's coordinates
     chrom, tilei, tilej = tile_cij
     origin = (tilei[0], tilej[0])
-
-    # we have to do it for every tile, because
-    # chrom is not known apriori (maybe move outside):
-    lazy_exp = LazyToeplitz(cis_exp.loc[chrom][exp_v_name].values)
-
-    # RAW observed matrix slice:
-    observed = clr.matrix(balance=False)[slice(*tilei), slice(*tilej)]
+    start = time.time()
+
+    # bin table arrays and expected of every chromosome
+    # are prepared only once per worker:
+    context = get_scoring_context(clr, cis_exp, exp_v_name, bal_v_name)
+    lazy_exp = context["expected"][chrom]
+    start = _profile_stage("context", start)
+
+    # RAW observed matrix slice, only the diagonal band that is reported
+    # and the part of it that kernels of reported pixels reach:
+    if clr.storage_mode == "symmetric-upper":
+        pad = max(max(k.shape) for k in kernels.values()) // 2
+        observed = fetch_band_tile(clr, tilei, tilej, band_to_cover + 2*pad)
+    else:
+        observed = clr.matrix(balance=False)[slice(*tilei), slice(*tilej)]
     # expected as a rectangular tile :
     expected = lazy_exp[slice(*tilei), slice(*tilej)]
     # slice of balance_weight for row-span and column-span :
-    bal_weight_i = clr.bins()[slice(*tilei)][bal_v_name].values
-    bal_weight_j = clr.bins()[slice(*tilej)][bal_v_name].values
+    bal_weight_i = context["weights"][slice(*tilei)]
+    bal_weight_j = context["weights"][slice(*tilej)]
+    start = _profile_stage("fetch", start)
+    # size of the dense tile, see 'fetch_band_tile' for the pixels read:
+    _tile_profile["dense_bytes"] = \
+        _tile_profile.get("dense_bytes", 0) + observed.nbytes
 
     # do the convolutions
     result = get_adjusted_expected_tile_some_nans(
@@ -823,6 +1167,7 @@ def score_tile(tile_cij, clr, cis_exp, exp_v_name, bal_v_name, kernels,
         kernels=kernels,
         balance_factor=balance_factor,
         verbose=verbose)
+    start = _profile_stage("convolve", start)
 
     # Post-processing filters
     # (1) exclude pixels that connect loci further than 'band_to_cover' apart:
@@ -835,17 +1180,24 @@ def score_tile(tile_cij, clr, cis_exp, exp_v_name, bal_v_name, kernels,
     # so, selecting inside band and nNaNs compliant results:
     # ( drop dropping index maybe ??? ) ...
     res_df = result[is_inside_band & does_comply_nans].reset_index(drop=True)
+    _tile_profile["n_pixels"] = _tile_profile.get("n_pixels", 0) + len(res_df)
+    start = _profile_stage("filter", start)
     ########################################################################
     # consider retiring Poisson testing from here, in case we
     # stick with l-chunking or opposite - add histogramming business here(!)
     ########################################################################
     # do Poisson tests:
-    get_pval = lambda la_exp : 1.0 - poisson.cdf(res_df["obs.raw"], la_exp)
-    for k in kernels:
-        res_df["la_exp."+k+".pval"] = get_pval( res_df["la_exp."+k+".value"] )
+    if compute_pvals:
+        for k in kernels:
+            res_df["la_exp."+k+".pval"] = poisson_pvals(
+                res_df["obs.raw"].values, res_df["la_exp."+k+".value"].values)
+    start = _profile_stage("pvals", start)
 
-    # annotate and return
-    return cooler.annotate(res_df.reset_index(drop=True), clr.bins()[:])
+    # annotate by integer indexing into bin table arrays and return
+    res_df = annotate_pixels(res_df.reset_index(drop=True),
+                             context["bin_arrays"])
+    _profile_stage("annotate", start)
+    return res_df
 
 
 def histogram_scored_pixels(scored_df, kernels, ledges, verbose):
@@ -946,6 +1298,159 @@ def histogram_scored_pixels(scored_df, kernels, ledges, verbose):
     return hists
 
 
+class LambdaHistogram(object):
+    """
+    Fixed-shape accumulator of lambda-chunked histograms of observed raw
+    counts, an array-backed alternative to 'histogram_scored_pixels'.
+
+    Counts are kept in an int64 array of shape (n_kernels, n_lambda_bins,
+    n_obs), where n_lambda_bins = len(ledges)-1, and n_obs - the number of
+    observed values - grows geometrically as larger raw counts are
+    encountered.
+    Accumulators are updated in place with scored pixels of every tile,
+    and merged across processes by plain array addition.
+
+    Parameters
+    ----------
+    kernels : iterable of str
+        Names of the kernels.
+    ledges : ndarray
+        An ndarray with bin lambda-edges for groupping loc. adj. expecteds,
+        Left-most bin (-inf, 1], and right-most one (value,+inf].
+    n_obs : int
+        Initial number of observed values (0..n_obs-1) to reserve.
+
+    """
+    def __init__(self, kernels, ledges, n_obs=64):
+        self.kernels = list(kernels)
+        self.ledges = np.asarray(ledges, dtype=np.float64)
+        self.hist = np.zeros((len(self.kernels), len(self.ledges) - 1, n_obs),
+                             dtype=np.int64)
+
+    def _grow(self, n_obs):
+        if n_obs > self.hist.shape[2]:
+            # grow geometrically to keep reallocations rare:
+            size = self.hist.shape[2]
+            while size < n_obs:
+                size *= 2
+            hist = np.zeros(self.hist.shape[:2] + (size,), dtype=np.int64)
+            hist[:, :, :self.hist.shape[2]] = self.hist
+            self.hist = hist
+
+    def update(self, scored_df):
+        """
+        Add scored pixels of a tile to the histograms.
+
+        """
+        obs = scored_df["obs.raw"].values
+        # check if obs.raw is integer of spome kind (temporary):
+        assert np.issubdtype(obs.dtype, np.integer)
+        if len(obs):
+            self._grow(obs.max() + 1)
+        for ki, k in enumerate(self.kernels):
+            la_exp = scored_df["la_exp."+k+".value"].values
+            # lambda-bins are closed on the right: (ledges[i], ledges[i+1]]
+            lbins = np.searchsorted(self.ledges, la_exp, side='left') - 1
+            # values beyond the edges are not histogrammed:
+            good = (lbins >= 0) & (lbins < self.hist.shape[1])
+            np.add.at(self.hist[ki], (lbins[good], obs[good]), 1)
+        return self
+
+    def merge(self, other):
+        """
+        Add histograms of another accumulator in place.
+
+        """
+        if self.kernels != other.kernels or \
+                not np.array_equal(self.ledges, other.ledges):
+            raise ValueError("Histograms must share kernels and lambda-edges.")
+        self._grow(other.hist.shape[2])
+        self.hist[:, :, :other.hist.shape[2]] += other.hist
+        return self
+
+    def to_frames(self):
+        """
+        Histograms in the form returned by 'histogram_scored_pixels': a
+        DataFrame for every kernel-type with observed values as rows and
+        lambda-chunks as columns (IntervalIndex), trimmed to the largest
+        observed value.
+
+        """
+        nonzero = np.flatnonzero(self.hist.any(axis=(0, 1)))
+        n_obs = nonzero[-1] + 1 if len(nonzero) else 0
+        # same lambda-chunk labels as the ones from pd.cut:
+        columns = pd.IntervalIndex(
+            pd.cut(np.empty(0), self.ledges).categories)
+        return {k: pd.DataFrame(self.hist[ki, :, :n_obs].T, columns=columns)
+                    for ki, k in enumerate(self.kernels)}
+
+
+def determine_thresholds(gw_hist, kernels, ledges, fdr):
+    """
+    Determine FDR thresholds on observed raw counts and q-values for every
+    lambda-chunk from genome-wide lambda-chunked histograms, the way it's
+    done in HiCCUPS.
+
+    Parameters
+    ----------
+    gw_hist : dict of pandas.DataFrame
+        Histograms of observed raw counts (rows) for every lambda-chunk
+        (columns), for every kernel-type, as returned by
+        'scoring_and_histogramming_step'.
+    kernels : iterable of str
+        Names of the kernels.
+    ledges : ndarray
+        An ndarray with bin lambda-edges for groupping loc. adj. expecteds.
+    fdr : float
+        False discovery rate to control.
+
+    Returns
+    -------
+    threshold_df : dict of pandas.Series
+        FDR thresholds on observed values for every kernel-type, indexed
+        with lambda-chunks.
+    qvalues : dict of pandas.DataFrame
+        q-values for every observed value (rows) and lambda-chunk (columns)
+        for every kernel-type.
+
+    """
+    threshold_df = {}
+    qvalues = {}
+    for k in kernels:
+        # generate a reverse cumulative histogram for each kernel,
+        #  such that 0th raw contains total # of pixels in each lambda-chunk:
+        rcs_hist = gw_hist[k].iloc[::-1].cumsum(axis=0).iloc[::-1]
+        # now for every kernel-type k - create rcsPoisson,
+        # a unit Poisson distribution for every lambda-chunk
+        # using upper boundary of each lambda-chunk as the expected,
+        # all lambda-chunks at once:
+        # P(X >= obs) is equivalent to the
+        # poisson.pmf(gw_hist[k].index,mu)[::-1].cumsum()[::-1]
+        # i.e., the way unitPoissonPMF is generated in HiCCUPS:
+        mus = ledges[1:len(gw_hist[k].columns)+1]
+        renorm_factors = rcs_hist.iloc[0].values
+        rcs_Poisson = pd.DataFrame(
+            renorm_factors * poisson_survival_table(gw_hist[k].index.values, mus),
+            index=gw_hist[k].index,
+            columns=gw_hist[k].columns)
+        # once we have both RCS hist and the Poisson:
+        # now compare rcs_hist and re-normalized rcs_Poisson
+        # to infer FDR thresolds for every lambda-chunk:
+        fdr_diff = fdr * rcs_hist - rcs_Poisson
+        # determine the threshold by checking the value at which
+        # 'fdr_diff' first turns positive:
+        threshold_df[k] = fdr_diff.where(fdr_diff>0).apply(lambda col: col.first_valid_index())
+        # q-values ...
+        # roughly speaking, qvalues[k] =  rcs_Poisson[k]/rcs_hist[k]
+        # bear in mind some issues with lots of NaNs and Infs after
+        # such a brave operation ...
+        qvalues[k] = rcs_Poisson / rcs_hist
+        # fill NaNs with the "unreachably" high value:
+        very_high_value = len(rcs_hist)
+        threshold_df[k] = threshold_df[k].fillna(very_high_value).astype(np.integer)
+    return threshold_df, qvalues
+
+
 def extract_scored_pixels(scored_df, kernels, thresholds, ledges, verbose):
     """
     An attempt to implement HiCCUPS-like lambda-chunking
@@ -1006,9 +1511,276 @@ def extract_scored_pixels(scored_df, kernels, thresholds, ledges, verbose):
     return scored_df[comply_fdr_list]
 
 
+def estimate_tile_costs(clr, tiles, band_to_cover):
+    """
+    Estimate relative costs of scoring heatmap tiles, from the number of
+    stored pixels in their rows (the 'indexes/bin1_offset' of a cooler, no
+    pixels are read) and from their area within the diagonal band.
+
+    Parameters
+    ----------
+    clr : cooler
+        Cooler object the tiles refer to.
+    tiles : list
+        Tiles as yielded by 'heatmap_tiles_generator_diag'.
+    band_to_cover : int
+        Size of the diagonal band to be covered by the tiles.
+
+    Returns
+    -------
+    costs : ndarray
+        Estimated cost of every tile, in the units of pixels.
+
+    """
+    bin1_offset = clr._load_dset('indexes/bin1_offset')
+    costs = np.zeros(len(tiles), dtype=np.float64)
+    for t, (_, tilei, tilej) in enumerate(tiles):
+        rows = np.arange(*tilei)
+        if not len(rows):
+            continue
+        # number of pixels of every row within the tile and the band:
+        lo = np.maximum(tilej[0], rows)
+        hi = np.minimum(tilej[1], rows + band_to_cover)
+        area = np.clip(hi - lo, 0, None).sum()
+        # average number of stored pixels per row:
+        nnz = bin1_offset[tilei[1]] - bin1_offset[tilei[0]]
+        costs[t] = area * (1.0 + nnz / len(rows))
+    return costs
+
+
+def _timed_job(indexed_tile, job):
+    """
+    Apply a job to a tile, reporting worker's pid, time spent, the time
+    the job is done and the profile of the tile (see 'score_tile').
+
+    """
+    t, tile = indexed_tile
+    _tile_profile.clear()
+    start = time.time()
+    result = job(tile)
+    end = time.time()
+    return t, os.getpid(), end - start, end, dict(_tile_profile), result
+
+
+# jobs of 'map_tiles' installed in a pool worker, by the path of the file
+# they are pickled to, see '_installed_job':
+_worker_jobs = {}
+
+
+def _installed_job(indexed_tile, job_path):
+    """
+    Apply the job pickled to 'job_path' to a tile, see '_timed_job'. The job
+    is unpickled once per worker and kept for the rest of its tiles, so that
+    tasks carry only tiles and the job keeps its state, e.g. the cached
+    scoring context, from one tile to the next.
+
+    """
+    job = _worker_jobs.get(job_path)
+    if job is None:
+        with open(job_path, 'rb') as f:
+            job = mp.reduction.ForkingPickler.loads(f.read())
+        # only the latest job is kept:
+        _worker_jobs.clear()
+        _worker_jobs[job_path] = job
+    return _timed_job(indexed_tile, job)
+
+
+def _profile_record(t, pid, elapsed, end, tile_profile, received=None):
+    """
+    Profile record of a tile consumed by 'map_tiles', with the time the
+    result was 'received' by the main process, now by default.
+
+    """
+    record = dict(index=int(t), worker=pid, time=elapsed)
+    record.update(tile_profile)
+    # pickling and sending the result to the main process:
+    if received is None:
+        received = time.time()
+    record["transfer"] = received - end
+    return record
+
+
+def _tile_records(step, tiles, records):
+    """
+    Profile records of 'map_tiles' labeled by a step and the coordinates
+    of tiles (as yielded by 'heatmap_tiles_generator_diag').
+
+    """
+    labeled = []
+    for record in records:
+        record = dict(record)
+        chrom, tilei, tilej = tiles[record.pop("index")]
+        labeled.append(dict(step=step,
+                            chrom=str(chrom),
+                            bin1_start=int(tilei[0]),
+                            bin1_end=int(tilei[1]),
+                            bin2_start=int(tilej[0]),
+                            bin2_end=int(tilej[1]),
+                            **record))
+    return labeled
+
+
+def profile_summary(profile, n_slowest=10):
+    """
+    Summarize profile records of tiles, as collected by the steps of
+    dot-calling with a 'profile' list.
+
+    Parameters
+    ----------
+    profile : list of dict
+        Profile records, with at least the 'step' and 'time' keys.
+    n_slowest : int
+        Number of the slowest tiles to report.
+
+    Returns
+    -------
+    stages : pandas.DataFrame
+        Number of tiles and total time spent in every stage, per step:
+        time of the jobs, of the stages of 'score_tile' within them and
+        of the 'other' work of the jobs, e.g. histogramming, and
+        'transfer' of the results to the main process.
+    slowest : pandas.DataFrame
+        Records of the slowest tiles.
+
+    """
+    df = pd.DataFrame(profile)
+    columns = ["time"] + [stage for stage in PROFILE_STAGES if stage in df] + \
+              ["transfer"]
+    stages = df.groupby("step", sort=False)[columns].sum()
+    stages.insert(len(columns) - 1, "other",
+                  stages["time"] - stages[columns[1:-1]].sum(axis=1))
+    stages.insert(0, "tiles", df.groupby("step", sort=False).size())
+    slowest = df.nlargest(n_slowest, "time").reset_index(drop=True)
+    return stages, slowest
+
+
+def map_tiles(job, tiles, nproc, verbose, costs=None, max_in_flight=None,
+              pool=None, profile=None):
+    """
+    Apply a job to every tile, serially or in a pool of 'nproc' workers.
+
+    In a pool, tiles are ordered by decreasing estimated cost (e.g. from
+    'estimate_tile_costs') and dispatched to the workers one at a time as
+    they become available, so that no worker is left with a batch of
+    expensive tiles at the end. Results are yielded as they arrive, and at
+    most 'max_in_flight' tiles are dispatched and not yet consumed at any
+    time, so that results of fast workers do not pile up in memory. Per-worker utilization is reported
+    when 'verbose'.
+
+    Parameters
+    ----------
+    job : callable
+        Function of a tile to apply.
+    tiles : list or iterable
+        Tiles to process. Without 'costs', any iterable, consumed as the
+        tiles are dispatched.
+    nproc : int
+        Number of processes, no pool is used for nproc=1.
+    verbose : bool
+        Enable verbose output.
+    costs : array-like, optional
+        Estimated costs of the tiles, by default tiles are processed in
+        the order they are given.
+    max_in_flight : int, optional
+        Maximum number of dispatched tiles whose results were not yet
+        consumed, 2*nproc by default.
+    pool : multiprocess.Pool, optional
+        A pool of 'nproc' workers to use, and leave open, instead of
+        creating one, e.g. to share it between several steps.
+    profile : list, optional
+        A list to append a record to for every tile: its 'index', the
+        'worker' pid, 'time' of the job, the profile of 'score_tile' if
+        it was used, and 'transfer' time: from the end of the job to the
+        arrival of its result in the main process.
+
+    Yields
+    ------
+    (index, result) : tuple
+        Position of a tile in 'tiles' and its result, in the order the
+        results arrive.
+
+    """
+    if nproc <= 1:
+        if verbose:
+            print("fallback to serial implementation.")
+        for t, tile in enumerate(tiles):
+            t, pid, elapsed, end, tile_profile, result = \
+                _timed_job((t, tile), job)
+            if profile is not None:
+                profile.append(
+                    _profile_record(t, pid, elapsed, end, tile_profile))
+            yield t, result
+        return
+
+    if costs is not None:
+        # largest-first, ties in the original order:
+        order = np.argsort(-np.asarray(costs, dtype=np.float64),
+                           kind='stable')
+        indexed_tiles = ((t, tiles[t]) for t in order)
+    else:
+        indexed_tiles = enumerate(tiles)
+    own_pool = pool is None
+    if verbose:
+        print("{} a Pool of {} workers to tackle {} tiles".format(
+                "creating" if own_pool else "using", nproc,
+                len(tiles) if hasattr(tiles, '__len__') else 'all'))
+    if max_in_flight is None:
+        max_in_flight = 2 * nproc
+    if own_pool:
+        pool = mp.Pool(nproc)
+    # the job is pickled once and installed by every worker on its
+    # first tile, tasks carry only the tiles:
+    fd, job_path = tempfile.mkstemp(suffix='.pkl')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(mp.reduction.ForkingPickler.dumps(job))
+    timed_job = partial(_installed_job, job_path=job_path)
+    busy = {}
+    start = time.time()
+    try:
+        # results are consumed in the order they arrive, timestamped on
+        # arrival, and the next tile is dispatched as soon as a result is
+        # consumed, so that a slow tile does not hold back the others:
+        arrived = queue.Queue()
+        def dispatch(indexed_tile):
+            pool.apply_async(
+                timed_job, (indexed_tile,),
+                callback=lambda result: arrived.put((result, time.time())),
+                error_callback=lambda error: arrived.put((error, None)))
+        n_in_flight = 0
+        for indexed_tile in islice(indexed_tiles, max_in_flight):
+            dispatch(indexed_tile)
+            n_in_flight += 1
+        while n_in_flight:
+            result, received = arrived.get()
+            n_in_flight -= 1
+            if received is None:
+                raise result
+            t, pid, elapsed, end, tile_profile, result = result
+            if profile is not None:
+                profile.append(
+                    _profile_record(t, pid, elapsed, end, tile_profile,
+                                    received))
+            indexed_tile = next(indexed_tiles, None)
+            if indexed_tile is not None:
+                dispatch(indexed_tile)
+                n_in_flight += 1
+            n_tiles, busy_time = busy.get(pid, (0, 0.0))
+            busy[pid] = (n_tiles + 1, busy_time + elapsed)
+            yield t, result
+    finally:
+        os.remove(job_path)
+        if own_pool:
+            pool.close()
+    if verbose:
+        wall_time = max(time.time() - start, 1e-9)
+        for pid, (n_tiles, busy_time) in sorted(busy.items()):
+            print("worker {}: {} tiles, busy {:.1f}s ({:.0%} of {:.1f}s)".format(
+                    pid, n_tiles, busy_time, busy_time / wall_time, wall_time))
+
+
 def scoring_step(clr, expected, expected_name, tiles, kernels,
                  max_nans_tolerated, loci_separation_bins, output_path,
-                 nproc, verbose):
+                 nproc, verbose, balance_factor=None, profile=None):
     if verbose:
         print("Preparing to convolve {} tiles:".format(len(tiles)))
 
@@ -1023,40 +1795,173 @@ def scoring_step(clr, expected, expected_name, tiles, kernels,
         kernels=kernels,
         nans_tolerated=max_nans_tolerated,
         band_to_cover=loci_separation_bins,
+        balance_factor=balance_factor,
         verbose=very_verbose)
 
-    if nproc > 1:
-        pool = mp.Pool(nproc)
-        map_ = pool.imap
-        map_kwargs = dict(chunksize=int(np.ceil(len(tiles)/nproc)))
-        if verbose:
-            print("creating a Pool of {} workers to tackle {} tiles".format(
-                    nproc, len(tiles)))
-    else:
-        map_ = map
-        if verbose:
-            print("fallback to serial implementation.")
-        map_kwargs = {}
+    # expensive tiles go first and chunks arrive in any order: they are
+    # sunk as they arrive and copied to 'output_path' in the order of tiles,
+    # one chunk at a time:
+    costs = estimate_tile_costs(clr, tiles, loci_separation_bins)
+    records = [] if profile is not None else None
+    chunks = map_tiles(job, tiles, nproc, verbose, costs=costs,
+                       profile=records)
+    fd, sink_path = tempfile.mkstemp(suffix='.h5',
+                                     dir=op.dirname(op.abspath(output_path)))
+    os.close(fd)
     try:
-        # consider using
-        # https://github.com/mirnylab/cooler/blob/9e72ee202b0ac6f9d93fd2444d6f94c524962769/cooler/tools.py#L59
-        # here:
-        chunks = map_(job, tiles, **map_kwargs)
-        append = False
-        for chunk in chunks:
-            chunk.to_hdf(output_path,
-                         key='results',
-                         format='table',
-                         append=append)
-            append = True
+        runs, template = _sink_chunks(chunks, tiles, sink_path, verbose)
+        if template is not None and not runs:
+            template.to_hdf(output_path, key='results', format='table')
+        with pd.HDFStore(sink_path, 'r') as sink:
+            for i, (_, _, start, stop) in enumerate(sorted(runs)):
+                sink.select('results', start=start, stop=stop).to_hdf(
+                    output_path,
+                    key='results',
+                    format='table',
+                    append=(i > 0))
     finally:
-        if nproc > 1:
-            pool.close()
+        os.remove(sink_path)
+    if profile is not None:
+        profile.extend(_tile_records("scoring", tiles, records))
+
+
+def _spill_tile_path(spill_path, tile):
+    """
+    Path of the file keeping scored pixels of a tile in a spill directory.
+    Tiles are identified by their global bin offsets, which are unique
+    genome-wide.
+
+    """
+    _, tilei, tilej = tile
+    return op.join(spill_path, "tile.{}.{}.h5".format(tilei[0], tilej[0]))
+
+
+def _score_and_spill(tile, to_score, spill_path):
+    """
+    Score a tile and keep the pixels that could ever pass FDR thresholds in
+    the spill directory.
+
+    FDR thresholds on observed counts are always >= 1 (rcs_Poisson is at
+    least fdr*rcs_hist for obs.raw=0), and pixels must exceed them, thus
+    pixels with obs.raw <= 1 are never extracted and are not kept.
+
+    """
+    scored_df = to_score(tile)
+    scored_df[scored_df["obs.raw"] > 1].to_hdf(
+        _spill_tile_path(spill_path, tile),
+        key='results',
+        mode='w',
+        format='table')
+    return scored_df
+
+
+def checkpoint_key(clr, expected_path, kernels, ledges, **params):
+    """
+    Key of a dot-calling run for checkpointing: a hash of the input cooler
+    and expected files (path, size and modification time), of the kernels,
+    lambda-edges and of any other parameters affecting the results, e.g.
+    expected_name, max_nans_tolerated, loci_separation_bins, tile size.
+
+    Runs with the same key produce the same per-tile results, and can
+    reuse each other's checkpoints.
+
+    """
+    sha = hashlib.sha1()
+    for path in [clr.filename, expected_path]:
+        stat = os.stat(path)
+        sha.update("{}:{}:{}".format(
+            op.abspath(path), stat.st_size, stat.st_mtime_ns).encode())
+    sha.update(clr.root.encode())
+    for k in sorted(kernels):
+        kernel = np.ascontiguousarray(kernels[k], dtype=np.float64)
+        sha.update(k.encode())
+        sha.update(str(kernel.shape).encode())
+        sha.update(kernel.tobytes())
+    sha.update(np.asarray(ledges, dtype=np.float64).tobytes())
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return sha.hexdigest()[:16]
+
+
+def _checkpoint_tile_path(checkpoint_path, stage, tile):
+    """
+    Path of the file keeping results of a 'stage' (histogramming or
+    extraction) of a tile in a checkpoint directory.
+
+    """
+    _, tilei, tilej = tile
+    ext = {'hist': 'npy', 'extract': 'pkl'}[stage]
+    return op.join(checkpoint_path,
+                   "{}.{}.{}.{}".format(stage, tilei[0], tilej[0], ext))
+
+
+def _atomic_write(path, write):
+    """
+    Write a file with 'write(file_object)' under a temporary name and
+    rename it, so that a killed run never leaves a partial checkpoint.
+
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _save_hist_checkpoint(hist, path):
+    _atomic_write(path, lambda f: np.save(f, hist.hist))
+
+
+def _load_hist_checkpoint(path, kernels, ledges):
+    hist = LambdaHistogram(kernels, ledges)
+    hist.hist = np.load(path)
+    return hist
+
+
+def _save_pixels_checkpoint(pixels_df, path):
+    _atomic_write(path, lambda f: pixels_df.to_pickle(f, compression=None))
+
+
+def _load_pixels_checkpoint(path):
+    return pd.read_pickle(path, compression=None)
+
+
+def _run_and_checkpoint(tile, job, checkpoint_path, stage, save):
+    """
+    Process a tile and record its result in the checkpoint directory.
+
+    """
+    result = job(tile)
+    save(result, _checkpoint_tile_path(checkpoint_path, stage, tile))
+    return result
+
+
+def _split_checkpointed(tiles, checkpoint_path, stage, verbose,
+                        spill_path=None):
+    """
+    Split tiles into the ones already recorded in 'checkpoint_path' for a
+    'stage' and the ones left to process. With 'spill_path', tiles are
+    done only if they were spilled there as well, e.g. tiles recorded by a
+    run without a spill directory are processed again to be spilled.
+
+    """
+    done, todo = [], []
+    for tile in tiles:
+        if op.exists(_checkpoint_tile_path(checkpoint_path, stage, tile)) and \
+                (spill_path is None or
+                 op.exists(_spill_tile_path(spill_path, tile))):
+            done.append(tile)
+        else:
+            todo.append(tile)
+    if verbose and done:
+        print("resuming {} step: {} of {} tiles are already done".format(
+                stage, len(done), len(tiles)))
+    return done, todo
 
 
 def scoring_and_histogramming_step(clr, expected, expected_name, tiles, kernels,
                                    ledges, max_nans_tolerated, loci_separation_bins,
-                                   output_path, nproc, verbose):
+                                   output_path, nproc, verbose, balance_factor=None,
+                                   spill_path=None, checkpoint_path=None,
+                                   pool=None, profile=None):
     """
     This is a derivative of the 'scoring_step'
     which is supposed to implement the 1st of the
@@ -1065,6 +1970,22 @@ def scoring_and_histogramming_step(clr, expected, expected_name, tiles, kernels,
     Basically we are piping scoring operation
     together with histogramming into a single
     pipeline of per-chunk operations/transforms.
+
+    When 'spill_path' - an existing directory - is provided, the scored
+    pixels of every tile that could pass FDR thresholds are kept there,
+    so that 'extraction_from_spill_step' can extract significant pixels
+    without scoring every tile again. 'balance_factor' should then be
+    the one meant for the extraction.
+
+    When 'checkpoint_path' - an existing directory - is provided, the
+    histogram of every tile is recorded there as soon as the tile is done,
+    and tiles recorded by a previous run are not scored again, unless they
+    are missing from 'spill_path'. The directory must be specific to the
+    inputs, see 'checkpoint_key'.
+
+    An existing 'pool' of 'nproc' workers is used when provided. Records
+    of timings of every scored tile are appended to 'profile' list when
+    provided (see 'map_tiles').
     """
     if verbose:
         print("Preparing to convolve {} tiles:".format(len(tiles)))
@@ -1082,72 +2003,52 @@ def scoring_and_histogramming_step(clr, expected, expected_name, tiles, kernels,
         kernels=kernels,
         nans_tolerated=max_nans_tolerated,
         band_to_cover=loci_separation_bins,
-        # do not calculate dynamic-donut criteria
-        # for now.
-        balance_factor=None,
-        verbose=very_verbose)
+        # dynamic-donut criteria and p-values are
+        # not needed for histogramming:
+        balance_factor=balance_factor,
+        verbose=very_verbose,
+        compute_pvals=(spill_path is not None))
+    if spill_path is not None:
+        to_score = partial(_score_and_spill, to_score=to_score,
+                           spill_path=spill_path)
 
-    # to hist per scored chunk:
-    to_hist = partial(
-        histogram_scored_pixels,
-        kernels=kernels,
-        ledges=ledges,
-        verbose=very_verbose)
+    # to hist per scored chunk, into small
+    # fixed-shape int64 arrays:
+    to_hist = lambda scored_df: \
+        LambdaHistogram(kernels, ledges).update(scored_df)
 
     # composing/piping scoring and histogramming
     # together :
     job = lambda tile : to_hist(to_score(tile))
 
-    # copy paste from @nvictus modified 'scoring_step':
-    if nproc > 1:
-        pool = mp.Pool(nproc)
-        map_ = pool.imap
-        map_kwargs = dict(chunksize=int(np.ceil(len(tiles)/nproc)))
-        if verbose:
-            print("creating a Pool of {} workers to tackle {} tiles".format(
-                    nproc, len(tiles)))
-    else:
-        map_ = map
-        if verbose:
-            print("fallback to serial implementation.")
-        map_kwargs = {}
-    try:
-        # consider using
-        # https://github.com/mirnylab/cooler/blob/9e72ee202b0ac6f9d93fd2444d6f94c524962769/cooler/tools.py#L59
-        # here:
-        hchunks = map_(job, tiles, **map_kwargs)
-        # hchunks TO BE ACCUMULATED
-        # hopefully 'hchunks' would stay in memory
-        # until we would get a chance to accumulate them:
-    finally:
-        if nproc > 1:
-            pool.close()
-    #
-    # now we need to combine/sum all of the histograms
-    # for different kernels:
-    #
-    # assuming we know "kernels"
-    # this is very ugly, but ok
-    # for the draft lambda-chunking
-    # lambda version of lambda-chunking:
-    def _sum_hists(hx,hy):
-        # perform a DataFrame summation
-        # for every value of the dictionary:
-        hxy = {}
-        for k in kernels:
-            hxy[k] = hx[k].add(hy[k],fill_value=0).astype(np.integer)
-        # returning the sum:
-        return hxy
-
-    # ######################################################
-    # this approach is tested and at the very least
-    # number of pixels in a dump list matches
-    # with the .sum().sum() of the histogram
-    # both for 10kb and 5kb,
-    # thus we should consider this as a reference
-    # implementation, albeit not a very efficient one ...
-    # ######################################################
-    final_hist = reduce(_sum_hists, hchunks)
+    # histograms of the tiles done by a previous run:
+    done_tiles = []
+    if checkpoint_path is not None:
+        done_tiles, tiles = _split_checkpointed(
+            tiles, checkpoint_path, 'hist', verbose, spill_path=spill_path)
+        job = partial(_run_and_checkpoint,
+                      job=job,
+                      checkpoint_path=checkpoint_path,
+                      stage='hist',
+                      save=_save_hist_checkpoint)
+
+    # expensive tiles go first:
+    costs = estimate_tile_costs(clr, tiles, loci_separation_bins)
+    records = [] if profile is not None else None
+    hchunks = map_tiles(job, tiles, nproc, verbose, costs=costs, pool=pool,
+                        profile=records)
+    # accumulate per-tile histograms by plain
+    # array addition as they arrive:
+    gw_hist = LambdaHistogram(kernels, ledges)
+    for tile in done_tiles:
+        gw_hist.merge(_load_hist_checkpoint(
+            _checkpoint_tile_path(checkpoint_path, 'hist', tile),
+            kernels, ledges))
+    for _, hchunk in hchunks:
+        gw_hist.merge(hchunk)
+    if profile is not None:
+        profile.extend(_tile_records("histogramming", tiles, records))
+    final_hist = gw_hist.to_frames()
     # we have to make sure there is nothing in the
     # top bin, i.e., there are no l.a. expecteds > base^(len(ledges)-1)
     for k in kernels:
@@ -1164,10 +2065,116 @@ def scoring_and_histogramming_step(clr, expected, expected_name, tiles, kernels,
     return final_hist
 
 
+def _sink_and_sort(chunks, tiles, sink_path, output_path, by, verbose):
+    """
+    Append chunks of pixels to the 'results' table of an HDF5 file at
+    'sink_path' as they arrive, and sort them by 'by' once all chunks are
+    in: one chromosome at a time, so that only pixels of a chromosome are
+    in memory during the sort. Sorted pixels are appended to 'output_path'
+    as the chromosomes are consumed.
+
+    Parameters
+    ----------
+    chunks : iterable
+        (position, pixels) pairs, where position is the position of the
+        tile, the pixels are coming from, in 'tiles'.
+    tiles : list
+        Tiles the pixels are coming from.
+    sink_path : str
+        HDF5 file to use, overwritten. It must be kept until the returned
+        iterator is exhausted.
+    output_path : str or None
+        Text file to write sorted pixels to.
+    by : list of str
+        Columns to sort by, the 1st one must be a chromosome.
+
+    Returns
+    -------
+    pixels : iterator of pandas.DataFrame
+        Sorted pixels of every chromosome, in the order of sorting, as if
+        sorted all at once. An empty frame when there are no pixels.
+
+    """
+    # all chunks are in the sink before this returns:
+    runs, template = _sink_chunks(chunks, tiles, sink_path, verbose)
+    return _sorted_from_sink(sink_path, runs, template, output_path, by)
+
+
+def _sink_chunks(chunks, tiles, sink_path, verbose):
+    """
+    Append chunks of pixels to the 'results' table at 'sink_path', and
+    return (position, chrom, start, stop) of pixels of every tile in the
+    table, along with an empty frame with the columns of the pixels.
+
+    """
+    runs = []
+    template = None
+    with pd.HDFStore(sink_path, 'w') as store:
+        nrows = 0
+        for t, chunk in chunks:
+            if template is None:
+                template = chunk.iloc[:0]
+            if not len(chunk):
+                continue
+            store.append('results', chunk, format='table', index=False)
+            runs.append((t, tiles[t][0], nrows, nrows + len(chunk)))
+            nrows += len(chunk)
+    if verbose:
+        print("{} pixels from {} tiles are in {}".format(
+                nrows, len(runs), sink_path))
+    return runs, template
+
+
+def _sorted_from_sink(sink_path, runs, template, output_path, by):
+    """
+    Yield pixels of every chromosome recorded in 'runs' of the sink,
+    sorted by 'by', see '_sink_and_sort'.
+
+    """
+    if template is None:
+        template = pd.DataFrame(columns=by)
+    # chromosomes in the order of sorting:
+    chroms = {chrom for _, chrom, _, _ in runs}
+    if pd.api.types.is_categorical_dtype(template[by[0]]):
+        chroms = [c for c in template[by[0]].cat.categories if c in chroms]
+    else:
+        chroms = sorted(chroms)
+
+    if not chroms:
+        if output_path is not None:
+            template.to_csv(output_path, sep='\t', header=True, index=False)
+        yield template
+        return
+
+    header = True
+    # rows are numbered genome-wide, as if sorted at once:
+    offset = 0
+    with pd.HDFStore(sink_path, 'r') as store:
+        for chrom in chroms:
+            # the same order of equal keys as with tiles
+            # concatenated in order and sorted at once:
+            chrom_df = pd.concat(
+                [store.select('results', start=start, stop=stop)
+                    for _, c, start, stop in sorted(runs) if c == chrom],
+                ignore_index=True).sort_values(by=by)
+            chrom_df.index = pd.RangeIndex(offset, offset + len(chrom_df))
+            offset += len(chrom_df)
+            if output_path is not None:
+                chrom_df.to_csv(output_path,
+                                sep='\t',
+                                header=header,
+                                index=False,
+                                mode=('w' if header else 'a'),
+                                compression=None)
+                header = False
+            yield chrom_df
+
+
 def scoring_and_extraction_step(clr, expected, expected_name, tiles, kernels,
                                ledges, thresholds, max_nans_tolerated,
                                balance_factor, loci_separation_bins, output_path,
-                               nproc, verbose):
+                               nproc, verbose, checkpoint_path=None,
+                               sink_path=None, pool=None, profile=None):
     """
     This is a derivative of the 'scoring_step'
     which is supposed to implement the 2nd of the
@@ -1177,6 +2184,21 @@ def scoring_and_extraction_step(clr, expected, expected_name, tiles, kernels,
     Basically we are piping scoring operation
     together with extraction into a single
     pipeline of per-chunk operations/transforms.
+
+    When 'checkpoint_path' is provided, pixels extracted from every tile
+    are recorded there, and tiles recorded by a previous run with the
+    same thresholds are not scored again.
+
+    When 'sink_path' is provided, pixels extracted from every tile are
+    appended to an HDF5 table in that file as they arrive, instead of
+    being kept in memory, and an iterator of sorted pixels of every
+    chromosome is returned instead of a single DataFrame (see
+    '_sink_and_sort'). 'output_path' is then written sorted, as the
+    iterator is consumed, and 'sink_path' must be kept until then.
+
+    An existing 'pool' of 'nproc' workers is used when provided. Records
+    of timings of every scored tile are appended to 'profile' list when
+    provided (see 'map_tiles').
     """
     if verbose:
         print("Preparing to convolve {} tiles:".format(len(tiles)))
@@ -1209,44 +2231,105 @@ def scoring_and_extraction_step(clr, expected, expected_name, tiles, kernels,
     # together :
     job = lambda tile : to_extract(to_score(tile))
 
-    # copy paste from @nvictus modified 'scoring_step':
-    if nproc > 1:
-        pool = mp.Pool(nproc)
-        map_ = pool.imap
-        map_kwargs = dict(chunksize=int(np.ceil(len(tiles)/nproc)))
-        if verbose:
-            print("creating a Pool of {} workers to tackle {} tiles".format(
-                    nproc, len(tiles)))
+    # pixels extracted from the tiles done by a previous run:
+    all_tiles, done_tiles = tiles, []
+    if checkpoint_path is not None:
+        done_tiles, tiles = _split_checkpointed(
+            tiles, checkpoint_path, 'extract', verbose)
+        job = partial(_run_and_checkpoint,
+                      job=job,
+                      checkpoint_path=checkpoint_path,
+                      stage='extract',
+                      save=_save_pixels_checkpoint)
+    # positions of the tiles to process among all tiles:
+    done_tiles = set(done_tiles)
+    positions = [t for t, tile in enumerate(all_tiles)
+                    if tile not in done_tiles]
+
+    # expensive tiles go first:
+    costs = estimate_tile_costs(clr, tiles, loci_separation_bins)
+    records = [] if profile is not None else None
+    # (position, pixels) for every tile, as they are done:
+    filtered_pix_chunks = chain(
+        ((t, _load_pixels_checkpoint(
+                _checkpoint_tile_path(checkpoint_path, 'extract', tile)))
+            for t, tile in enumerate(all_tiles) if tile in done_tiles),
+        ((positions[t], chunk) for t, chunk in
+            map_tiles(job, tiles, nproc, verbose, costs=costs, pool=pool,
+                      profile=records)))
+
+    if sink_path is not None:
+        significant_pixels = _sink_and_sort(
+            filtered_pix_chunks, all_tiles, sink_path, output_path,
+            by=["chrom1","chrom2","start1","start2"],
+            verbose=verbose)
     else:
-        map_ = map
-        if verbose:
-            print("fallback to serial implementation.")
-        map_kwargs = {}
-    try:
-        # consider using
-        # https://github.com/mirnylab/cooler/blob/9e72ee202b0ac6f9d93fd2444d6f94c524962769/cooler/tools.py#L59
-        # here:
-        filtered_pix_chunks = map_(job, tiles, **map_kwargs)
-        significant_pixels = pd.concat(filtered_pix_chunks,ignore_index=True)
+        # keeping the order of tiles, as if all were done
+        # in order and none were done before:
+        filtered_pix_chunks = dict(filtered_pix_chunks)
+        significant_pixels = pd.concat(
+            [filtered_pix_chunks[t] for t in range(len(all_tiles))],
+            ignore_index=True)
         if output_path is not None:
             significant_pixels.to_csv(output_path,
                                       sep='\t',
                                       header=True,
                                       index=False,
                                       compression=None)
-    finally:
-        if nproc > 1:
-            pool.close()
-    # # concat and store the results if needed:
-    # significant_pixels = pd.concat(filtered_pix_chunks)
-    return significant_pixels \
+        significant_pixels = significant_pixels \
                 .sort_values(by=["chrom1","chrom2","start1","start2"]) \
                 .reset_index(drop=True)
 
+    if profile is not None:
+        profile.extend(_tile_records("extraction", tiles, records))
+    return significant_pixels
+
+
+
+def extraction_from_spill_step(spill_path, tiles, kernels, ledges, thresholds,
+                               output_path, verbose):
+    """
+    The 2nd step of the lambda-chunking procedure - extracting pixels
+    that are FDR compliant - for the scored pixels kept by
+    'scoring_and_histogramming_step' in 'spill_path'.
+
+    Returns the same as 'scoring_and_extraction_step', without
+    convolving and Poisson-testing any of the tiles again.
+    """
+    if verbose:
+        print("Extracting pixels of {} spilled tiles:".format(len(tiles)))
+
+    filtered_pix_chunks = []
+    for tile in tiles:
+        with pd.HDFStore(_spill_tile_path(spill_path, tile), 'r') as store:
+            # tiles without kept pixels have nothing stored:
+            if 'results' not in store:
+                continue
+            scored_df = store['results']
+        filtered_pix_chunks.append(
+            extract_scored_pixels(scored_df,
+                                  kernels=kernels,
+                                  thresholds=thresholds,
+                                  ledges=ledges,
+                                  verbose=False))
+    if not filtered_pix_chunks:
+        filtered_pix_chunks = [
+            pd.DataFrame(columns=["chrom1","chrom2","start1","start2"])]
+    significant_pixels = pd.concat(filtered_pix_chunks, ignore_index=True)
+    if output_path is not None:
+        significant_pixels.to_csv(output_path,
+                                  sep='\t',
+                                  header=True,
+                                  index=False,
+                                  compression=None)
+    return significant_pixels \
+                .sort_values(by=["chrom1","chrom2","start1","start2"]) \
+                .reset_index(drop=True)
 
 
 def clustering_step_local(scores_df, expected_chroms,
-                          dots_clustering_radius, verbose):
+                          dots_clustering_radius, verbose,
+                          method='birch', nproc=1, pool=None, profile=None):
     """
     This is a new "clustering" step updated for the pixels
     processed by lambda-chunking multiple hypothesis testing.
@@ -1256,19 +2339,34 @@ def clustering_step_local(scores_df, expected_chroms,
     no additional 'comply_fdr' column and selection of compliant
     pixels.
 
-    This step is a clustering-only (using Birch from scikit).
+    This step is a clustering-only (using Birch from scikit by
+    default, or connected components of nearby pixels).
 
     Parameters
     ----------
-    scores_df : pandas.DataFrame
+    scores_df : pandas.DataFrame or iterable of pandas.DataFrame
         DataFrame that stores filtered pixels that are ready to be
-        clustered, no more 'comply_fdr' column dependency.
+        clustered, no more 'comply_fdr' column dependency. Or an
+        iterable of such DataFrames with pixels of a single chromosome
+        each, e.g. as returned by 'scoring_and_extraction_step' with a
+        'sink_path', clustered as they come.
     expected_chroms : iterable
         An iterable of chromosomes to be clustered.
     dots_clustering_radius : int
-        Birch-clustering threshold.
+        Birch-clustering threshold, or the linking distance
+        for the 'connected' method.
     verbose : bool
         Enable verbose output.
+    method : str
+        Clustering backend, one of CLUSTERING_METHODS: 'birch'
+        (default) or 'connected', which scales better with the
+        number of pixels.
+    nproc : int
+        Number of processes to cluster chromosomes in parallel.
+    pool : multiprocess.Pool, optional
+        A pool of 'nproc' workers to use instead of creating one.
+    profile : list, optional
+        A list to append timings of clustering of every chromosome to.
 
     Returns
     -------
@@ -1284,50 +2382,267 @@ def clustering_step_local(scores_df, expected_chroms,
 
     """
 
-    # using different bin12_id_names since all
-    # pixels are annotated at this point.
-    pixel_clust_list = []
-    for chrom  in expected_chroms:
-        # probably generate one big DataFrame with clustering
-        # information only and then just merge it with the
-        # existing 'scores_df'-DataFrame.
-        # should we use groupby instead of 'scores_df['chrom12']==chrom' ?!
-        # to be tested ...
-        df = scores_df[((scores_df['chrom1'].astype(str)==str(chrom)) &
-                        (scores_df['chrom2'].astype(str)==str(chrom)))]
-        if not len(df):
-            continue
+    centroids, _ = _clustering_per_chrom(scores_df, expected_chroms,
+                                         dots_clustering_radius, verbose,
+                                         method, nproc, threshold=False,
+                                         pool=pool, profile=profile)
+    return centroids
 
-        pixel_clust = clust_2D_pixels(
-            df,
-            threshold_cluster=dots_clustering_radius,
-            bin1_id_name='start1',
-            bin2_id_name='start2',
-            verbose=verbose)
-        pixel_clust_list.append(pixel_clust)
-    if verbose:
-        print("Clustering is over!")
-    # concatenate clustering results ...
-    # indexing information persists here ...
-    pixel_clust_df = pd.concat(pixel_clust_list, ignore_index=False)
 
-    # now merge pixel_clust_df and scores_df DataFrame ...
-    # # and merge (index-wise) with the main DataFrame:
+def clustering_and_thresholding_step(scores_df, expected_chroms,
+                                     dots_clustering_radius, verbose,
+                                     method='birch', nproc=1, pool=None,
+                                     profile=None):
+    """
+    'clustering_step_local' followed by 'thresholding_step', both done
+    per chromosome - in a pool of 'nproc' workers if nproc > 1.
+
+    Returns
+    -------
+    centroids : pandas.DataFrame
+        Same as 'clustering_step_local'.
+    out : pandas.DataFrame
+        Same as 'thresholding_step' applied to 'centroids'.
+
+    """
+    return _clustering_per_chrom(scores_df, expected_chroms,
+                                 dots_clustering_radius, verbose,
+                                 method, nproc, threshold=True, pool=pool,
+                                 profile=profile)
+
+
+def _cluster_chrom(df, clust_pixels, dots_clustering_radius, verbose,
+                   threshold):
+    """
+    Cluster pixels of a single chromosome, report centroids with highest
+    Observed and optionally threshold them.
+
+    """
+    # using different bin12_id_names since all
+    # pixels are annotated at this point.
+    pixel_clust = clust_pixels(
+        df,
+        threshold_cluster=dots_clustering_radius,
+        bin1_id_name='start1',
+        bin2_id_name='start2',
+        verbose=verbose)
+    # merge (index-wise) with the pixels:
     df = pd.merge(
-        scores_df,
-        pixel_clust_df,
+        df,
+        pixel_clust,
         how='left',
         left_index=True,
         right_index=True)
 
     # report only centroids with highest Observed:
-    chrom_clust_group = df.groupby(["chrom1", "chrom2", "c_label"])
+    # (observed=True skips empty combinations of categorical chroms)
+    chrom_clust_group = df.groupby(["chrom1", "chrom2", "c_label"],
+                                   observed=True)
     centroids = df.loc[chrom_clust_group["obs.raw"].idxmax()]
-    return centroids
+    out = thresholding_step(centroids) if threshold else None
+    return centroids, out
+
+
+def _clustering_per_chrom(scores_df, expected_chroms, dots_clustering_radius,
+                          verbose, method, nproc, threshold, pool=None,
+                          profile=None):
+    try:
+        clust_pixels = CLUSTERING_METHODS[method]
+    except KeyError:
+        raise ValueError(
+            "Unknown clustering method {}, use one of {}".format(
+                method, list(CLUSTERING_METHODS)))
+
+    job = partial(
+        _cluster_chrom,
+        clust_pixels=clust_pixels,
+        dots_clustering_radius=dots_clustering_radius,
+        verbose=verbose,
+        threshold=threshold)
+    records = [] if profile is not None else None
+    # (chrom, number of pixels) of every clustered chromosome:
+    chrom_sizes = []
+    if isinstance(scores_df, pd.DataFrame):
+        # should we use groupby instead of 'scores_df['chrom12']==chrom' ?!
+        # to be tested ...
+        chrom_dfs = []
+        for chrom in expected_chroms:
+            df = scores_df[((scores_df['chrom1'].astype(str)==str(chrom)) &
+                            (scores_df['chrom2'].astype(str)==str(chrom)))]
+            if len(df):
+                chrom_dfs.append(df)
+                chrom_sizes.append((str(chrom), len(df)))
+        template = scores_df.iloc[:0]
+        # chromosomes with more pixels go first:
+        results = dict(map_tiles(job, chrom_dfs, nproc, verbose,
+                                 costs=[len(df) for df in chrom_dfs],
+                                 pool=pool, profile=records))
+    else:
+        # pixels of one chromosome at a time, dispatched as they come,
+        # so that only a few chromosomes are in memory at once:
+        expected_chroms = {str(chrom) for chrom in expected_chroms}
+        template = None
+        def chrom_dfs_of(chunks):
+            for df in chunks:
+                if len(df):
+                    chrom = str(df['chrom1'].iloc[0])
+                    if chrom in expected_chroms:
+                        chrom_sizes.append((chrom, len(df)))
+                        yield df
+        chunks = iter(scores_df)
+        first = next(chunks, None)
+        if first is not None:
+            template = first.iloc[:0]
+            chunks = chain([first], chunks)
+        results = dict(map_tiles(job, chrom_dfs_of(chunks), nproc, verbose,
+                                 pool=pool, profile=records))
+    results = [results[c] for c in range(len(chrom_sizes))]
+    if verbose:
+        print("Clustering is over!")
+    if profile is not None:
+        for record in records:
+            chrom, n_pixels = chrom_sizes[record.pop("index")]
+            profile.append(dict(step="clustering",
+                                chrom=chrom,
+                                n_pixels=n_pixels,
+                                **record))
+
+    by = ["chrom1", "chrom2", "c_label"]
+    if not results:
+        # no pixels to cluster:
+        empty = pd.DataFrame() if template is None else \
+                    template.assign(cstart1=[], cstart2=[], c_label=[], c_size=[])
+        return empty, (empty.copy() if threshold else None)
+    # chromosome order of a genome-wide groupby, index
+    # of 'scores_df' persists here ...
+    centroids = pd.concat([centroids for centroids, _ in results]) \
+                  .sort_values(by=by)
+    out = None
+    if threshold:
+        out = pd.concat([out for _, out in results]).sort_values(by=by)
+    return centroids, out
+
+
+def _pvals_bin_edges(bins_per_decade):
+    """
+    Edges of logarithmic p-value bins covering [0, 1] down to the smallest
+    double, with separate bins for p-values below that and for p=1.
+
+    """
+    n_decades = 323
+    return np.concatenate(([0.0],
+                           np.logspace(-n_decades, 0,
+                                       num=n_decades*bins_per_decade+1),
+                           [np.inf]))
+
+
+def get_qvals_streaming(scores_file, ktypes, fdr, chunksize=1000000,
+                        bins_per_decade=100, verbose=False):
+    '''
+    Out-of-core version of the genome-wide BH-FDR testing of 'clustering_step':
+    the q-values of 'get_qvals' are computed only for the pixels that comply
+    with 'fdr' for every kernel-type, without loading the scored pixels in
+    memory all at once.
+
+    The 'results' table of 'scores_file' is streamed twice in chunks of
+    'chunksize' pixels. The 1st pass builds logarithmic histograms of
+    p-values, which bound the rank, and thus the q-value, of every pixel.
+    The 2nd pass keeps p-values from the histogram bins that could pass
+    'fdr', ranks them exactly, and keeps the pixels compliant for every
+    kernel-type. Memory scales with the number of such pixels.
+
+    Parameters
+    ----------
+    scores_file : str
+        HDF5 file with the scored pixels in the 'results' table, as
+        written by 'scoring_step'.
+    ktypes : iterable of str
+        Kernel-types to test.
+    fdr : float
+        False discovery rate to control.
+    chunksize : int
+        Number of pixels to read at once.
+    bins_per_decade : int
+        Resolution of the p-value histograms, the finer - the fewer
+        p-values are kept in memory for ranking.
+    verbose : bool
+        Enable verbose output.
+
+    Returns
+    -------
+    res_df : pandas.DataFrame
+        Compliant pixels with 'la_exp.<k>.qval' columns and 'comply_fdr'
+        column, the same as the compliant pixels in 'clustering_step'.
+
+    Notes
+    -----
+    - Ranks of tied p-values are the largest ones, whereas 'get_qvals'
+    ranks ties in an arbitrary order.
+
+    '''
+    ktypes = list(ktypes)
+    edges = _pvals_bin_edges(bins_per_decade)
+    n_bins = len(edges) - 1
+    get_bins = lambda pvals: np.searchsorted(edges, pvals, side='right') - 1
+
+    # 1st pass - histograms of p-values:
+    n_obs = 0
+    hists = {k: np.zeros(n_bins, dtype=np.int64) for k in ktypes}
+    for chunk in pd.read_hdf(scores_file, 'results', chunksize=chunksize):
+        n_obs += len(chunk)
+        for k in ktypes:
+            pvals = chunk["la_exp."+k+".pval"].values
+            # NaN p-values are ranked last and never comply:
+            bins = get_bins(pvals[np.isfinite(pvals)])
+            hists[k] += np.bincount(bins, minlength=n_bins)
+
+    # bins that may have pixels with q-values <= fdr, i.e.
+    # n_obs*p/rank <= fdr for the smallest p-value in the bin
+    # and the largest possible rank:
+    rank_before, candidate_bins = {}, {}
+    for k in ktypes:
+        rank_through = np.cumsum(hists[k])
+        rank_before[k] = rank_through - hists[k]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            candidate_bins[k] = (hists[k] > 0) & \
+                (n_obs * edges[:-1] <= fdr * rank_through)
+
+    # 2nd pass - p-values of candidate bins and candidate pixels:
+    cand_pvals = {k: [] for k in ktypes}
+    cand_chunks = []
+    for chunk in pd.read_hdf(scores_file, 'results', chunksize=chunksize):
+        is_cand = np.ones(len(chunk), dtype=bool)
+        for k in ktypes:
+            pvals = chunk["la_exp."+k+".pval"].values
+            bins = get_bins(pvals)
+            cand = np.isfinite(pvals) & candidate_bins[k][
+                                            np.clip(bins, 0, n_bins-1)]
+            cand_pvals[k].append(pvals[cand])
+            is_cand &= cand
+        cand_chunks.append(chunk[is_cand])
+    res_df = pd.concat(cand_chunks, ignore_index=True)
+
+    # exact ranks of the candidate pixels, all p-values of
+    # their bins are known at this point:
+    res_df['comply_fdr'] = True
+    for k in ktypes:
+        sorted_pvals = np.sort(np.concatenate(cand_pvals[k]))
+        pvals = res_df["la_exp."+k+".pval"].values
+        bins = get_bins(pvals)
+        prank = rank_before[k][bins] + \
+            np.searchsorted(sorted_pvals, pvals, side='right') - \
+            np.searchsorted(sorted_pvals, edges[bins], side='left')
+        res_df["la_exp."+k+".qval"] = np.true_divide(n_obs*pvals, prank)
+        res_df['comply_fdr'] &= (res_df["la_exp."+k+".qval"] <= fdr)
+
+    if verbose:
+        print("{} of {} pixels comply with FDR {}".format(
+                res_df['comply_fdr'].sum(), n_obs, fdr))
+    return res_df[res_df['comply_fdr']].reset_index(drop=True)
 
 
 def clustering_step(scores_file, expected_chroms, ktypes, fdr,
-                    dots_clustering_radius, verbose):
+                    dots_clustering_radius, verbose, chunksize=None):
     """
     This is an old "clustering" step, before lambda-chunking
     was implemented.
@@ -1336,19 +2651,26 @@ def clustering_step(scores_file, expected_chroms, ktypes, fdr,
     a clustering step itself (using Birch from scikit).
     This method also assumes 'scores_file' to be an external
     hdf file, and it would try to read the entire file in
-    memory.
+    memory, unless 'chunksize' is provided - then 'scores_file'
+    is streamed in chunks of that many pixels and only FDR
+    compliant pixels are kept (see 'get_qvals_streaming').
     """
-    res_df = pd.read_hdf(scores_file, 'results')
+    if chunksize is not None:
+        # out-of-core BH-FDR, only compliant pixels are returned:
+        res_df = get_qvals_streaming(scores_file, ktypes, fdr,
+                                     chunksize=chunksize, verbose=verbose)
+    else:
+        res_df = pd.read_hdf(scores_file, 'results')
 
-    # do Benjamin-Hochberg FDR multiple hypothesis tests
-    # genome-wide:
-    for k in ktypes:
-        res_df["la_exp."+k+".qval"] = get_qvals( res_df["la_exp."+k+".pval"] )
+        # do Benjamin-Hochberg FDR multiple hypothesis tests
+        # genome-wide:
+        for k in ktypes:
+            res_df["la_exp."+k+".qval"] = get_qvals( res_df["la_exp."+k+".pval"] )
 
-    # combine results of all tests:
-    res_df['comply_fdr'] = np.all(
-        res_df[["la_exp."+k+".qval" for k in ktypes]] <= fdr,
-        axis=1)
+        # combine results of all tests:
+        res_df['comply_fdr'] = np.all(
+            res_df[["la_exp."+k+".qval" for k in ktypes]] <= fdr,
+            axis=1)
 
     # print a message for timing:
     if verbose:
@@ -1390,7 +2712,9 @@ def clustering_step(scores_file, expected_chroms, ktypes, fdr,
         right_index=True)
 
     # report only centroids with highest Observed:
-    chrom_clust_group = df.groupby(["chrom1", "chrom2", "c_label"])
+    # (observed=True skips empty combinations of categorical chroms)
+    chrom_clust_group = df.groupby(["chrom1", "chrom2", "c_label"],
+                                   observed=True)
     centroids = df.loc[chrom_clust_group["obs.raw"].idxmax()]
     return centroids
 
@@ -1501,3 +2825,57 @@ def thresholding_step(centroids):
         'la_exp.lowleft.qval'
     ]
     return out[columns_for_output]
+
+
+def merge_resolutions(calls, radius=None):
+    """
+    Merge dots called at several resolutions HiCCUPS-style: all dots of
+    the finest resolution are kept, and a dot of a coarser resolution is
+    kept only if there is no kept dot within 'radius' of it.
+
+    Parameters
+    ----------
+    calls : dict
+        Dots called at every resolution (as returned by
+        'thresholding_step'), keyed by resolution in base pairs.
+    radius : int, optional
+        Distance in base pairs between the centers of the pixels of
+        dots, within which a coarser dot duplicates a finer one. Twice
+        the coarser resolution by default.
+
+    Returns
+    -------
+    merged : pandas.DataFrame
+        Kept dots, with the resolution they were called at in the 'res'
+        column, sorted by genomic position.
+
+    """
+    centers = lambda df: np.column_stack([
+        (df["start1"].values + df["end1"].values) / 2,
+        (df["start2"].values + df["end2"].values) / 2])
+
+    merged = []
+    # KD-trees with centers of dots kept so far, per chromosome:
+    trees = {}
+    for res in sorted(calls):
+        df = calls[res].assign(res=res)
+        max_dist = 2 * res if radius is None else radius
+        keep = np.ones(len(df), dtype=bool)
+        chroms = df["chrom1"].astype(str).values
+        for chrom in np.unique(chroms):
+            if chrom not in trees:
+                continue
+            is_chrom = chroms == chrom
+            dist, _ = trees[chrom].query(centers(df[is_chrom]),
+                                         distance_upper_bound=max_dist)
+            keep[is_chrom] = dist > max_dist
+        merged.append(df[keep])
+        # coarser dots are compared against all
+        # finer ones kept so far:
+        kept = pd.concat(merged, ignore_index=True)
+        kept_chroms = kept["chrom1"].astype(str).values
+        trees = {chrom: cKDTree(centers(kept[kept_chroms == chrom]))
+                    for chrom in np.unique(kept_chroms)}
+    return pd.concat(merged, ignore_index=True) \
+             .sort_values(by=["chrom1","chrom2","start1","start2"]) \
+             .reset_index(drop=True)
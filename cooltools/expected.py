@@ -1,4 +1,5 @@
 from itertools import chain, combinations
+import json
 from collections import defaultdict
 from functools import partial
 
@@ -14,7 +15,7 @@ from cooler.tools import split, partition
 from cooler.sandbox.dask import read_table
 import cooler
 import bioframe
-from .lib import assign_supports, numutils
+from .lib import assign_supports, get_bin_arrays, annotate_pixels, numutils
 
 where = np.flatnonzero
 concat = chain.from_iterable
@@ -190,22 +191,14 @@ def count_bad_pixels_per_diag(n, bad_bins):
     ixn = lattice_pdist_frequencies(n, bad_bins)
     dcount[0] = ixn[0]
 
-    # Keep track of out-of-bounds pixels by squeezing left and right bounds
-    # ~O(n)
-    pl = 0
-    pr = k
-    for diag in range(1, n):
-        if pl < k:
-            while (bad_bins[pl] - diag) < 0:
-                pl += 1
-                if pl == k:
-                    break
-        if pr > 0:
-            while (bad_bins[pr-1] + diag) >= n:
-                pr -= 1
-                if pr == 0:
-                    break
-        dcount[diag] = 2*k - ixn[diag] - pl - (k - pr)
+    # Keep track of out-of-bounds pixels: on diagonal d, bad bins to the
+    # left of d run out on the left, bad bins at n-d or further run out on
+    # the right
+    # ~O(n log k)
+    diags = np.arange(1, n)
+    pl = np.searchsorted(bad_bins, diags, side='left')
+    pr = np.searchsorted(bad_bins, n - diags, side='left')
+    dcount[1:] = 2*k - ixn[1:] - pl - (k - pr)
     return dcount
 
 
@@ -234,8 +227,11 @@ def make_diag_table(bad_mask, span1, span2):
     elements ``n_bad`` per diagonal for a single contact area encompassing 
     ``span1`` and ``span2`` on the same genomic scaffold (cis matrix).
 
-    Follows the same principle as the algorithm for finding contact areas for
-    computing scalings.
+    Each diagonal of the rectangular area is a run of pixels (i, i+diag);
+    its bad pixels are counted directly from the sorted bad bin indexes with
+    ``np.searchsorted`` (bad rows plus bad columns), minus the intersection
+    pixels of bad rows with bad columns, obtained for all diagonals at once
+    as a cross-correlation via FFT.
 
     Parameters
     ----------
@@ -248,38 +244,41 @@ def make_diag_table(bad_mask, span1, span2):
     Returns
     -------
     diags : pandas.DataFrame
-        Table indexed by 'diag' with columns ['n_elem', 'n_bad'].
+        Table indexed by 'diag' with column 'n_valid', the number of valid
+        elements on each diagonal that intersects the contact area.
 
     """
-    def _make_diag_table(n_bins, bad_locs):
-        diags = pd.DataFrame(index=pd.Series(np.arange(n_bins), name='diag'))
-        diags['n_elem'] = count_all_pixels_per_diag(n_bins)
-        diags['n_valid'] = (diags['n_elem'] - 
-                            count_bad_pixels_per_diag(n_bins, bad_locs))
-        return diags
-    
-    if span1 == span2:
-        lo, hi = span1
-        diags = _make_diag_table(hi - lo, where(bad_mask[lo:hi]))
-    else:
-        lo1, hi1 = span1
-        lo2, hi2 = span2
-        if lo2 <= lo1:
-            lo1, lo2 = lo2, lo1
-            hi1, hi2 = hi2, hi1
-        diags = (
-            _make_diag_table(hi2 - lo1, where(bad_mask[lo1:hi2]))
-                .subtract(_make_diag_table(lo2 - lo1, where(bad_mask[lo1:lo2])), 
-                          fill_value=0)
-                .subtract(_make_diag_table(hi2 - hi1, where(bad_mask[hi1:hi2])), 
-                          fill_value=0)            
-        )
-        if hi1 < lo2:
-            diags.add(_make_diag_table(lo2 - hi1, where(bad_mask[hi1:lo2])), 
-                      fill_value=0)
-        diags = diags[diags['n_elem'] > 0]
-
-    diags = diags.drop('n_elem', axis=1)
+    lo1, hi1 = span1
+    lo2, hi2 = span2
+    if lo2 <= lo1:
+        lo1, lo2 = lo2, lo1
+        hi1, hi2 = hi2, hi1
+    bad_mask = np.asarray(bad_mask, dtype=bool)
+    bad_bins = where(bad_mask)
+    count_bad = lambda lo, hi: (np.searchsorted(bad_bins, hi) - 
+                                np.searchsorted(bad_bins, lo))
+
+    # rows i and columns j = i + diag of the pixels on each diagonal:
+    diags = np.arange(max(hi2 - lo1, 0))
+    ilo = np.maximum(lo1, lo2 - diags)
+    ihi = np.maximum(np.minimum(hi1, hi2 - diags), ilo)
+    n_elem = ihi - ilo
+    n_bad = count_bad(ilo, ihi) + count_bad(ilo + diags, ihi + diags)
+
+    # bad pixels at the intersection of bad rows and bad columns
+    # were counted twice:
+    rows = bad_mask[lo1:hi1].astype(float)
+    cols = bad_mask[lo2:hi2].astype(float)
+    if rows.any() and cols.any():
+        ixn = np.round(fftconvolve(cols, rows[::-1])).astype(int)
+        k = diags - (lo2 - lo1) + (hi1 - lo1) - 1
+        inside = (k >= 0) & (k < len(ixn))
+        n_bad[inside] -= ixn[k[inside]]
+
+    diags = pd.DataFrame(
+        {'n_valid': n_elem - n_bad},
+        index=pd.Series(diags, name='diag'))
+    diags = diags[n_elem > 0]
     return diags.astype(int)
 
 
@@ -397,11 +396,16 @@ def cis_expected(clr, regions, field='balanced', chunksize=1000000,
     return dtable
 
 
-def trans_expected(clr, chromosomes, chunksize=1000000, use_dask=False):
+def trans_expected(clr, chromosomes, chunksize=1000000, use_dask=False,
+                   map=map):
     """
     Aggregate the signal in intrachromosomal blocks.
     Can be used as abackground for contact frequencies between chromosomes.
 
+    The pixel table is streamed in chunks of ``chunksize`` pixels, each
+    reduced to per-chromosome-pair sums, so memory use does not grow with
+    the size of the pixel table.
+
     Parameters
     ----------
     clr : cooler.Cooler
@@ -409,9 +413,11 @@ def trans_expected(clr, chromosomes, chunksize=1000000, use_dask=False):
     chromosomes : list of str
         List of chromosome names
     chunksize : int, optional
-        Size of dask chunks
+        Size of pixel table chunks to process
     use_dask : bool, optional
-        option to use dask
+        Deprecated, has no effect: pixels are always processed in chunks.
+    map : callable, optional
+        Map functor implementation.
     
     Returns
     -------
@@ -423,75 +429,32 @@ def trans_expected(clr, chromosomes, chunksize=1000000, use_dask=False):
     the actual value of expected for every interchromosomal pair.
 
     """
-    def n_total_trans_elements(clr, chromosomes):
-        n = len(chromosomes)
-        x = [clr.extent(chrom)[1] - clr.extent(chrom)[0] 
-                 for chrom in chromosomes]
-        pairblock_list = []
-        for i in range(n):
-            for j in range(i + 1, n):
-                # appending to the list of tuples
-                pairblock_list.append((chromosomes[i],
-                                       chromosomes[j],
-                                       x[i] * x[j] ))
-        return pd.DataFrame(pairblock_list, 
-            columns=['chrom1', 'chrom2', 'n_total'])
-
-    def n_bad_trans_elements(clr, chromosomes):
-        n = 0
-        # bad bins are ones with
-        # the weight vector being NaN:
-        x = [np.sum(clr.bins()['weight']
-                       .fetch(chrom)
-                       .isnull()
-                       .astype(int)
-                       .values)
-                 for chrom in chromosomes]
-        pairblock_list = []
-        for i in range(len(x)):
-            for j in range(i + 1, len(x)):
-                # appending to the list of tuples
-                pairblock_list.append((chromosomes[i],
-                                       chromosomes[j],
-                                       x[i] * x[j] ))
-        return pd.DataFrame(pairblock_list,
-            columns=['chrom1', 'chrom2', 'n_bad'])
+    # keep pairs of chromosomes in the order of the pixel table:
+    chromosomes = [chrom for chrom in clr.chromnames if chrom in chromosomes]
+    fields = ['balanced']
+    transforms = {
+        'balanced': lambda p: p['count'] * p['weight1'] * p['weight2']
+    }
+    n = len(chromosomes)
+    support_spans = np.array([clr.extent(chrom) for chrom in chromosomes],
+                             dtype=np.int64).reshape(-1, 2)
+    spans = partition(0, len(clr.pixels()), chunksize)
 
-    if use_dask:
-        # pixels = daskify(clr.filename, clr.root + '/pixels', chunksize=chunksize)
-        raise NotImplementedError("To be implemented once dask supports MultiIndex")
-    else:
-        pixels = clr.pixels()[:]
-    # getting pixels that belong to trans-area,
-    # defined by the list of chromosomes:
-    pixels = cooler.annotate(pixels, clr.bins(), replace=False)
-    pixels = pixels[
-        (pixels.chrom1.isin(chromosomes)) &
-        (pixels.chrom2.isin(chromosomes)) &
-        (pixels.chrom1 != pixels.chrom2)
-    ]
-    pixels['balanced'] = pixels['count'] * pixels['weight1'] * pixels['weight2']
-    ntot = n_total_trans_elements(clr, chromosomes).groupby(('chrom1', 'chrom2'))['n_total'].sum()
-    nbad = n_bad_trans_elements(clr, chromosomes).groupby(('chrom1', 'chrom2'))['n_bad'].sum()
-    trans_area = ntot - nbad
-    trans_area.name = 'n_valid'
-    # processing with use_dask=True is different:
-    if use_dask:
-        # trans_sum = pixels.groupby(('chrom1', 'chrom2'))['balanced'].sum().compute()
-        pass
-    else:
-        trans_sum = pixels.groupby(('chrom1', 'chrom2'))['balanced'].sum()
-    # for consistency with the cis_expected function:
-    trans_sum.name = trans_sum.name + '.sum'
-
-    # returning a DataFrame with MultiIndex, that stores
-    # pairs of 'balanced.sum' and 'n_valid' values for each
-    # pair of chromosomes.
-    dtable = pd.merge(
-        trans_sum.to_frame(),
-        trans_area.to_frame(),
-        left_index=True,
-        right_index=True)
+    block_sums = {field + '.sum': np.zeros(n * n) for field in fields}
+    job = partial(_blocksum_symm, clr, fields, transforms, support_spans)
+    for result in map(job, spans):
+        for name in block_sums:
+            block_sums[name] += result[name]
+
+    records = make_block_table(clr, chromosomes)
+    blocks = list(combinations(range(n), 2))
+    dtable = pd.DataFrame(
+        {'balanced.sum': [block_sums['balanced.sum'][i * n + j] for i, j in blocks],
+         'n_valid': [records[chromosomes[i], chromosomes[j]]['n_valid']
+                        for i, j in blocks]},
+        index=pd.MultiIndex.from_tuples(
+            [(chromosomes[i], chromosomes[j]) for i, j in blocks],
+            names=['chrom1', 'chrom2']))
 
     # the actual expected is balanced.sum/n_valid:
     dtable['balanced.avg'] = dtable['balanced.sum'] / dtable['n_valid']
@@ -516,6 +479,8 @@ def make_diag_tables(clr, supports):
 
     where = np.flatnonzero
     diag_tables = {}
+    # supports sharing a chromosome and bin spans share a table:
+    cache = {}
     for region in supports:
         if isinstance(region, str):
             region = bioframe.parse_region(region)
@@ -542,35 +507,216 @@ def make_diag_tables(clr, supports):
         hi1 -= co
         hi2 -= co
         
-        bad_mask = bad_bin_dict[chrom]
-        diag_tables[region] = make_diag_table(bad_mask, [lo1, hi1], [lo2, hi2])
+        key = (chrom, lo1, hi1, lo2, hi2)
+        if key not in cache:
+            bad_mask = bad_bin_dict[chrom]
+            cache[key] = make_diag_table(bad_mask, [lo1, hi1], [lo2, hi2])
+        diag_tables[region] = cache[key].copy()
 
     return diag_tables
 
 
-def _diagsum_symm(clr, fields, transforms, supports, span):
+def make_block_table(clr, supports):
+    """
+    Count the valid pixels in every inter-support rectangular block.
+
+    Parameters
+    ----------
+    clr : cooler.Cooler
+        Cooler object
+    supports : sequence of genomic range tuples
+        Support regions. Blocks for all pairs of support regions are used.
+
+    Returns
+    -------
+    dict of (support1, support2) -> defaultdict with an 'n_valid' entry
+
+    """
+    # bad bins are ones with
+    # the weight vector being NaN:
+    n_bins = [clr.extent(region)[1] - clr.extent(region)[0]
+                  for region in supports]
+    n_bad = [np.sum(clr.bins()['weight']
+                       .fetch(region)
+                       .isnull()
+                       .astype(int)
+                       .values)
+                 for region in supports]
+    records = {}
+    for i, j in combinations(range(len(supports)), 2):
+        records[supports[i], supports[j]] = defaultdict(int)
+        records[supports[i], supports[j]]['n_valid'] = (
+            n_bins[i] * n_bins[j] - n_bad[i] * n_bad[j])
+    return records
+
+
+def make_diag_index(clr, supports):
+    """
+    Lay out the diagonals of a collection of symmetric support regions in a
+    single flat array, so that every (support, diag) pair gets its own slot.
+
+    Parameters
+    ----------
+    clr : cooler.Cooler
+        Cooler object
+    supports : sequence of genomic range tuples
+        Non-overlapping support regions.
+
+    Returns
+    -------
+    spans : 2D array of int
+        Global bin extents ``[lo, hi)`` of each support, in input order.
+    offsets : 1D array of int
+        ``offsets[i]`` is the position of diagonal 0 of support ``i`` in the
+        flat array, ``offsets[-1]`` is the total length of the flat array.
+
+    """
+    spans = np.array([clr.extent(region) for region in supports],
+                     dtype=np.int64).reshape(-1, 2)
+    offsets = np.r_[0, np.cumsum(spans[:, 1] - spans[:, 0])]
+    return spans, offsets
+
+
+def _support_index(bin_ids, spans):
+    """
+    Index of the support that contains each bin, or -1 for bins outside of
+    every support. Supports are given by their global bin ``spans`` and are
+    assumed to not overlap.
+
+    """
+    order = np.argsort(spans[:, 0], kind='mergesort')
+    k = np.searchsorted(spans[order, 0], bin_ids, side='right') - 1
+    inside = (k >= 0)
+    k = order[np.where(inside, k, 0)]
+    inside &= (bin_ids < spans[k, 1])
+    return np.where(inside, k, -1)
+
+
+def _diag_flat_index(bin1, bin2, spans, offsets):
+    """
+    Map upper-triangle pixels to positions in the flat (support, diag)
+    layout produced by :func:`make_diag_index`. Pixels that fall outside of
+    every support block get -1.
+
+    """
+    k = _support_index(bin1, spans)
+    inside = (k >= 0) & (bin2 < spans[k, 1])
+    return np.where(inside, offsets[k] + (bin2 - bin1), -1)
+
+
+def _bincount_fields(flat, values, minlength, moments=()):
+    """
+    Sum pixel values of each field over the positions ``flat`` of a flat
+    layout. Missing values contribute nothing. Optional ``moments`` add
+    'sumsq' (sums of squares) and 'logsum' (sums of logarithms of the
+    positive values, along with their number 'npos').
+
+    """
+    out = {}
+    for field, x in values.items():
+        out[field + '.sum'] = np.bincount(
+            flat, weights=np.nan_to_num(x), minlength=minlength)
+        if 'sumsq' in moments:
+            out[field + '.sumsq'] = np.bincount(
+                flat, weights=np.nan_to_num(x * x), minlength=minlength)
+        if 'logsum' in moments:
+            pos = (np.nan_to_num(x) > 0)
+            out[field + '.logsum'] = np.bincount(
+                flat[pos], weights=np.log(x[pos]), minlength=minlength)
+            out[field + '.npos'] = np.bincount(
+                flat[pos], minlength=minlength).astype(float)
+    return out
+
+
+def _diagsum_symm(clr, fields, transforms, spans, offsets, moments, span):
     lo, hi = span
-    bins = clr.bins()[:]
+    bin_arrays = get_bin_arrays(clr)
     pixels = clr.pixels()[lo:hi]
-    pixels = cooler.annotate(pixels, bins, replace=False)
-    
-    pixels = pixels[pixels['chrom1'] == pixels['chrom2']].copy()
-    pixels['diag'] = pixels['bin2_id'] - pixels['bin1_id']
+
+    flat = _diag_flat_index(
+        pixels['bin1_id'].values, pixels['bin2_id'].values, spans, offsets)
+    pixels = pixels[flat >= 0]
+    flat = flat[flat >= 0]
+    pixels = annotate_pixels(pixels, bin_arrays)
     for field, t in transforms.items():
         pixels[field] = t(pixels)
-    
-    pixels['support'] = assign_supports(pixels, supports, suffix='1')
-    
-    pixel_groups = dict(iter(pixels.groupby('support')))
-    return {int(i): group.groupby('diag')[fields].sum()
-                  for i, group in pixel_groups.items()}
+
+    values = {field: pixels[field].values for field in fields}
+    return _bincount_fields(flat, values, offsets[-1], moments)
+
+
+def _block_flat_index(pixels, values, spans):
+    """
+    Map trans pixels to the flat (support1, support2) layout of an
+    ``n x n`` block array, with ``support1 <= support2``. Cis pixels, pixels
+    outside of the supports and pixels with missing values (skipped like in
+    blocksum_pairwise) get -1.
+
+    """
+    n = len(spans)
+    k1 = _support_index(pixels['bin1_id'].values, spans)
+    k2 = _support_index(pixels['bin2_id'].values, spans)
+    sel = ((pixels['chrom1'] != pixels['chrom2']).values &
+           (k1 >= 0) & (k2 >= 0))
+    for v in values.values():
+        sel &= ~np.isnan(v)
+    return np.where(sel, np.minimum(k1, k2) * n + np.maximum(k1, k2), -1)
+
+
+def _blocksum_symm(clr, fields, transforms, spans, span):
+    lo, hi = span
+    bin_arrays = get_bin_arrays(clr)
+    pixels = clr.pixels()[lo:hi]
+    pixels = annotate_pixels(pixels, bin_arrays)
+    for field, t in transforms.items():
+        pixels[field] = t(pixels)
+
+    values = {field: pixels[field].values for field in fields}
+    flat = _block_flat_index(pixels, values, spans)
+    sel = (flat >= 0)
+    n = len(spans)
+    return _bincount_fields(
+        flat[sel], {field: values[field][sel] for field in fields}, n * n)
+
+
+def _diagsum_blocksum_symm(clr, fields, transforms, spans, offsets, span):
+    lo, hi = span
+    bin_arrays = get_bin_arrays(clr)
+    pixels = clr.pixels()[lo:hi]
+    pixels = annotate_pixels(pixels, bin_arrays)
+    for field, t in transforms.items():
+        pixels[field] = t(pixels)
+
+    bin1 = pixels['bin1_id'].values
+    bin2 = pixels['bin2_id'].values
+    values = {field: pixels[field].values for field in fields}
+
+    # cis pixels within a support go to the diagonal sums:
+    diag_flat = _diag_flat_index(bin1, bin2, spans, offsets)
+    diag_sel = (diag_flat >= 0)
+
+    # trans pixels between supports go to the block sums:
+    n = len(spans)
+    block_flat = _block_flat_index(pixels, values, spans)
+    block_sel = (block_flat >= 0)
+    block_flat = block_flat[block_sel]
+
+    diag_sums = _bincount_fields(
+        diag_flat[diag_sel],
+        {field: values[field][diag_sel] for field in fields},
+        offsets[-1])
+    block_sums = _bincount_fields(
+        block_flat,
+        {field: values[field][block_sel] for field in fields},
+        n * n)
+    return diag_sums, block_sums
 
 
 def _diagsum_asymm(clr, fields, transforms, contact_type, supports1, supports2, span):
     lo, hi = span
-    bins = clr.bins()[:]
+    bin_arrays = get_bin_arrays(clr)
     pixels = clr.pixels()[lo:hi]
-    pixels = cooler.annotate(pixels, bins, replace=False)
+    pixels = annotate_pixels(pixels, bin_arrays)
     
     if contact_type == 'cis':
         pixels = pixels[pixels['chrom1'] == pixels['chrom2']].copy()
@@ -591,9 +737,9 @@ def _diagsum_asymm(clr, fields, transforms, contact_type, supports1, supports2,
 
 def _blocksum_asymm(clr, fields, transforms, supports1, supports2, span):
     lo, hi = span
-    bins = clr.bins()[:]
+    bin_arrays = get_bin_arrays(clr)
     pixels = clr.pixels()[lo:hi]
-    pixels = cooler.annotate(pixels, bins, replace=False)
+    pixels = annotate_pixels(pixels, bin_arrays)
 
     pixels = pixels[pixels['chrom1'] != pixels['chrom2']].copy()
     for field, t in transforms.items():
@@ -603,13 +749,210 @@ def _blocksum_asymm(clr, fields, transforms, supports1, supports2, span):
     pixels['support2'] = assign_supports(pixels, supports2, suffix='2')
     pixels = pixels.dropna()
     
-    pixel_groups = dict(iter(pixels.groupby(('support1', 'support2'))))
+    pixel_groups = dict(iter(pixels.groupby(['support1', 'support2'])))
     return {(int(i), int(j)): group[fields].sum()
                   for (i, j), group in pixel_groups.items()}
 
 
+# higher-order sums of '_bincount_fields', which can't be merged:
+_NON_ADDITIVE_SUFFIXES = ('.sumsq', '.logsum', '.npos')
+
+
+class ExpectedState(object):
+    """
+    Mergeable partial sums from which expected tables are finalized.
+
+    A state holds, for every (support, diag) pair of a cis reduction or for
+    every pair of supports of a trans reduction, the number of valid pixels
+    and the sums of the aggregated fields, laid out in flat arrays. States
+    computed on separate datasets that share a bin table and a bad-bin mask,
+    e.g. individual sequencing lanes, can be merged or subtracted to derive
+    the expected of a combined dataset without rescanning its pixels.
+    Only sums of fields that are additive across the datasets stay exact
+    under merging: raw counts, and transforms that scale counts by factors
+    of the shared bin table, such as balanced counts with a common weight
+    column. Higher-order sums ('.sumsq', '.logsum' and '.npos') are not
+    additive, and states holding them can't be merged or subtracted.
+
+    Parameters
+    ----------
+    contact_type : {'cis', 'trans'}
+        Diagonal ('cis') or block ('trans') layout.
+    supports : list of genomic range tuples
+        Support regions the state was computed for.
+    n_valid : 1D array of int
+        Number of valid pixels per (support, diag) or per block.
+    sums : dict of str -> 1D array
+        Partial sums per (support, diag) or per block, keyed by the name of
+        the output column, e.g. 'count.sum' or 'balanced.sumsq'.
+    n_diags : 1D array of int, optional
+        Number of diagonals of each support. Required for cis states.
+
+    """
+    def __init__(self, contact_type, supports, n_valid, sums, n_diags=None):
+        if contact_type not in ('cis', 'trans'):
+            raise ValueError("contact_type must be 'cis' or 'trans'")
+        self.contact_type = contact_type
+        self.supports = [tuple(s) if not isinstance(s, str) else s
+                            for s in supports]
+        self.n_valid = np.asarray(n_valid, dtype=np.int64)
+        self.sums = {name: np.asarray(x, dtype=float)
+                        for name, x in sums.items()}
+        if contact_type == 'cis':
+            if n_diags is None:
+                raise ValueError("n_diags is required for cis states.")
+            self.n_diags = np.asarray(n_diags, dtype=np.int64)
+        else:
+            self.n_diags = None
+
+    def _check_compatible(self, other):
+        if (self.contact_type != other.contact_type or
+                self.supports != other.supports or
+                list(self.sums) != list(other.sums)):
+            raise ValueError(
+                "States must share contact type, supports and fields.")
+        if not np.array_equal(self.n_valid, other.n_valid):
+            raise ValueError(
+                "States must be computed with the same bad-bin mask.")
+
+    def _combine(self, other, sign):
+        self._check_compatible(other)
+        moments = [name for name in self.sums
+                        if name.endswith(_NON_ADDITIVE_SUFFIXES)]
+        if moments:
+            raise ValueError(
+                "Sums {} are not additive across datasets, use states "
+                "computed without moments.".format(moments))
+        return ExpectedState(
+            self.contact_type,
+            self.supports,
+            self.n_valid,
+            {name: self.sums[name] + sign * other.sums[name]
+                for name in self.sums},
+            self.n_diags)
+
+    def merge(self, other):
+        """
+        Partial sums of the union of two datasets.
+
+        """
+        return self._combine(other, 1)
+
+    def subtract(self, other):
+        """
+        Partial sums of a dataset with a subset of it (``other``) removed.
+
+        """
+        return self._combine(other, -1)
+
+    def finalize(self, ignore_diags=2):
+        """
+        Turn the partial sums into expected tables.
+
+        For every field with accumulated squares, the variance and standard
+        deviation over the valid pixels of each diagonal (including those
+        that are not stored in the pixel table, i.e. zeros) are added as
+        '<field>.var' and '<field>.std'.
+
+        Parameters
+        ----------
+        ignore_diags : int, optional
+            Number of intial diagonals to exclude from statistics. Only used
+            for cis states.
+
+        Returns
+        -------
+        For cis states, dict of support region -> dataframe of diagonal
+        statistics, as returned by :func:`diagsum`. For trans states, dict of
+        support region pair -> (field name -> summary), as returned by
+        :func:`blocksum_pairwise`.
+
+        """
+        if self.contact_type == 'trans':
+            records = {}
+            for k, block in enumerate(combinations(self.supports, 2)):
+                records[block] = defaultdict(int)
+                records[block]['n_valid'] = int(self.n_valid[k])
+                for name in self.sums:
+                    records[block][name] = self.sums[name][k]
+            return records
+
+        offsets = np.r_[0, np.cumsum(self.n_diags)]
+        dtables = {}
+        for i, support in enumerate(self.supports):
+            lo, hi = offsets[i], offsets[i + 1]
+            dt = pd.DataFrame(
+                {'n_valid': self.n_valid[lo:hi]},
+                index=pd.Index(np.arange(hi - lo), name='diag'))
+            for name in self.sums:
+                dt[name] = self.sums[name][lo:hi]
+            for name in self.sums:
+                if name.endswith('.sumsq'):
+                    field = name[:-len('.sumsq')]
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        mean = dt[field + '.sum'] / dt['n_valid']
+                        var = dt[name] / dt['n_valid'] - mean**2
+                    dt[field + '.var'] = var.clip(lower=0)
+                    dt[field + '.std'] = np.sqrt(dt[field + '.var'])
+            if ignore_diags:
+                for name in dt.columns.drop('n_valid'):
+                    dt.iloc[:ignore_diags, dt.columns.get_loc(name)] = np.nan
+            dtables[support] = dt
+        return dtables
+
+    def save(self, path):
+        """
+        Serialize the state into a numpy .npz file.
+
+        """
+        meta = {
+            'contact_type': self.contact_type,
+            'supports': [s if isinstance(s, str) else
+                            [x if isinstance(x, str) else int(x) for x in s]
+                                for s in self.supports],
+            'sums': list(self.sums),
+        }
+        np.savez(
+            path,
+            meta=json.dumps(meta),
+            n_valid=self.n_valid,
+            n_diags=(self.n_diags if self.n_diags is not None
+                        else np.zeros(0, dtype=np.int64)),
+            **{'sums.' + name: self.sums[name] for name in self.sums})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a state serialized with :meth:`save`.
+
+        """
+        with np.load(path) as npz:
+            meta = json.loads(str(npz['meta']))
+            state = cls(
+                meta['contact_type'],
+                meta['supports'],
+                npz['n_valid'],
+                {name: npz['sums.' + name] for name in meta['sums']},
+                npz['n_diags'] if meta['contact_type'] == 'cis' else None)
+        return state
+
+    @classmethod
+    def from_records(cls, records, supports, fields):
+        """
+        Build a trans state from per-block records.
+
+        """
+        blocks = list(combinations(supports, 2))
+        n_valid = [records[block]['n_valid'] for block in blocks]
+        sums = {}
+        for field in fields:
+            agg_name = '{}.sum'.format(field)
+            sums[agg_name] = [records[block][agg_name] for block in blocks]
+        return cls('trans', supports, n_valid, sums)
+
+
 def diagsum(clr, supports, transforms=None, chunksize=10000000, ignore_diags=2, 
-            map=map):
+            map=map, return_state=False, moments=None):
     """
 
     Intra-chromosomal diagonal summary statistics.
@@ -619,7 +962,9 @@ def diagsum(clr, supports, transforms=None, chunksize=10000000, ignore_diags=2,
     clr : cooler.Cooler
         Cooler object
     supports : sequence of genomic range tuples
-        Support regions for intra-chromosomal diagonal summation
+        Support regions for intra-chromosomal diagonal summation. Supports
+        must not overlap; only pixels with both ends inside the same support
+        are aggregated.
     transforms : dict of str -> callable, optional
         Transformations to apply to pixels. The result will be assigned to
         a temporary column with the name given by the key. Callables take
@@ -630,39 +975,167 @@ def diagsum(clr, supports, transforms=None, chunksize=10000000, ignore_diags=2,
         Number of intial diagonals to exclude from statistics
     map : callable, optional
         Map functor implementation.
+    return_state : bool, optional
+        Return the mergeable :class:`ExpectedState` holding the partial sums
+        instead of the finalized tables.
+    moments : sequence of {'sumsq', 'logsum'}, optional
+        Higher-order sums to accumulate per diagonal along with the plain
+        sums. With 'sumsq', the tables get '<field>.sumsq' as well as the
+        '<field>.var' and '<field>.std' of each diagonal, taken over all its
+        valid pixels (including implicit zeros). With 'logsum', they get
+        '<field>.logsum' and '<field>.npos', the sum of logarithms and the
+        number of the positive values, e.g. to derive geometric means.
 
     Returns
     -------
     dict of support region -> dataframe of diagonal statistics
 
     """    
+    moments = _check_moments(moments)
     spans = partition(0, len(clr.pixels()), chunksize)
     fields = ['count'] + list(transforms.keys())
     dtables = make_diag_tables(clr, supports)
-    
-    for dt in dtables.values():
-        for field in fields:
-            agg_name = '{}.sum'.format(field)
-            dt[agg_name] = 0
+    support_spans, offsets = make_diag_index(clr, supports)
 
-    job = partial(_diagsum_symm, clr, fields, transforms, supports)
+    # accumulate all (support, diag) sums in flat arrays and
+    # split them into per-support tables only once at the end:
+    job = partial(_diagsum_symm, clr, fields, transforms, support_spans,
+                  offsets, moments)
     results = map(job, spans)
+    state = _diagsum_state(supports, fields, dtables, offsets, moments, results)
+    if return_state:
+        return state
+    return state.finalize(ignore_diags)
+
+
+def _check_moments(moments):
+    if moments is None:
+        moments = ()
+    unknown = set(moments) - {'sumsq', 'logsum'}
+    if unknown:
+        raise ValueError("Unknown moments: {}".format(sorted(unknown)))
+    return tuple(moments)
+
+
+def _diagsum_state(supports, fields, dtables, offsets, moments, results):
+    """
+    Reduce the flat per-chunk sums of :func:`_diagsum_symm` into a cis
+    :class:`ExpectedState`.
+
+    """
+    sums = None
     for result in results:
-        for i, agg in result.items():
-            support = supports[i]
-            for field in fields:
-                agg_name = '{}.sum'.format(field)
-                dtables[support][agg_name] = \
-                    dtables[support][agg_name].add(agg[field], fill_value=0)
-    
-    if ignore_diags:
-        for dt in dtables.values():
-            for field in fields:
-                agg_name = '{}.sum'.format(field)
-                j =  dt.columns.get_loc(agg_name)
-                dt.iloc[:ignore_diags, j] = np.nan
+        if sums is None:
+            # bincount of an empty chunk is integer-typed:
+            sums = {name: x.astype(float) for name, x in result.items()}
+        else:
+            for name in sums:
+                sums[name] += result[name]
+    if sums is None:
+        sums = _bincount_fields(
+            np.zeros(0, dtype=np.int64),
+            {field: np.zeros(0) for field in fields},
+            offsets[-1], moments)
 
-    return dtables
+    n_valid = np.concatenate(
+        [dtables[support]['n_valid'].values for support in supports])
+    return ExpectedState('cis', supports, n_valid, sums, np.diff(offsets))
+
+
+def _diag_tables_key(clr, supports):
+    """
+    Key under which coolers with identical bin tables and bad-bin masks
+    share their diagonal tables.
+
+    """
+    bins = clr.bins()[:]
+    if 'weight' in bins.columns:
+        bad_mask = bins['weight'].isnull().values
+    else:
+        bad_mask = np.zeros(len(bins), dtype=bool)
+    return (
+        tuple(clr.chromnames),
+        tuple(clr.chromsizes.values),
+        clr.binsize,
+        hash(bins['start'].values.tobytes()),
+        hash(np.packbits(bad_mask).tobytes()),
+        tuple(s if isinstance(s, str) else tuple(s) for s in supports),
+    )
+
+
+def _apply_job(task):
+    job, span = task
+    return job(span)
+
+
+def diagsum_batch(clrs, supports=None, transforms=None, chunksize=10000000,
+                  ignore_diags=2, map=map, moments=None):
+    """
+
+    Intra-chromosomal diagonal summary statistics of several coolers
+    computed on a single map functor.
+
+    Chunk jobs of all coolers are submitted together, so that a process pool
+    stays busy across coolers and only has to be started once. Diagonal
+    tables (numbers of valid pixels) are computed once for all coolers that
+    share a bin table and a bad-bin mask, e.g. replicates balanced together.
+
+    Parameters
+    ----------
+    clrs : sequence of cooler.Cooler
+        Cooler objects, possibly of different resolutions.
+    supports : sequence of genomic range tuples, optional
+        Support regions for intra-chromosomal diagonal summation shared by
+        all coolers. By default, whole chromosomes of each cooler are used.
+    transforms : dict of str -> callable, optional
+        Transformations to apply to pixels, see :func:`diagsum`.
+    chunksize : int, optional
+        Size of pixel table chunks to process
+    ignore_diags : int, optional
+        Number of intial diagonals to exclude from statistics
+    map : callable, optional
+        Map functor implementation.
+    moments : sequence of {'sumsq', 'logsum'}, optional
+        Higher-order sums to accumulate, see :func:`diagsum`.
+
+    Returns
+    -------
+    list of dicts of support region -> dataframe of diagonal statistics,
+    one per cooler, in input order.
+
+    """
+    if transforms is None:
+        transforms = {}
+    moments = _check_moments(moments)
+    fields = ['count'] + list(transforms.keys())
+
+    diag_tables_cache = {}
+    inputs = []
+    tasks = []
+    for clr in clrs:
+        clr_supports = supports
+        if clr_supports is None:
+            clr_supports = [(chrom, 0, clr.chromsizes[chrom])
+                                for chrom in clr.chromnames]
+        key = _diag_tables_key(clr, clr_supports)
+        if key not in diag_tables_cache:
+            diag_tables_cache[key] = make_diag_tables(clr, clr_supports)
+        support_spans, offsets = make_diag_index(clr, clr_supports)
+        job = partial(_diagsum_symm, clr, fields, transforms, support_spans,
+                      offsets, moments)
+        spans = list(partition(0, len(clr.pixels()), chunksize))
+        inputs.append((clr_supports, diag_tables_cache[key], offsets,
+                       len(spans)))
+        tasks.extend((job, span) for span in spans)
+
+    results = iter(map(_apply_job, tasks))
+    out = []
+    for clr_supports, dtables, offsets, n_spans in inputs:
+        state = _diagsum_state(
+            clr_supports, fields, dtables, offsets, moments,
+            (next(results) for _ in range(n_spans)))
+        out.append(state.finalize(ignore_diags))
+    return out
 
 
 def diagsum_asymm(clr, supports1, supports2, contact_type='cis', 
@@ -724,7 +1197,8 @@ def diagsum_asymm(clr, supports1, supports2, contact_type='cis',
     return dtables
 
 
-def blocksum_pairwise(clr, supports, transforms=None, chunksize=1000000, map=map):
+def blocksum_pairwise(clr, supports, transforms=None, chunksize=1000000, map=map,
+                      return_state=False):
     """
     Summary statistics on inter-chromosomal rectangular blocks.
 
@@ -743,48 +1217,21 @@ def blocksum_pairwise(clr, supports, transforms=None, chunksize=1000000, map=map
         Size of pixel table chunks to process
     map : callable, optional
         Map functor implementation.
+    return_state : bool, optional
+        Return the mergeable :class:`ExpectedState` holding the partial sums
+        instead of the finalized records.
 
     Returns
     -------
     dict of support region -> (field name -> summary)
 
     """    
-    def n_total_block_elements(clr, supports):
-        n = len(supports)
-        x = [clr.extent(region)[1] - clr.extent(region)[0] 
-                 for region in supports]
-        blocks = {}
-        for i in range(n):
-            for j in range(i + 1, n):
-                blocks[supports[i], supports[j]] = x[i] * x[j]
-        return blocks
-
-    def n_bad_block_elements(clr, supports):
-        n = 0
-        # bad bins are ones with
-        # the weight vector being NaN:
-        x = [np.sum(clr.bins()['weight']
-                       .fetch(region)
-                       .isnull()
-                       .astype(int)
-                       .values)
-                 for region in supports]
-        blocks = {}
-        for i in range(len(x)):
-            for j in range(i + 1, len(x)):
-                blocks[supports[i], supports[j]] = x[i] * x[j]
-        return blocks
-
     blocks = list(combinations(supports, 2))
     supports1, supports2 = list(zip(*blocks))
     spans = partition(0, len(clr.pixels()), chunksize)
     fields = ['count'] + list(transforms.keys())
 
-    n_tot = n_total_block_elements(clr, supports)
-    n_bad = n_bad_block_elements(clr, supports)
-    records = {(c1, c2): defaultdict(int) for (c1, c2) in blocks}    
-    for c1, c2 in blocks:
-        records[c1, c2]['n_valid'] = n_tot[c1, c2] - n_bad[c1, c2]
+    records = make_block_table(clr, supports)
     
     job = partial(_blocksum_asymm, clr, fields, transforms, supports1, supports2)
     results = map(job, spans)
@@ -792,8 +1239,83 @@ def blocksum_pairwise(clr, supports, transforms=None, chunksize=1000000, map=map
         for (i, j), agg in result.items():
             for field in fields:
                 agg_name = '{}.sum'.format(field)
-                s = np.asscalar(agg[field])
+                s = float(agg[field])
                 if not np.isnan(s):
                     records[supports1[i], supports2[j]][agg_name] += s
-                
+
+    if return_state:
+        return ExpectedState.from_records(records, supports, fields)
     return records
+
+
+def diagsum_and_blocksum(clr, supports, transforms=None, chunksize=10000000,
+                         ignore_diags=2, map=map, return_state=False):
+    """
+    Intra-chromosomal diagonal and inter-chromosomal block summary statistics
+    collected in a single pass over the pixel table.
+
+    Cis pixels are routed into the diagonal sums of their support, trans
+    pixels into the sums of the rectangular block of their pair of supports.
+
+    Parameters
+    ----------
+    clr : cooler.Cooler
+        Cooler object
+    supports : sequence of genomic range tuples
+        Non-overlapping support regions. Diagonals are summed within each
+        support, blocks are summed for all pairs of supports.
+    transforms : dict of str -> callable, optional
+        Transformations to apply to pixels. The result will be assigned to
+        a temporary column with the name given by the key. Callables take
+        one argument: the current chunk of the (annotated) pixel dataframe.
+    chunksize : int, optional
+        Size of pixel table chunks to process
+    ignore_diags : int, optional
+        Number of intial diagonals to exclude from statistics
+    map : callable, optional
+        Map functor implementation.
+    return_state : bool, optional
+        Return a pair of mergeable :class:`ExpectedState` (cis, trans)
+        holding the partial sums instead of the finalized tables.
+
+    Returns
+    -------
+    dtables : dict of support region -> dataframe of diagonal statistics,
+        same as returned by :func:`diagsum`.
+    records : dict of support region pair -> (field name -> summary),
+        same as returned by :func:`blocksum_pairwise`.
+
+    """
+    if transforms is None:
+        transforms = {}
+    spans = partition(0, len(clr.pixels()), chunksize)
+    fields = ['count'] + list(transforms.keys())
+    dtables = make_diag_tables(clr, supports)
+    records = make_block_table(clr, supports)
+    support_spans, offsets = make_diag_index(clr, supports)
+    n = len(supports)
+
+    diag_sums = {field + '.sum': np.zeros(offsets[-1]) for field in fields}
+    block_sums = {field + '.sum': np.zeros(n * n) for field in fields}
+    job = partial(_diagsum_blocksum_symm, clr, fields, transforms,
+                  support_spans, offsets)
+    results = map(job, spans)
+    for diag_result, block_result in results:
+        for name in diag_sums:
+            diag_sums[name] += diag_result[name]
+            block_sums[name] += block_result[name]
+
+    n_valid = np.concatenate(
+        [dtables[support]['n_valid'].values for support in supports])
+    cis_state = ExpectedState('cis', supports, n_valid, diag_sums,
+                              np.diff(offsets))
+    blocks = list(combinations(range(n), 2))
+    trans_state = ExpectedState(
+        'trans',
+        supports,
+        [records[supports[i], supports[j]]['n_valid'] for i, j in blocks],
+        {name: [block_sums[name][i * n + j] for i, j in blocks]
+            for name in block_sums})
+    if return_state:
+        return cis_state, trans_state
+    return cis_state.finalize(ignore_diags), trans_state.finalize()
@@ -1,3 +1,4 @@
+import os.path as op
 import numpy as np
 import pandas as pd
 
@@ -5,6 +6,13 @@ import pandas as pd
 def assign_supports(features, supports, labels=False, suffix=''):
     """
     Assign support regions to a table of genomic intervals.
+
+    A feature is assigned to a support when it overlaps it (a feature ending
+    exactly at the start of a support counts as overlapping); if several
+    supports match, the last one wins. When the supports of every chromosome
+    are disjoint, all features are labeled at once by binary search over the
+    sorted support boundaries, in O(n log k) time; otherwise every support is
+    matched against the whole table in turn.
     
     Parameters
     ----------
@@ -15,9 +23,6 @@ def assign_supports(features, supports, labels=False, suffix=''):
         Support areas
 
     """
-    features = features.copy()
-    supp_col = pd.Series(index=features.index, data=np.nan)
-    
     c = 'chrom' + suffix
     s = 'start' + suffix
     e = 'end' + suffix
@@ -25,7 +30,74 @@ def assign_supports(features, supports, labels=False, suffix=''):
         if col not in features.columns:
             raise ValueError(
                 'Column "{}" not found in features data frame.'.format(col))
-    
+
+    intervals = _index_supports(supports)
+    if intervals is None:
+        supp_col = _assign_supports_loop(features, supports, c, s, e)
+    else:
+        supp_col = _assign_supports_indexed(features, intervals, c, s, e)
+
+    if labels:
+        supp_col = supp_col.map(lambda i: supports[int(i)], na_action='ignore')
+
+    return supp_col
+
+
+def _index_supports(supports):
+    """
+    Sort the intervals of the supports by chromosome. Returns a dict of
+    chrom -> (starts, ends, support indexes), or None if the supports of some
+    chromosome overlap.
+
+    """
+    by_chrom = {}
+    for i, region in enumerate(supports):
+        # single-region or paired-region support:
+        regions = [region] if len(region) == 3 else list(region)
+        for chrom, start, end in regions:
+            end = np.inf if end is None else end
+            by_chrom.setdefault(chrom, []).append((start, end, i))
+
+    intervals = {}
+    for chrom, items in by_chrom.items():
+        items.sort()
+        starts, ends, idx = (np.array(x) for x in zip(*items))
+        if np.any(starts[1:] < ends[:-1]):
+            return None
+        intervals[chrom] = (starts, ends, idx)
+    return intervals
+
+
+def _assign_supports_indexed(features, intervals, c, s, e):
+    supp = np.full(len(features), np.nan)
+    codes, chroms = pd.factorize(features[c])
+    order = np.argsort(codes, kind='mergesort')
+    bounds = np.searchsorted(codes[order], np.arange(len(chroms) + 1))
+    feat_starts = features[s].values
+    feat_ends = features[e].values
+    for code, chrom in enumerate(chroms):
+        if chrom not in intervals:
+            continue
+        starts, ends, idx = intervals[chrom]
+        rows = order[bounds[code]:bounds[code + 1]]
+        # matching supports form a contiguous run [lo, hi) of the sorted
+        # supports: those starting at or before the feature's end and
+        # ending after the feature's start
+        lo = np.searchsorted(ends, feat_starts[rows], side='right')
+        hi = np.searchsorted(starts, feat_ends[rows], side='right')
+        hit = (lo < hi)
+        # the highest support index of each run wins:
+        ix = np.empty(2 * len(rows), dtype=np.intp)
+        ix[0::2] = lo
+        ix[1::2] = np.maximum(hi, lo)
+        if len(ix):
+            best = np.maximum.reduceat(np.append(idx, -1), ix)[0::2]
+            supp[rows[hit]] = best[hit]
+    return pd.Series(index=features.index, data=supp)
+
+
+def _assign_supports_loop(features, supports, c, s, e):
+    supp_col = pd.Series(index=features.index, data=np.nan)
     for i, region in enumerate(supports):
         # single-region support
         if len(region) == 3:
@@ -43,8 +115,80 @@ def assign_supports(features, supports, labels=False, suffix=''):
                 sel2 &= (features[s] < region2[2])
             sel = sel1 | sel2
         supp_col.loc[sel] = i
-    
-    if labels:
-        supp_col = supp_col.map(lambda i: supports[int(i)], na_action='ignore')
-
     return supp_col
+
+
+# per-process cache of bin tables loaded by `get_bin_arrays`,
+# keyed by cooler file, root group and modification time:
+_bin_arrays_cache = {}
+_BIN_ARRAYS_CACHE_SIZE = 4
+
+
+def get_bin_arrays(clr):
+    """
+    Load the bin table of a cooler as a dict of compact column arrays.
+
+    The result is cached per process, so that chunk jobs executed by the
+    same worker read and parse the bin table only once.
+
+    Parameters
+    ----------
+    clr : cooler.Cooler
+        Cooler object
+
+    Returns
+    -------
+    dict of column name -> array
+        'chrom' is a pandas.Categorical, other columns are numpy arrays.
+
+    """
+    key = (clr.filename, clr.root, op.getmtime(clr.filename))
+    if key not in _bin_arrays_cache:
+        bins = clr.bins()[:]
+        arrays = {}
+        for col in bins.columns:
+            if col == 'chrom':
+                arrays[col] = pd.Categorical(bins[col])
+            else:
+                arrays[col] = bins[col].values
+        # evict the oldest entries first:
+        while len(_bin_arrays_cache) >= _BIN_ARRAYS_CACHE_SIZE:
+            _bin_arrays_cache.pop(next(iter(_bin_arrays_cache)))
+        _bin_arrays_cache[key] = arrays
+    return _bin_arrays_cache[key]
+
+
+def annotate_pixels(pixels, bin_arrays, columns=None):
+    """
+    Add bin annotations to a data frame of pixels by integer indexing into
+    the column arrays returned by `get_bin_arrays`. Equivalent to
+    ``cooler.annotate(pixels, bins, replace=False)``.
+
+    Parameters
+    ----------
+    pixels : DataFrame
+        Data frame with columns ``bin1_id`` and ``bin2_id``.
+    bin_arrays : dict of column name -> array
+        Bin table columns, as returned by `get_bin_arrays`.
+    columns : list of str, optional
+        Bin table columns to annotate with. All of them by default.
+
+    Returns
+    -------
+    DataFrame
+
+    """
+    if columns is None:
+        columns = list(bin_arrays.keys())
+    annotations = {}
+    for suffix in ('1', '2'):
+        bin_ids = pixels['bin' + suffix + '_id'].values
+        for col in columns:
+            arr = bin_arrays[col]
+            if isinstance(arr, pd.Categorical):
+                annotations[col + suffix] = pd.Categorical.from_codes(
+                    arr.codes[bin_ids], dtype=arr.dtype)
+            else:
+                annotations[col + suffix] = arr[bin_ids]
+    annotations = pd.DataFrame(annotations, index=pixels.index)
+    return pd.concat([annotations, pixels], axis=1)
@@ -53,6 +53,11 @@ install_requires = [
     'tables'
 ]
 
+extras_require = {
+    # Parquet expected tables:
+    'parquet': ['pyarrow'],
+}
+
 
 extensions = [
     Extension(
@@ -83,6 +88,7 @@ setup(
     include_dirs=[np.get_include()],
 
     install_requires=install_requires,
+    extras_require=extras_require,
     entry_points={
         'console_scripts': [
              'cooltools = cooltools.cli:cli',
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from cooltools.lib import assign_supports
+from cooltools.lib.common import _assign_supports_loop
+
+
+def _random_features(n, seed=0):
+    rng = np.random.RandomState(seed)
+    starts = rng.randint(0, 1000, n) // 10 * 10
+    return pd.DataFrame({
+        'chrom1': rng.choice(['chr1', 'chr2', 'chrX'], n),
+        'start1': starts,
+        'end1': starts + 10 * rng.randint(1, 5, n),
+    })
+
+
+def test_assign_supports_indexed():
+    features = _random_features(2000)
+    for supports in [
+            # whole chromosomes
+            [('chr1', 0, 1000), ('chr2', 0, 1000)],
+            # touching arms, unsorted, open-ended
+            [('chr1', 500, None), ('chr1', 0, 500), ('chr2', 100, 300),
+             ('chr2', 300, 310)],
+            # paired-region supports
+            [(('chr1', 0, 200), ('chr1', 600, 700)),
+             (('chr1', 200, 400), ('chr2', 0, 1000))],
+            # overlapping supports fall back to the loop
+            [('chr1', 0, 600), ('chr1', 400, 1000)],
+        ]:
+        expected = _assign_supports_loop(
+            features, supports, 'chrom1', 'start1', 'end1')
+        for df in [features, features.astype({'chrom1': 'category'})]:
+            result = assign_supports(df, supports, suffix='1')
+            pd.testing.assert_series_equal(result, expected)
+
+    labels = assign_supports(features, [('chr1', 0, 1000)], labels=True,
+                             suffix='1')
+    assert (labels[features['chrom1'] == 'chr1'] == ('chr1', 0, 1000)).all()
+    assert labels[features['chrom1'] != 'chr1'].isnull().all()
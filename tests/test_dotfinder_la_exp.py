@@ -118,3 +118,28 @@ def test_adjusted_expected_tile_some_nans():
 
 
 
+
+
+def test_convolve_kernels():
+    from scipy.ndimage import convolve
+    from cooltools.dotfinder import convolve_kernels, decompose_kernel
+    from cooltools.lib.numutils import get_kernel
+    rng = np.random.RandomState(0)
+    mat = rng.rand(50, 60)
+    nans = (rng.rand(50, 60) < 0.2).astype(int)
+    # HiCCUPS kernels decompose into rectangles,
+    # arbitrary ones fall back to FFT convolution:
+    kernels = [get_kernel(w, p, ktype) for w, p in [(3, 1), (5, 2)]
+               for ktype in ['donut', 'vertical', 'horizontal', 'lowleft']]
+    assert all(decompose_kernel(k) is not None for k in kernels)
+    kernels += [rng.rand(5, 5), rng.randint(0, 3, (7, 3))]
+    assert decompose_kernel(kernels[-2]) is None
+
+    res = convolve_kernels(mat, kernels)
+    res_nans = convolve_kernels(nans, [(k != 0).astype(int) for k in kernels],
+                                cval=1)
+    for i, k in enumerate(kernels):
+        assert np.allclose(res[i], convolve(mat, k, mode='constant', cval=0.0))
+        assert np.array_equal(
+            res_nans[i],
+            convolve(nans, (k != 0).astype(int), mode='constant', cval=1))
@@ -0,0 +1,601 @@
+# tests for the genome-wide steps of dot-calling
+# on a small synthetic Hi-C map with planted dots ...
+
+import os
+import os.path as op
+import subprocess
+import time
+
+import pytest
+import numpy as np
+import pandas as pd
+import cooler
+from scipy.stats import poisson
+
+from cooltools import dotfinder, expected as cooltools_expected
+
+
+binsize = 10000
+chromsizes = pd.Series({'chr1': 3000000, 'chr2': 2500000})
+# positions of planted dots (in bins) for every chromosome:
+dots = {'chr1': [(50, 80), (120, 160), (200, 215)],
+        'chr2': [(30, 60), (100, 140)]}
+
+
+def make_dots_cooler(tmpdir):
+    rng = np.random.RandomState(7)
+    bins = cooler.binnify(chromsizes, binsize)
+    pixels = []
+    offset = 0
+    for chrom, size in chromsizes.items():
+        n = int(np.ceil(size / binsize))
+        i, j = np.triu_indices(n)
+        lam = 400.0 / (1 + j - i)
+        for di, dj in dots[chrom]:
+            lam[(np.abs(i - di) <= 1) & (np.abs(j - dj) <= 1)] *= 6
+        counts = rng.poisson(lam)
+        sel = counts > 0
+        pixels.append(pd.DataFrame({'bin1_id': i[sel] + offset,
+                                    'bin2_id': j[sel] + offset,
+                                    'count': counts[sel]}))
+        offset += n
+    uri = op.join(str(tmpdir), 'dots.cool')
+    cooler.create_cooler(uri, bins, pd.concat(pixels, ignore_index=True))
+    clr = cooler.Cooler(uri)
+    bias, _ = cooler.balance_cooler(clr, ignore_diags=1, store=True)
+    return cooler.Cooler(uri)
+
+
+def make_inputs(clr):
+    supports = [(chrom, 0, clr.chromsizes[chrom]) for chrom in clr.chromnames]
+    tables = cooltools_expected.diagsum(
+        clr,
+        supports,
+        transforms={
+            'balanced': lambda p: p['count'] * p['weight1'] * p['weight2']})
+    expected = pd.concat(
+        [tables[support] for support in supports],
+        keys=[support[0] for support in supports],
+        names=['chrom'])
+    expected['balanced.avg'] = expected['balanced.sum'] / expected['n_valid']
+
+    w, p = 3, 1
+    kernels = {k: dotfinder.get_kernel(w, p, k)
+                  for k in ['donut', 'vertical', 'horizontal', 'lowleft']}
+    nlchunks = dotfinder.HiCCUPS_W1_MAX_INDX
+    ledges = np.concatenate(([-np.inf],
+                             np.logspace(0, nlchunks - 1, num=nlchunks,
+                                         base=2**(1 / 3.0)),
+                             [np.inf]))
+    loci_separation_bins = 100
+    tiles = list(dotfinder.heatmap_tiles_generator_diag(
+        clr, clr.chromnames, w, 120, loci_separation_bins))
+    return expected, kernels, ledges, tiles, loci_separation_bins
+
+
+def get_thresholds(gw_hist, ledges, fdr=0.1):
+    thresholds = {}
+    for k, hist in gw_hist.items():
+        rcs_hist = hist.iloc[::-1].cumsum(axis=0).iloc[::-1]
+        rcs_poisson = pd.DataFrame()
+        for mu, column in zip(ledges[1:-1], hist.columns):
+            rcs_poisson[column] = (rcs_hist.loc[0, column] *
+                                   poisson.sf(hist.index - 1, mu))
+        fdr_diff = fdr * rcs_hist - rcs_poisson
+        thresholds[k] = fdr_diff.where(fdr_diff > 0) \
+            .apply(lambda col: col.first_valid_index()) \
+            .fillna(len(rcs_hist)).astype(np.int64)
+    return thresholds
+
+
+# the map, the inputs and the results of the serial steps of dot-calling
+# are shared by the tests of this module, and must not be modified:
+@pytest.fixture(scope='module')
+def clr(tmpdir_factory):
+    return make_dots_cooler(tmpdir_factory.mktemp('dots'))
+
+
+@pytest.fixture(scope='module')
+def inputs(clr):
+    return make_inputs(clr)
+
+
+@pytest.fixture(scope='module')
+def gw_hist(clr, inputs):
+    expected, kernels, ledges, tiles, band = inputs
+    return dotfinder.scoring_and_histogramming_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, 1, band,
+        None, 1, False)
+
+
+@pytest.fixture(scope='module')
+def extracted(clr, inputs, gw_hist):
+    expected, kernels, ledges, tiles, band = inputs
+    thresholds, _ = dotfinder.determine_thresholds(
+        gw_hist, kernels, ledges, 0.1)
+    pixels = dotfinder.scoring_and_extraction_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, thresholds,
+        1, 1.0, band, None, 1, False)
+    return thresholds, pixels
+
+
+def test_extraction_from_spill(tmpdir, clr, inputs, gw_hist, extracted):
+    expected, kernels, ledges, tiles, band = inputs
+    spill_path = tmpdir.mkdir('spill')
+    gw_hist_spill = dotfinder.scoring_and_histogramming_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, 1, band,
+        None, 1, False, balance_factor=1.0, spill_path=str(spill_path))
+    for k in kernels:
+        pd.testing.assert_frame_equal(gw_hist_spill[k], gw_hist[k])
+    assert len(spill_path.listdir()) == len(tiles)
+
+    thresholds, ref = extracted
+    res = dotfinder.extraction_from_spill_step(
+        str(spill_path), tiles, kernels, ledges, thresholds, None, False)
+    assert len(ref) > 0
+    pd.testing.assert_frame_equal(res, ref)
+
+
+def test_scoring_context(clr, inputs):
+    expected, kernels, ledges, tiles, band = inputs
+    context = dotfinder.get_scoring_context(
+        clr, expected, 'balanced.avg', 'weight')
+    # prepared once for the same cooler and expected:
+    assert context is dotfinder.get_scoring_context(
+        clr, expected, 'balanced.avg', 'weight')
+    assert np.array_equal(context['weights'], clr.bins()['weight'][:].values,
+                          equal_nan=True)
+
+    scored = dotfinder.score_tile(
+        tiles[0], clr, expected, 'balanced.avg', 'weight', kernels, 1, band,
+        None, False)
+    ref = cooler.annotate(scored[['bin1_id', 'bin2_id']], clr.bins()[:])
+    pd.testing.assert_frame_equal(scored[ref.columns], ref)
+
+
+def test_scoring_context_in_pool(tmpdir, monkeypatch, clr, inputs):
+    expected, kernels, ledges, tiles, band = inputs
+    # every context build is logged to a file, shared by forked workers:
+    log_path = op.join(str(tmpdir), 'builds.log')
+    get_bin_arrays = dotfinder.get_bin_arrays
+    def logged_get_bin_arrays(clr):
+        with open(log_path, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+        return get_bin_arrays(clr)
+    monkeypatch.setattr(dotfinder, 'get_bin_arrays', logged_get_bin_arrays)
+    monkeypatch.setattr(dotfinder, '_scoring_context', {})
+    # so is every hashing of expected:
+    hash_log_path = op.join(str(tmpdir), 'hashes.log')
+    fingerprint = dotfinder._expected_fingerprint
+    def logged_fingerprint(cis_exp, exp_v_name):
+        with open(hash_log_path, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+        return fingerprint(cis_exp, exp_v_name)
+    monkeypatch.setattr(dotfinder, '_expected_fingerprint', logged_fingerprint)
+
+    nproc = 2
+    dotfinder.scoring_and_histogramming_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, 1, band,
+        None, nproc, False)
+    assert len(tiles) > nproc
+    # at most once per worker, as the job is installed once per worker:
+    for path in [log_path, hash_log_path]:
+        with open(path) as f:
+            pids = f.read().split()
+        assert len(pids) == len(set(pids)) <= nproc
+
+
+def test_fetch_band_tile(clr):
+    max_diag = 30
+    for tilei, tilej in [((0, 100), (0, 100)), ((50, 120), (90, 180)),
+                         ((0, 50), (200, 300)), ((300, 400), (290, 400))]:
+        tile = dotfinder.fetch_band_tile(clr, tilei, tilej, max_diag)
+        dense = clr.matrix(balance=False)[slice(*tilei), slice(*tilej)]
+        i, j = np.indices(dense.shape)
+        diag = (j + tilej[0]) - (i + tilei[0])
+        in_band = (diag >= 0) & (diag < max_diag)
+        assert tile.dtype == dense.dtype
+        assert np.array_equal(tile[in_band], dense[in_band])
+        assert not tile[~in_band].any()
+
+
+def test_lambda_histogram(clr, inputs):
+    expected, kernels, ledges, tiles, band = inputs
+    scored = [dotfinder.score_tile(tile, clr, expected, 'balanced.avg',
+                                   'weight', kernels, 1, band, None, False)
+                for tile in tiles[:3]]
+
+    # a small initial size to exercise growing:
+    hists = [dotfinder.LambdaHistogram(kernels, ledges, n_obs=2).update(df)
+                for df in scored]
+    merged = dotfinder.LambdaHistogram(kernels, ledges)
+    for hist in hists:
+        merged.merge(hist)
+    ref = dotfinder.histogram_scored_pixels(
+        pd.concat(scored, ignore_index=True), kernels, ledges, False)
+    for k, df in merged.to_frames().items():
+        pd.testing.assert_frame_equal(df, ref[k], check_names=False)
+
+
+def test_poisson_tables(inputs, gw_hist):
+    rng = np.random.RandomState(0)
+    obs = rng.poisson(5, 1000)
+    la_exp = rng.rand(1000) * 10
+    assert np.allclose(dotfinder.poisson_pvals(obs, la_exp),
+                       1.0 - poisson.cdf(obs, la_exp))
+    mus = np.logspace(0, 10, 11, base=2)
+    table = dotfinder.poisson_survival_table(np.arange(50), mus)
+    for b, mu in enumerate(mus):
+        assert np.allclose(table[:, b],
+                           poisson.sf(np.arange(50) - 1, mu))
+
+    expected, kernels, ledges, tiles, band = inputs
+    thresholds, qvalues = dotfinder.determine_thresholds(
+        gw_hist, kernels, ledges, 0.1)
+    ref = get_thresholds(gw_hist, ledges, 0.1)
+    for k in kernels:
+        pd.testing.assert_series_equal(thresholds[k], ref[k])
+
+
+def test_clust_2D_pixels_connected():
+    rng = np.random.RandomState(1)
+    # well separated blobs of pixels, blobs are chains with step <= 2:
+    centers = [(100, 200), (150, 400), (160, 420), (900, 1000)]
+    pixels = pd.DataFrame(
+        np.concatenate([c + rng.randint(-2, 3, size=(20, 2))
+                           for c in centers]),
+        columns=['bin1_id', 'bin2_id'],
+        index=np.arange(80) * 3)
+    pixels = pixels.drop_duplicates()
+
+    res = dotfinder.clust_2D_pixels_connected(pixels, threshold_cluster=5,
+                                              verbose=False)
+    assert list(res.columns) == ['cbin1_id', 'cbin2_id', 'c_label', 'c_size']
+    assert res.index.equals(pixels.index)
+    assert res['c_label'].nunique() == len(centers)
+    ref = dotfinder.clust_2D_pixels(pixels, threshold_cluster=5,
+                                    verbose=False)
+    # same partition of pixels as Birch on well separated clusters:
+    assert (pd.crosstab(res['c_label'], ref['c_label']) > 0).sum().eq(1).all()
+    for label, grp in pixels.groupby(res['c_label']):
+        clust = res.loc[grp.index]
+        assert (clust['c_size'] == len(grp)).all()
+        assert np.allclose(clust['cbin1_id'], grp['bin1_id'].mean())
+        assert np.allclose(clust['cbin2_id'], grp['bin2_id'].mean())
+
+
+def test_clustering_step_local(clr, extracted):
+    _, pixels = extracted
+
+    centroids = {
+        method: dotfinder.clustering_step_local(
+            pixels, clr.chromnames, 3 * binsize, False, method=method)
+        for method in dotfinder.CLUSTERING_METHODS}
+    for method, df in centroids.items():
+        assert df['c_label'].notnull().all()
+        # every planted dot is reported:
+        for chrom, chrom_dots in dots.items():
+            called = df[df['chrom1'] == chrom]
+            for di, dj in chrom_dots:
+                assert ((np.abs(called['start1'] // binsize - di) <= 1) &
+                        (np.abs(called['start2'] // binsize - dj) <= 1)).any()
+
+
+def test_checkpointed_steps(tmpdir, clr, inputs, gw_hist, extracted):
+    expected, kernels, ledges, tiles, band = inputs
+    expected_path = op.join(str(tmpdir), 'expected.tsv')
+    expected.to_csv(expected_path, sep='\t')
+
+    key = dotfinder.checkpoint_key(clr, expected_path, kernels, ledges,
+                                   fdr=0.1)
+    assert key == dotfinder.checkpoint_key(clr, expected_path, kernels,
+                                           ledges, fdr=0.1)
+    assert key != dotfinder.checkpoint_key(clr, expected_path, kernels,
+                                           ledges, fdr=0.2)
+
+    checkpoint_path = tmpdir.mkdir('checkpoint')
+    gw_hist_ck = dotfinder.scoring_and_histogramming_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, 1, band,
+        None, 1, False, checkpoint_path=str(checkpoint_path))
+    assert len(checkpoint_path.listdir()) == len(tiles)
+    thresholds, ref = extracted
+    res = dotfinder.scoring_and_extraction_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, thresholds,
+        1, 1.0, band, None, 1, False, checkpoint_path=str(checkpoint_path))
+    assert len(checkpoint_path.listdir()) == 2 * len(tiles)
+
+    # resume after a part of the tiles were lost:
+    for path in sorted(checkpoint_path.listdir())[::3]:
+        path.remove()
+    gw_hist_resumed = dotfinder.scoring_and_histogramming_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, 1, band,
+        None, 1, False, checkpoint_path=str(checkpoint_path))
+    res_resumed = dotfinder.scoring_and_extraction_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, thresholds,
+        1, 1.0, band, None, 1, False, checkpoint_path=str(checkpoint_path))
+    for k in kernels:
+        pd.testing.assert_frame_equal(gw_hist_ck[k], gw_hist[k])
+        pd.testing.assert_frame_equal(gw_hist_resumed[k], gw_hist[k])
+    pd.testing.assert_frame_equal(res, ref)
+    pd.testing.assert_frame_equal(res_resumed, ref)
+
+    # resumed with a spill directory, after a run without one:
+    spill_path = tmpdir.mkdir('spill')
+    gw_hist_spill = dotfinder.scoring_and_histogramming_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, 1, band,
+        None, 1, False, balance_factor=1.0, spill_path=str(spill_path),
+        checkpoint_path=str(checkpoint_path))
+    assert len(spill_path.listdir()) == len(tiles)
+    for k in kernels:
+        pd.testing.assert_frame_equal(gw_hist_spill[k], gw_hist[k])
+    res_spill = dotfinder.extraction_from_spill_step(
+        str(spill_path), tiles, kernels, ledges, thresholds, None, False)
+    pd.testing.assert_frame_equal(res_spill, ref)
+
+
+def test_map_tiles(clr, inputs):
+    expected, kernels, ledges, tiles, band = inputs
+    costs = dotfinder.estimate_tile_costs(clr, tiles, band)
+    assert costs.shape == (len(tiles),)
+    assert (costs > 0).all()
+    # the last tile of chr1 is a small one at its end:
+    assert tiles[4][2][1] == clr.extent('chr1')[1]
+    assert costs[4] < costs[:4].min()
+
+    job = lambda tile: tile[1][0]
+    ref = [job(tile) for tile in tiles]
+    for nproc in [1, 2]:
+        res = list(dotfinder.map_tiles(job, tiles, nproc, False,
+                                       costs=costs))
+        assert sorted(t for t, _ in res) == list(range(len(tiles)))
+        assert all(ref[t] == result for t, result in res)
+    # dispatched largest-first in a pool, one at a time:
+    order = [t for t, _ in dotfinder.map_tiles(job, tiles, 2, False,
+                                               costs=costs, max_in_flight=1)]
+    assert np.all(np.diff(costs[order]) <= 0)
+    # results are consumed as they arrive, a slow tile holds back no other:
+    def slow_first(tile):
+        if tile == tiles[0]:
+            time.sleep(2)
+        return tile[1][0]
+    order = [t for t, _ in dotfinder.map_tiles(slow_first, tiles, 2, False)]
+    assert order[-1] == 0
+
+
+def test_get_qvals_streaming(tmpdir, clr, inputs):
+    expected, kernels, ledges, tiles, band = inputs
+    scores_file = op.join(str(tmpdir), 'scores.h5')
+    dotfinder.scoring_step(clr, expected, 'balanced.avg', tiles, kernels,
+                           1, band, scores_file, 1, False)
+    ktypes = list(kernels)
+    fdr = 0.1
+
+    ref = pd.read_hdf(scores_file, 'results')
+    # stored in the order of tiles, whatever the order they arrive in:
+    scores_file_pool = op.join(str(tmpdir), 'scores_pool.h5')
+    dotfinder.scoring_step(clr, expected, 'balanced.avg', tiles, kernels,
+                           1, band, scores_file_pool, 2, False)
+    pd.testing.assert_frame_equal(pd.read_hdf(scores_file_pool, 'results'),
+                                  ref)
+    for k in ktypes:
+        ref["la_exp."+k+".qval"] = dotfinder.get_qvals(
+            ref["la_exp."+k+".pval"])
+    ref = ref[np.all(ref[["la_exp."+k+".qval" for k in ktypes]] <= fdr,
+                     axis=1)].reset_index(drop=True)
+    assert len(ref) > 0
+    # chunks much smaller than the table:
+    res = dotfinder.get_qvals_streaming(scores_file, ktypes, fdr,
+                                        chunksize=5000)
+    pd.testing.assert_frame_equal(res[ref.columns], ref)
+    assert res['comply_fdr'].all()
+
+    centroids = dotfinder.clustering_step(scores_file, clr.chromnames,
+                                          ktypes, fdr, 3 * binsize, False)
+    centroids_streamed = dotfinder.clustering_step(
+        scores_file, clr.chromnames, ktypes, fdr, 3 * binsize, False,
+        chunksize=5000)
+    pd.testing.assert_frame_equal(
+        centroids_streamed.reset_index(drop=True)[centroids.columns],
+        centroids.reset_index(drop=True))
+
+
+def test_clustering_and_thresholding_step(clr, inputs, extracted):
+    expected, kernels, ledges, tiles, band = inputs
+    _, pixels = extracted
+    # stand-ins for the q-values used in thresholding:
+    pixels = pixels.assign(**{"la_exp."+k+".qval": pixels["la_exp."+k+".pval"]
+                              for k in kernels})
+    radius = 3 * binsize
+
+    # genome-wide reference, clustering per chromosome:
+    pixel_clust = pd.concat([
+        dotfinder.clust_2D_pixels(
+            pixels[pixels['chrom1'] == chrom], threshold_cluster=radius,
+            bin1_id_name='start1', bin2_id_name='start2', verbose=False)
+        for chrom in clr.chromnames])
+    df = pixels.join(pixel_clust)
+    ref = df.loc[df.groupby(["chrom1", "chrom2", "c_label"], observed=True)
+                   ["obs.raw"].idxmax()]
+
+    for nproc in [1, 2]:
+        centroids, out = dotfinder.clustering_and_thresholding_step(
+            pixels, clr.chromnames, radius, False, nproc=nproc)
+        pd.testing.assert_frame_equal(centroids, ref)
+        pd.testing.assert_frame_equal(out, dotfinder.thresholding_step(ref))
+        pd.testing.assert_frame_equal(
+            dotfinder.clustering_step_local(pixels, clr.chromnames, radius,
+                                            False, nproc=nproc),
+            ref)
+
+
+def test_extraction_sink(tmpdir, clr, inputs, extracted):
+    expected, kernels, ledges, tiles, band = inputs
+    thresholds, _ = extracted
+    ref_path = op.join(str(tmpdir), 'ref.tsv')
+    ref = dotfinder.scoring_and_extraction_step(
+        clr, expected, 'balanced.avg', tiles, kernels, ledges, thresholds,
+        1, 1.0, band, ref_path, 1, False)
+    by = ["chrom1", "chrom2", "start1", "start2"]
+    ref_txt = pd.read_csv(ref_path, sep='\t') \
+                .sort_values(by=by).reset_index(drop=True)
+
+    output_path = op.join(str(tmpdir), 'calls.tsv')
+    for nproc in [1, 2]:
+        chrom_dfs = list(dotfinder.scoring_and_extraction_step(
+            clr, expected, 'balanced.avg', tiles, kernels, ledges,
+            thresholds, 1, 1.0, band, output_path, nproc, False,
+            sink_path=op.join(str(tmpdir), 'sink.h5')))
+        # one chromosome at a time:
+        assert [df['chrom1'].unique().tolist() for df in chrom_dfs] == \
+            [[chrom] for chrom in clr.chromnames]
+        pd.testing.assert_frame_equal(pd.concat(chrom_dfs), ref)
+        # written already sorted:
+        pd.testing.assert_frame_equal(pd.read_csv(output_path, sep='\t'),
+                                      ref_txt)
+
+    # clustered as they come, the same as all at once:
+    for k in kernels:
+        ref["la_exp."+k+".qval"] = ref["la_exp."+k+".pval"]
+    for nproc in [1, 2]:
+        chrom_dfs = dotfinder.scoring_and_extraction_step(
+            clr, expected, 'balanced.avg', tiles, kernels, ledges,
+            thresholds, 1, 1.0, band, None, nproc, False,
+            sink_path=op.join(str(tmpdir), 'sink.h5'))
+        chrom_dfs = (df.assign(**{"la_exp."+k+".qval": df["la_exp."+k+".pval"]
+                                  for k in kernels}) for df in chrom_dfs)
+        centroids, out = dotfinder.clustering_and_thresholding_step(
+            chrom_dfs, clr.chromnames, 3 * binsize, False, nproc=nproc)
+        ref_centroids, ref_out = dotfinder.clustering_and_thresholding_step(
+            ref, clr.chromnames, 3 * binsize, False)
+        pd.testing.assert_frame_equal(centroids, ref_centroids)
+        pd.testing.assert_frame_equal(out, ref_out)
+
+    # no pixels at all:
+    empty = list(dotfinder._sink_and_sort(
+        iter([]), tiles, op.join(str(tmpdir), 'empty.h5'), None,
+        by=["chrom1", "chrom2", "start1", "start2"], verbose=False))
+    assert len(empty) == 1 and empty[0].empty
+    centroids, out = dotfinder.clustering_and_thresholding_step(
+        iter(empty), clr.chromnames, 3 * binsize, False)
+    assert centroids.empty and out.empty
+
+
+def test_merge_resolutions():
+    def make_calls(chroms, starts1, starts2, res):
+        return pd.DataFrame({
+            'chrom1': chroms, 'start1': starts1,
+            'end1': np.add(starts1, res),
+            'chrom2': chroms, 'start2': starts2,
+            'end2': np.add(starts2, res)})
+
+    calls = {
+        5000: make_calls(['chr1', 'chr2'], [100000, 100000],
+                         [300000, 500000], 5000),
+        # near the 1st 5 kb dot, 50 kb away from the 2nd and elsewhere:
+        10000: make_calls(['chr1', 'chr1', 'chr2', 'chr3'],
+                          [100000, 800000, 150000, 100000],
+                          [310000, 900000, 500000, 300000], 10000),
+    }
+    merged = dotfinder.merge_resolutions(calls)
+    assert merged[['chrom1', 'start1', 'start2', 'res']].values.tolist() == [
+        ['chr1', 100000, 300000, 5000],
+        ['chr1', 800000, 900000, 10000],
+        ['chr2', 100000, 500000, 5000],
+        ['chr2', 150000, 500000, 10000],
+        ['chr3', 100000, 300000, 10000]]
+    # a larger radius merges the chr2 dots as well:
+    merged = dotfinder.merge_resolutions(calls, radius=200000)
+    assert (merged['chrom1'] == 'chr2').sum() == 1
+
+
+def test_map_tiles_shared_pool():
+    pool = dotfinder.mp.Pool(2)
+    try:
+        for _ in range(2):
+            res = dict(dotfinder.map_tiles(lambda x: x * x, list(range(10)),
+                                           2, False, pool=pool))
+            assert res == {x: x * x for x in range(10)}
+    finally:
+        pool.close()
+
+
+def test_profile(clr, inputs):
+    expected, kernels, ledges, tiles, band = inputs
+    for nproc in [1, 2]:
+        profile = []
+        dotfinder.scoring_and_histogramming_step(
+            clr, expected, 'balanced.avg', tiles, kernels, ledges, 1, band,
+            None, nproc, False, profile=profile)
+        assert len(profile) == len(tiles)
+        records = pd.DataFrame(profile)
+        assert (records['step'] == 'histogramming').all()
+        assert sorted(zip(records['bin1_start'], records['bin2_start'])) == \
+            sorted((tilei[0], tilej[0]) for _, tilei, tilej in tiles)
+        assert (records['dense_bytes'] > 0).all()
+        assert (records['bytes_fetched'] > 0).all()
+        assert (records['transfer'] >= 0).all()
+        assert records['n_pixels'].sum() > 0
+        stages = records[dotfinder.PROFILE_STAGES].sum(axis=1)
+        assert (stages <= records['time'] + 1e-6).all()
+
+    stages, slowest = dotfinder.profile_summary(profile, n_slowest=3)
+    assert stages.loc['histogramming', 'tiles'] == len(tiles)
+    assert np.isclose(stages.loc['histogramming', 'time'],
+                      records['time'].sum())
+    assert len(slowest) == 3
+    assert slowest['time'].is_monotonic_decreasing
+
+
+def test_call_dots_resolutions_cli(tmpdir, clr):
+    resolutions = [binsize, 2 * binsize]
+    mcool = op.join(str(tmpdir), 'dots.mcool')
+    cooler.zoomify_cooler(clr.uri, mcool, resolutions, chunksize=10000000)
+    for res in resolutions:
+        cooler.balance_cooler(
+            cooler.Cooler('{}::resolutions/{}'.format(mcool, res)),
+            ignore_diags=1, store=True)
+    # expected of every resolution, as <prefix>.dots.<res>.cis.tsv:
+    exp_prefix = op.join(str(tmpdir), 'exp')
+    subprocess.check_output(
+        'python -m cooltools compute-expected -o {} {}'.format(
+            exp_prefix, mcool),
+        shell=True)
+
+    out_calls = op.join(str(tmpdir), 'calls.tsv')
+    spill_dir = op.join(str(tmpdir), 'spill')
+    args = ('--max-loci-separation 1000000 --tile-size 1200000 --fdr 0.1'
+            ' --dots-clustering-radius 30000')
+    subprocess.check_output(
+        'python -m cooltools call-dots -n 2 {} --resolutions {},{}'
+        ' --spill-dir {} -o {} {} {}.dots.{{resolution}}.cis.tsv'.format(
+            args, resolutions[0], resolutions[1], spill_dir, out_calls, mcool,
+            exp_prefix),
+        shell=True)
+    calls = {}
+    for res in resolutions:
+        assert op.exists(op.join(str(tmpdir), 'calls.{}.tsv'.format(res)))
+        calls[res] = pd.read_csv(
+            op.join(str(tmpdir), 'final_calls.{}.tsv'.format(res)), sep='\t')
+        assert len(calls[res]) > 0
+        assert (calls[res]['end1'] - calls[res]['start1'] == res).all()
+        # spilled pixels of a run are kept apart from other runs':
+        assert len(os.listdir(op.join(spill_dir, str(res)))) == 1
+    merged = pd.read_csv(op.join(str(tmpdir), 'final_calls.tsv'), sep='\t')
+    pd.testing.assert_frame_equal(
+        merged, dotfinder.merge_resolutions(calls), check_dtype=False)
+    # the planted dots are called at the finer resolution:
+    fine = merged[merged['res'] == binsize]
+    for chrom, chrom_dots in dots.items():
+        for i, j in chrom_dots:
+            assert ((fine['chrom1'] == chrom) &
+                    ((fine['start1'] // binsize - i).abs() <= 1) &
+                    ((fine['start2'] // binsize - j).abs() <= 1)).any()
+
+    # EXPECTED_PATH must be a template:
+    with pytest.raises(subprocess.CalledProcessError):
+        subprocess.check_output(
+            'python -m cooltools call-dots {} --resolutions {} -o {}'
+            ' {} {}.dots.{}.cis.tsv'.format(
+                args, resolutions[0], out_calls, mcool, exp_prefix,
+                resolutions[0]),
+            shell=True, stderr=subprocess.STDOUT)
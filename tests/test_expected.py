@@ -1,10 +1,15 @@
 import os.path as op
+import shutil
+import subprocess
+import h5py
+import pytest
 import numpy as np
 import pandas as pd
 
 import bioframe
 import cooler
 import cooltools.expected
+from cooltools.lib import get_bin_arrays, annotate_pixels
 
 chromsizes = bioframe.fetch_chromsizes('mm9')
 chromosomes = list(chromsizes.index)
@@ -39,3 +44,316 @@ def test_blocksum(request):
         [{'chrom1': s1[0], 'chrom2': s2[0], **rec} 
             for (s1, s2), rec in records.items()], 
         columns=['chrom1', 'chrom2', 'n_valid', 'count.sum', 'balanced.sum'])
+
+
+def _balanced(p):
+    return p['count'] * p['weight1'] * p['weight2']
+
+
+def _masked_cooler(request, tmpdir):
+    # copy of the test cooler with a few bad (NaN-weighted) bins
+    src = op.join(request.fspath.dirname, 'data/sin_eigs_mat.cool')
+    dst = op.join(str(tmpdir), 'masked.cool')
+    shutil.copy(src, dst)
+    with h5py.File(dst, 'r+') as f:
+        weight = f['bins/weight'][:]
+        weight[[3, 4, 150, 420, 599]] = np.nan
+        f['bins/weight'][:] = weight
+    return cooler.Cooler(dst)
+
+
+def test_diagsum_matches_groupby(request, tmpdir):
+    clr = _masked_cooler(request, tmpdir)
+    # arm-like supports, including one that doesn't start at 0:
+    supports = [('chr1', 0, 500), ('chr1', 500, 1000), ('chr2', 0, 2000),
+                ('chr3', 1000, 3000)]
+    tables = cooltools.expected.diagsum(
+        clr,
+        supports,
+        transforms={'balanced': _balanced},
+        chunksize=30000,
+        ignore_diags=0)
+
+    pixels = cooler.annotate(clr.pixels()[:], clr.bins()[:], replace=False)
+    pixels['balanced'] = _balanced(pixels)
+    for chrom, start, end in supports:
+        sel = pixels[(pixels['chrom1'] == chrom) &
+                     (pixels['chrom2'] == chrom) &
+                     (pixels['start1'] >= start) &
+                     (pixels['end2'] <= end)]
+        ref = sel.groupby(sel['bin2_id'] - sel['bin1_id'])[['count', 'balanced']].sum()
+        dt = tables[chrom, start, end]
+        assert len(dt) == (end - start) // clr.binsize
+        assert np.allclose(dt['count.sum'].loc[ref.index], ref['count'])
+        assert np.allclose(dt['balanced.sum'].loc[ref.index], ref['balanced'])
+        assert dt['count.sum'].drop(ref.index).sum() == 0
+
+
+def test_diagsum_moments(request, tmpdir):
+    clr = _masked_cooler(request, tmpdir)
+    supports = [('chr2', 0, 2000)]
+    tables = cooltools.expected.diagsum(
+        clr,
+        supports,
+        transforms={'balanced': _balanced},
+        chunksize=30000,
+        ignore_diags=2,
+        moments=('sumsq', 'logsum'))
+    dt = tables['chr2', 0, 2000]
+    plain = cooltools.expected.diagsum(
+        clr, supports, transforms={'balanced': _balanced}, chunksize=30000)
+    pd.testing.assert_frame_equal(dt[plain[supports[0]].columns],
+                                  plain[supports[0]])
+
+    # reference: moments over the valid pixels of the dense matrix,
+    # including the ones that are not stored
+    mat = clr.matrix(balance=True).fetch('chr2')
+    valid = np.isfinite(clr.bins().fetch('chr2')['weight'].values)
+    for d in range(2, 50):
+        sel = valid[:len(valid) - d] & valid[d:]
+        x = np.nan_to_num(np.diagonal(mat, d)[sel])
+        assert dt['n_valid'][d] == sel.sum()
+        assert np.isclose(dt['balanced.var'][d], x.var())
+        assert np.isclose(dt['balanced.std'][d], x.std())
+        assert np.isclose(dt['balanced.logsum'][d], np.log(x[x > 0]).sum())
+        assert dt['balanced.npos'][d] == (x > 0).sum()
+    assert dt['balanced.var'][:2].isnull().all()
+
+    with pytest.raises(ValueError):
+        cooltools.expected.diagsum(clr, supports, transforms={},
+                                   moments=('kurtosis',))
+
+
+def test_diagsum_and_blocksum(request, tmpdir):
+    clr = _masked_cooler(request, tmpdir)
+    supports = [(chrom, 0, clr.chromsizes[chrom]) for chrom in clr.chromnames]
+    transforms = {'balanced': _balanced}
+    tables, records = cooltools.expected.diagsum_and_blocksum(
+        clr, supports, transforms=transforms, chunksize=30000)
+    ref_tables = cooltools.expected.diagsum(
+        clr, supports, transforms=transforms, chunksize=30000)
+    ref_records = cooltools.expected.blocksum_pairwise(
+        clr, supports, transforms=transforms, chunksize=30000)
+    for support in supports:
+        pd.testing.assert_frame_equal(tables[support], ref_tables[support])
+    assert records.keys() == ref_records.keys()
+    for block in records:
+        for key in ['n_valid', 'count.sum', 'balanced.sum']:
+            assert np.isclose(records[block][key], ref_records[block][key])
+
+
+def test_annotate_pixels(request, tmpdir):
+    clr = _masked_cooler(request, tmpdir)
+    pixels = clr.pixels()[1000:5000]
+    bin_arrays = get_bin_arrays(clr)
+    # cached per process:
+    assert get_bin_arrays(clr) is bin_arrays
+    pd.testing.assert_frame_equal(
+        annotate_pixels(pixels, bin_arrays),
+        cooler.annotate(pixels, clr.bins()[:], replace=False),
+        check_dtype=False,
+        check_categorical=False)
+
+
+def test_expected_state_merge(request, tmpdir):
+    clr = _masked_cooler(request, tmpdir)
+    supports = [(chrom, 0, clr.chromsizes[chrom]) for chrom in clr.chromnames]
+    bins = clr.bins()[:]
+    pixels = clr.pixels()[:]
+    # split the counts into two "lanes" sharing the bin table:
+    lanes = []
+    for i, counts in enumerate([pixels['count'] // 3,
+                                pixels['count'] - pixels['count'] // 3]):
+        uri = op.join(str(tmpdir), 'lane{}.cool'.format(i))
+        cooler.create_cooler(uri, bins, pixels.assign(count=counts))
+        lanes.append(cooler.Cooler(uri))
+
+    kwargs = dict(transforms={'balanced': _balanced}, chunksize=30000,
+                  return_state=True)
+    full = cooltools.expected.diagsum(clr, supports, **kwargs)
+    parts = [cooltools.expected.diagsum(lane, supports, **kwargs)
+                for lane in lanes]
+    merged = parts[0].merge(parts[1])
+    for support, dt in full.finalize().items():
+        pd.testing.assert_frame_equal(merged.finalize()[support], dt)
+    rest = full.subtract(parts[1])
+    assert np.allclose(rest.sums['count.sum'], parts[0].sums['count.sum'])
+
+    full_trans = cooltools.expected.blocksum_pairwise(clr, supports, **kwargs)
+    parts_trans = [cooltools.expected.blocksum_pairwise(lane, supports, **kwargs)
+                       for lane in lanes]
+    merged_trans = parts_trans[0].merge(parts_trans[1]).finalize()
+    for block, rec in full_trans.finalize().items():
+        assert np.isclose(merged_trans[block]['count.sum'], rec['count.sum'])
+
+    # round-trip through disk:
+    path = op.join(str(tmpdir), 'state.npz')
+    merged.save(path)
+    loaded = cooltools.expected.ExpectedState.load(path)
+    assert loaded.supports == merged.supports
+    for support, dt in merged.finalize().items():
+        pd.testing.assert_frame_equal(loaded.finalize()[support], dt)
+
+    # states with different masks can't be merged:
+    other = cooltools.expected.diagsum(
+        cooler.Cooler(op.join(request.fspath.dirname, 'data/sin_eigs_mat.cool')),
+        supports, **kwargs)
+    with pytest.raises(ValueError):
+        merged.merge(other)
+
+    # sums of squares and logarithms of merged lanes are not
+    # the sums of the ones of the lanes:
+    parts = [cooltools.expected.diagsum(lane, supports,
+                                        moments=('sumsq', 'logsum'), **kwargs)
+                for lane in lanes]
+    with pytest.raises(ValueError):
+        parts[0].merge(parts[1])
+    with pytest.raises(ValueError):
+        parts[0].subtract(parts[1])
+
+
+def _count_bad_pixels_per_diag_loop(n, bad_bins):
+    # reference implementation with the squeezing bounds loop
+    k = len(bad_bins)
+    dcount = np.zeros(n, dtype=int)
+    ixn = cooltools.expected.lattice_pdist_frequencies(n, bad_bins)
+    dcount[0] = ixn[0]
+    pl = 0
+    pr = k
+    for diag in range(1, n):
+        if pl < k:
+            while (bad_bins[pl] - diag) < 0:
+                pl += 1
+                if pl == k:
+                    break
+        if pr > 0:
+            while (bad_bins[pr-1] + diag) >= n:
+                pr -= 1
+                if pr == 0:
+                    break
+        dcount[diag] = 2*k - ixn[diag] - pl - (k - pr)
+    return dcount
+
+
+def _make_diag_table_brute(bad_mask, span1, span2):
+    (lo1, hi1), (lo2, hi2) = sorted([tuple(span1), tuple(span2)])
+    i, j = np.meshgrid(np.arange(lo1, hi1), np.arange(lo2, hi2), indexing='ij')
+    i, j = i.ravel(), j.ravel()
+    upper = (j >= i)
+    i, j = i[upper], j[upper]
+    good = ~bad_mask[i] & ~bad_mask[j]
+    return pd.Series(good.astype(int)).groupby(j - i).sum()
+
+
+def test_count_bad_pixels_per_diag():
+    rng = np.random.RandomState(0)
+    for n, k in [(1, 0), (10, 0), (10, 10), (50, 1), (200, 20), (1000, 300)]:
+        bad_bins = np.sort(rng.choice(n, k, replace=False))
+        assert np.array_equal(
+            cooltools.expected.count_bad_pixels_per_diag(n, bad_bins),
+            _count_bad_pixels_per_diag_loop(n, bad_bins))
+
+
+def test_make_diag_table():
+    rng = np.random.RandomState(1)
+    bad_mask = rng.rand(300) < 0.1
+    bad_mask[:5] = True
+    for span1, span2 in [
+            ([0, 300], [0, 300]),     # whole scaffold
+            ([20, 120], [20, 120]),   # symmetric
+            ([0, 100], [100, 250]),   # adjacent
+            ([50, 150], [100, 250]),  # overlapping
+            ([10, 60], [200, 290]),   # gap in between
+            ([200, 290], [10, 60]),   # swapped
+        ]:
+        dt = cooltools.expected.make_diag_table(bad_mask, span1, span2)
+        ref = _make_diag_table_brute(bad_mask, span1, span2)
+        assert np.array_equal(dt.index, ref.index)
+        assert np.array_equal(dt['n_valid'], ref.values)
+        if span1 == span2:
+            n = span1[1] - span1[0]
+            bad_bins = np.flatnonzero(bad_mask[span1[0]:span1[1]])
+            assert np.array_equal(
+                dt['n_valid'],
+                n - np.arange(n) - _count_bad_pixels_per_diag_loop(n, bad_bins))
+
+
+def test_trans_expected(request, tmpdir):
+    clr = _masked_cooler(request, tmpdir)
+    chromosomes = ['chr3', 'chr1', 'chr2']
+    result = cooltools.expected.trans_expected(clr, chromosomes, chunksize=30000)
+
+    pixels = cooler.annotate(clr.pixels()[:], clr.bins()[:], replace=False)
+    pixels = pixels[pixels['chrom1'] != pixels['chrom2']]
+    pixels['balanced'] = _balanced(pixels)
+    ref = pixels.groupby(['chrom1', 'chrom2'], observed=True)['balanced'].sum()
+    assert list(result.index) == [('chr1', 'chr2'), ('chr1', 'chr3'), ('chr2', 'chr3')]
+    assert np.allclose(result['balanced.sum'], ref.loc[result.index])
+    assert np.allclose(result['balanced.avg'],
+                       result['balanced.sum'] / result['n_valid'])
+
+
+def test_expected_cli_formats(request, tmpdir):
+    from cooltools.cli.util import read_expected
+    in_cool = op.join(request.fspath.dirname, 'data/sin_eigs_mat.cool')
+    columns = ['chrom', 'diag', 'n_valid', 'balanced.avg']
+    dtype = {'chrom': str, 'diag': np.int64, 'n_valid': np.int64,
+             'balanced.avg': np.float64}
+    tables = {}
+    for fmt, ext in [('tsv', '.tsv'), ('hdf5', '.h5')]:
+        out_prefix = op.join(str(tmpdir), fmt)
+        subprocess.check_output(
+            'python -m cooltools compute-expected --format {} '
+            '-o {} {}'.format(fmt, out_prefix, in_cool),
+            shell=True)
+        tables[fmt] = read_expected(
+            out_prefix + '.cis' + ext, columns, ['chrom', 'diag'], dtype)
+    pd.testing.assert_frame_equal(tables['hdf5'], tables['tsv'])
+
+    with pytest.raises(ValueError, match='missing'):
+        read_expected(op.join(str(tmpdir), 'hdf5.cis.h5'),
+                      columns + ['missing'], ['chrom', 'diag'], dtype)
+
+
+def test_expected_cli_parquet(request, tmpdir):
+    pytest.importorskip('pyarrow')
+    from cooltools.cli.util import read_expected
+    in_cool = op.join(request.fspath.dirname, 'data/sin_eigs_mat.cool')
+    columns = ['chrom', 'diag', 'n_valid', 'balanced.avg']
+    dtype = {'chrom': str, 'diag': np.int64, 'n_valid': np.int64,
+             'balanced.avg': np.float64}
+    tables = {}
+    for fmt, ext in [('tsv', '.tsv'), ('parquet', '.parquet')]:
+        out_prefix = op.join(str(tmpdir), fmt)
+        subprocess.check_output(
+            'python -m cooltools compute-expected --format {} '
+            '-o {} {}'.format(fmt, out_prefix, in_cool),
+            shell=True)
+        tables[fmt] = read_expected(
+            out_prefix + '.cis' + ext, columns, ['chrom', 'diag'], dtype)
+    pd.testing.assert_frame_equal(tables['parquet'], tables['tsv'])
+
+    with pytest.raises(ValueError, match='missing'):
+        read_expected(op.join(str(tmpdir), 'parquet.cis.parquet'),
+                      columns + ['missing'], ['chrom', 'diag'], dtype)
+
+
+def test_diagsum_batch(request, tmpdir):
+    clr = _masked_cooler(request, tmpdir)
+    clr_other = cooler.Cooler(
+        op.join(request.fspath.dirname, 'data/sin_eigs_mat.cool'))
+    supports = [(chrom, 0, clr.chromsizes[chrom]) for chrom in clr.chromnames]
+    transforms = {'balanced': _balanced}
+    batch = cooltools.expected.diagsum_batch(
+        [clr, clr_other, clr], supports, transforms=transforms,
+        chunksize=30000)
+    assert len(batch) == 3
+    for clr_, tables in zip([clr, clr_other, clr], batch):
+        ref = cooltools.expected.diagsum(
+            clr_, supports, transforms=transforms, chunksize=30000)
+        for support in supports:
+            pd.testing.assert_frame_equal(tables[support], ref[support])
+    # only coolers with the same bins and bad-bin masks share diag tables:
+    key = cooltools.expected._diag_tables_key
+    assert key(clr, supports) == key(cooler.Cooler(clr.uri), supports)
+    assert key(clr, supports) != key(clr_other, supports)